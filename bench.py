@@ -0,0 +1,153 @@
+"""מדידות ביצועים לרכיבי הבוט - הרצה: python bench.py [ratelimit|find|recall|timeparse ...]"""
+import asyncio
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# הבוט קורא את ההגדרות בזמן import - ערכי דמה מספיקים למדידות מקומיות
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:bench")
+os.environ.setdefault("GROQ_API_KEY", "bench")
+os.environ.setdefault("HF_TOKEN", "bench")
+
+import bot
+
+
+def bench_ratelimit(users: int = 100_000, checks: int = 1_000_000):
+    limiter = bot.RateLimiter()
+    now = time.time()
+
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    for uid in range(users):
+        limiter.check(uid, "msgs", bot.RATE_MSGS, 60, now)
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    print(f"ratelimit: {users:,} users -> {used / 1024 / 1024:.1f}MB ({used / users:.0f}B/user)")
+
+    t0 = time.perf_counter()
+    for i in range(checks):
+        limiter.check(i % users, "msgs", bot.RATE_MSGS, 60, now + i * 1e-4)
+    elapsed = time.perf_counter() - t0
+    print(f"ratelimit: {checks:,} checks -> {elapsed * 1e9 / checks:.0f}ns/check")
+
+    t0 = time.perf_counter()
+    evicted = limiter.evict_idle(now + 180)
+    print(f"ratelimit: evicted {evicted:,} idle windows in {(time.perf_counter() - t0) * 1000:.1f}ms")
+
+
+def _hebrew_vocab(size: int, rng: random.Random) -> list[str]:
+    letters = "אבגדהוזחטיכלמנסעפצקרשת"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(3, 7))) for _ in range(size)]
+
+
+async def _timed(label: str, runs: int, fn):
+    t0 = time.perf_counter()
+    for _ in range(runs):
+        result = await fn()
+    print(f"find: {label:<28} {(time.perf_counter() - t0) * 1000 / runs:8.2f}ms/query")
+    return result
+
+
+def bench_find(notes: int = int(os.getenv("BENCH_NOTES", 1_000_000)), users: int = 50):
+    """1M פתקים סינתטיים: LIKE הישן מול FTS5 trigram (כולל ספירה ועמוד ראשון)"""
+    rng = random.Random(1)
+    vocab = _hebrew_vocab(20_000, rng)
+    cum_weights = list(itertools.accumulate(1 / (i + 1) for i in range(len(vocab))))
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    bot.db.path = path
+
+    async def run():
+        await bot.init_db()
+        t0 = time.perf_counter()
+        with sqlite3.connect(path) as conn:
+            batch = []
+            for i in range(notes):
+                words = rng.choices(vocab, cum_weights=cum_weights, k=30)
+                batch.append((i % users, " ".join(words[:3]), " ".join(words[3:]), i))
+                if len(batch) == 10_000:
+                    conn.executemany("INSERT INTO notes (user_id, title, content, created_at) VALUES (?, ?, ?, ?)", batch)
+                    batch.clear()
+            conn.executemany("INSERT INTO notes (user_id, title, content, created_at) VALUES (?, ?, ?, ?)", batch)
+        print(f"find: inserted {notes:,} notes (with FTS triggers) in {time.perf_counter() - t0:.1f}s")
+
+        for query in (vocab[50], vocab[5000], f"{vocab[50]} {vocab[200]}"):
+            print(f"find: query '{query}'")
+
+            async def old_like():
+                return await bot.db.fetchall(
+                    "SELECT id, title, content FROM notes WHERE user_id=? AND (title LIKE ? OR content LIKE ?)",
+                    (7, f"%{query}%", f"%{query}%")
+                )
+            rows = await _timed("old LIKE (all rows)", 3, old_like)
+
+            bot.NOTES_FTS = False
+            await _timed("LIKE page", 3, lambda: bot.search_notes(7, query))
+            bot.NOTES_FTS = True
+            total, _ = await _timed("FTS5 page (count + bm25)", 20, lambda: bot.search_notes(7, query))
+            print(f"find:   old LIKE rows {len(rows):,}, FTS total {total:,}")
+        await bot.db.close()
+
+    asyncio.run(run())
+
+
+def bench_recall(turns: int = 100_000, queries: int = 200):
+    """זיכרון ארוך למשתמש עם 100k תורות: בנייה, הוספה בודדת וחיפוש top-k"""
+    rng = random.Random(2)
+    vocab = _hebrew_vocab(20_000, rng)
+    cum_weights = list(itertools.accumulate(1 / (i + 1) for i in range(len(vocab))))
+    texts = [" ".join(rng.choices(vocab, cum_weights=cum_weights, k=rng.randint(5, 40))) for _ in range(turns)]
+    memory = bot.RecallMemory(bot.RECALL_DIM, max_mb=4096)
+    entry = bot._UserRecall(memory.dim)
+
+    t0 = time.perf_counter()
+    memory._add(entry, [("user", t) for t in texts])
+    print(f"recall: built {turns:,} turns in {time.perf_counter() - t0:.2f}s "
+          f"({memory._cost(entry) / 1024 / 1024:.0f}MB incl. text)")
+    memory._store(1, entry)
+
+    t0 = time.perf_counter()
+    for t in texts[:1000]:
+        memory.append(1, "assistant", t)
+    print(f"recall: append {(time.perf_counter() - t0) * 1e6 / 1000:.0f}us/turn")
+
+    async def run():
+        samples = []
+        for i in range(queries):
+            query = " ".join(rng.choices(vocab, cum_weights=cum_weights, k=8))
+            t0 = time.perf_counter()
+            await memory.search(1, query, k=4, exclude_recent=50)
+            samples.append((time.perf_counter() - t0) * 1000)
+        samples.sort()
+        print(f"recall: search p50 {samples[len(samples) // 2]:.2f}ms, p95 {samples[int(len(samples) * 0.95)]:.2f}ms")
+
+    asyncio.run(run())
+
+
+def bench_timeparse(cases: int = 20_000):
+    """מהירות המנתח מול הקודם. הנכונות (זהות לקודם, fuzz, מקרי קצה) נבדקת ב-tests/test_reminder_time_parser.py"""
+    from tests.test_reminder_time_parser import NOW, legacy_input, legacy_parse_reminder_time
+    rng = random.Random(3)
+    parser = bot.ReminderTimeParser()
+    corpus = [legacy_input(rng) for _ in range(cases)]
+    for label, fn in (("old", lambda t: legacy_parse_reminder_time(t, NOW)), ("new", lambda t: parser.parse(t, NOW))):
+        t0 = time.perf_counter()
+        for text in corpus:
+            fn(text)
+        print(f"timeparse: {label} {(time.perf_counter() - t0) * 1e6 / len(corpus):.1f}us/parse")
+
+
+BENCHES = {
+    "ratelimit": bench_ratelimit,
+    "find": bench_find,
+    "recall": bench_recall,
+    "timeparse": bench_timeparse,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHES:
+        BENCHES[name]()
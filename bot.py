@@ -1,12 +1,24 @@
 import asyncio
 import time
+BOOT_STARTED = time.perf_counter()
+import sys
 import logging
 import shutil
+import sqlite3
+import gzip
 import io
 import re
 import json
+import heapq
+import hashlib
+import random
+import tempfile
+import zipfile
 from datetime import datetime, timedelta
-from collections import defaultdict
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command, CommandObject
 from aiogram.types import (
@@ -15,15 +27,14 @@ from aiogram.types import (
     CallbackQuery, ReplyKeyboardMarkup, KeyboardButton,
     ReplyKeyboardRemove
 )
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from groq import AsyncGroq
-from huggingface_hub import InferenceClient
+from aiogram.methods import GetUpdates
 from dotenv import load_dotenv
 import os
 import aiosqlite
-from duckduckgo_search import DDGS
 
 load_dotenv()
 
@@ -38,27 +49,98 @@ MAX_HISTORY_DAYS = int(os.getenv("MAX_HISTORY_DAYS", 90))
 RATE_MSGS = int(os.getenv("RATE_MSGS_PER_MIN", 12))
 RATE_SEARCH = int(os.getenv("RATE_SEARCH_PER_HOUR", 5))
 RATE_IMAGES = int(os.getenv("RATE_IMAGES_PER_HOUR", 4))
+RATE_PERSIST = os.getenv("RATE_PERSIST", "1") == "1"
+RATE_SNAPSHOT_SEC = int(os.getenv("RATE_SNAPSHOT_SEC", 300))
+REMINDER_CONCURRENCY = int(os.getenv("REMINDER_CONCURRENCY", 20))
+REMINDER_MAX_ATTEMPTS = int(os.getenv("REMINDER_MAX_ATTEMPTS", 5))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE_PER_SEC", 25))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 8))
+EXPORT_PART_MB = int(os.getenv("EXPORT_PART_MB", 45))  # מגבלת מסמך של Bot API היא 50MB
+EXPORT_SPOOL_MB = int(os.getenv("EXPORT_SPOOL_MB", 4))
+DIGEST_TIME = os.getenv("DIGEST_TIME", "08:00")
+DIGEST_TZ = os.getenv("DIGEST_TZ", "")  # ריק = שעון השרת
+DIGEST_RATE = float(os.getenv("DIGEST_RATE_PER_SEC", 25))
+DIGEST_WORKERS = int(os.getenv("DIGEST_WORKERS", 8))
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", 1800))
+SEARCH_CACHE_MAX = int(os.getenv("SEARCH_CACHE_MAX", 500))
+IMAGE_WORKERS_SCHNELL = int(os.getenv("IMAGE_WORKERS_SCHNELL", 2))
+IMAGE_WORKERS_DEV = int(os.getenv("IMAGE_WORKERS_DEV", 1))
+IMAGE_TIMEOUT = int(os.getenv("IMAGE_TIMEOUT_SEC", 180))
+IMAGE_SIZE = 1024
+IMAGE_DEFAULT_SEED = 0
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+IMAGE_CACHE_MB = int(os.getenv("IMAGE_CACHE_MB", 500))
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "tts_cache")
+TTS_CACHE_MB = int(os.getenv("TTS_CACHE_MB", 200))
+TTS_HOT_MB = int(os.getenv("TTS_HOT_MB", 8))
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", 3))
+VOICE_PIPELINE = os.getenv("VOICE_PIPELINE", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.2))
+FAST_START = os.getenv("FAST_START", "1") == "1"
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", 20))
+ROUTER_FAIL_THRESHOLD = int(os.getenv("ROUTER_FAIL_THRESHOLD", 3))
+ROUTER_COOLDOWN_SEC = int(os.getenv("ROUTER_COOLDOWN_SEC", 60))
+MODEL_PROBE_SEC = int(os.getenv("MODEL_PROBE_SEC", 3600))
 
-GROQ_MODELS = [
-    "llama-3.3-70b-versatile",
-    "llama-3.1-70b-versatile",
-    "llama3-70b-8192",
-    "mixtral-8x7b-32768",
-]
-active_model = GROQ_MODELS[0]
+# מודל -> חלון הקשר בטוקנים, לפי סדר עדיפות
+GROQ_MODELS = {
+    "llama-3.3-70b-versatile": 131072,
+    "llama-3.1-70b-versatile": 131072,
+    "llama3-70b-8192": 8192,
+    "mixtral-8x7b-32768": 32768,
+}
+PROMPT_TOKEN_CAP = int(os.getenv("PROMPT_TOKEN_CAP", 6000))
+PROMPT_HISTORY_TURNS = int(os.getenv("PROMPT_HISTORY_TURNS", 50))
 
 # STT models for voice
 WHISPER_MODEL = "whisper-large-v3"
+TTS_MODEL = "playai-tts"
+TTS_VOICE = "Cheyenne-PlayAI"
 
 storage = MemoryStorage()
 bot = Bot(token=TELEGRAM_TOKEN)
 dp = Dispatcher(storage=storage)
-groq_client = AsyncGroq(api_key=GROQ_API_KEY)
-hf = InferenceClient(token=HF_TOKEN)
+_clients = {}
+
+# groq / huggingface_hub / duckduckgo_search נטענים רק בשימוש הראשון כדי לא לעכב את העלייה
+def groq_client():
+    if "groq" not in _clients:
+        from groq import AsyncGroq
+        _clients["groq"] = AsyncGroq(api_key=GROQ_API_KEY)
+    return _clients["groq"]
+
+def hf_client():
+    if "hf" not in _clients:
+        from huggingface_hub import InferenceClient
+        _clients["hf"] = InferenceClient(token=HF_TOKEN)
+    return _clients["hf"]
 
 DB_FILE = "bot.db"
+DB_READERS = int(os.getenv("DB_READERS", 3))
+WRITE_BATCH_ROWS = int(os.getenv("WRITE_BATCH_ROWS", 64))
+WRITE_BATCH_MS = int(os.getenv("WRITE_BATCH_MS", 250))
+HISTORY_CACHE_WINDOW = int(os.getenv("HISTORY_CACHE_WINDOW", PROMPT_HISTORY_TURNS))
+HISTORY_CACHE_MB = int(os.getenv("HISTORY_CACHE_MB", 32))
+HISTORY_CACHE_IDLE_SEC = int(os.getenv("HISTORY_CACHE_IDLE_SEC", 1800))
+RETENTION_BATCH_ROWS = int(os.getenv("RETENTION_BATCH_ROWS", 500))
+RETENTION_PAUSE_MS = int(os.getenv("RETENTION_PAUSE_MS", 50))
+HISTORY_ARCHIVE_DIR = os.getenv("HISTORY_ARCHIVE_DIR", "")  # ריק = בלי ארכיון
+VACUUM_STEP_PAGES = int(os.getenv("VACUUM_STEP_PAGES", 512))
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_EVERY_SEC = int(os.getenv("BACKUP_EVERY_SEC", 3600))  # 0 = בלי גיבוי מתוזמן
+BACKUP_KEEP_HOURLY = int(os.getenv("BACKUP_KEEP_HOURLY", 24))
+BACKUP_KEEP_DAILY = int(os.getenv("BACKUP_KEEP_DAILY", 7))
+BACKUP_KEEP_OTHER = int(os.getenv("BACKUP_KEEP_OTHER", 10))  # לכל סוג: manual / wipe / prerestore
+BACKUP_STEP_PAGES = int(os.getenv("BACKUP_STEP_PAGES", 256))
+BACKUP_STEP_PAUSE_MS = int(os.getenv("BACKUP_STEP_PAUSE_MS", 5))
+PROFILE_CACHE_USERS = int(os.getenv("PROFILE_CACHE_USERS", 5000))
+RECALL_ENABLED = os.getenv("RECALL_ENABLED", "1") == "1"
+RECALL_DIM = int(os.getenv("RECALL_DIM", 128))
+RECALL_TOP_K = int(os.getenv("RECALL_TOP_K", 4))
+RECALL_MIN_SCORE = float(os.getenv("RECALL_MIN_SCORE", 0.2))
+RECALL_CACHE_MB = int(os.getenv("RECALL_CACHE_MB", 256))
 banned = set()
-rate_limit = defaultdict(lambda: {"msgs": [], "search": [], "images": []})
 
 logging.basicConfig(
     level=logging.INFO,
@@ -86,195 +168,2414 @@ def is_allowed(user_id: int) -> bool:
     return False
 
 # ====================== DATABASE ======================
+class Database:
+    """שכבת גישה לנתונים: חיבור כתיבה אחד + מאגר חיבורי קריאה, פתוחים לכל חיי הבוט"""
+
+    PRAGMAS = (
+        "PRAGMA auto_vacuum=INCREMENTAL",  # חל רק על קובץ חדש (לפני WAL); DB קיים מומר ב-/vacuum
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA busy_timeout=5000",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-8000",
+    )
+
+    def __init__(self, path: str, readers: int = 3):
+        self.path = path
+        self.reader_count = max(1, readers)
+        self._writer: aiosqlite.Connection | None = None
+        self._readers: list[aiosqlite.Connection] = []
+        self._idle_readers: asyncio.Queue = asyncio.Queue()
+        self._write_lock = asyncio.Lock()
+
+    async def _connect(self, read_only: bool = False) -> aiosqlite.Connection:
+        # cached_statements = מטמון prepared statements של sqlite3 לכל חיבור
+        conn = await aiosqlite.connect(self.path, cached_statements=256)
+        for pragma in self.PRAGMAS:
+            await conn.execute(pragma)
+        if read_only:
+            await conn.execute("PRAGMA query_only=1")
+        return conn
+
+    async def open(self):
+        if self._writer:
+            return
+        self._writer = await self._connect()
+        for _ in range(self.reader_count):
+            conn = await self._connect(read_only=True)
+            self._readers.append(conn)
+            self._idle_readers.put_nowait(conn)
+        logger.info(f"DB pool opened: 1 writer + {self.reader_count} readers")
+
+    async def close(self):
+        for conn in self._readers:
+            await conn.close()
+        self._readers.clear()
+        self._idle_readers = asyncio.Queue()
+        if self._writer:
+            async with self._write_lock:
+                await self._writer.commit()
+                await self._writer.close()
+            self._writer = None
+        logger.info("DB pool closed")
+
+    @asynccontextmanager
+    async def reader(self):
+        conn = await self._idle_readers.get()
+        try:
+            yield conn
+        finally:
+            self._idle_readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """חיבור הכתיבה תחת נעילה; commit ביציאה, rollback בשגיאה"""
+        async with self._write_lock:
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        """כתיבה בודדת. מחזיר rowcount"""
+        async with self.transaction() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return cursor.rowcount
+
+    async def insert(self, sql: str, params: tuple = ()) -> int:
+        """INSERT בודד. מחזיר lastrowid"""
+        async with self.transaction() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return cursor.lastrowid
+
+    async def executemany(self, sql: str, rows) -> int:
+        async with self.transaction() as conn:
+            async with conn.executemany(sql, rows) as cursor:
+                return cursor.rowcount
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list:
+        async with self.reader() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        async with self.reader() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+
+    async def fetchval(self, sql: str, params: tuple = (), default=None):
+        row = await self.fetchone(sql, params)
+        return row[0] if row else default
+
+db = Database(DB_FILE, readers=DB_READERS)
+
+class WriteBehind:
+    """תור כתיבה מושהית להיסטוריה ולעובדות: נשמר בקבוצות, טרנזקציה (ו-fsync) אחת לכל קבוצה.
+    עובדות נשמרות לפי (משתמש, מפתח), כך שעדכון חוזר לאותו מפתח לפני ה-flush נכתב פעם אחת"""
+
+    def __init__(self, database: Database, max_rows: int = 64, max_delay_ms: int = 250):
+        self.db = database
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000
+        self._history: list[tuple] = []
+        self._facts: dict[int, tuple] = {}
+        self._inflight_history: list[tuple] = []
+        self._inflight_facts: dict[int, tuple] = {}
+        self._has_data = asyncio.Event()
+        self._full = asyncio.Event()
+        self._no_flush = asyncio.Event()
+        self._no_flush.set()
+        self._reads_done = asyncio.Event()
+        self._active_reads = 0
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def _queued(self):
+        self._has_data.set()
+        if len(self._history) + len(self._facts) >= self.max_rows:
+            self._full.set()
+
+    def add_message(self, user_id: int, role: str, content: str):
+        self._history.append((user_id, role, content, int(time.time())))
+        self._queued()
+
+    def set_fact(self, user_id: int, key: str, value: str):
+        self._facts[(user_id, key)] = (value, int(time.time()))
+        self._queued()
+
+    def pending_history(self, user_id: int) -> list[tuple]:
+        return [r for r in self._inflight_history + self._history if r[0] == user_id]
+
+    def pending_facts(self, user_id: int) -> dict:
+        return {key: value for (uid, key), (value, _) in (self._inflight_facts | self._facts).items() if uid == user_id}
+
+    async def discard(self, user_id: int | None = None, history: bool = True, facts: bool = True):
+        """ביטול כתיבות ממתינות (ל-/clear, /clearmemory, /wipeall) כדי שלא ייכתבו מחדש אחרי המחיקה"""
+        if history:
+            self._history = [r for r in self._history if user_id is not None and r[0] != user_id]
+        if facts:
+            self._facts = {k: v for k, v in self._facts.items() if user_id is not None and k[0] != user_id}
+        # קבוצה שכבר בדרך לדיסק תסתיים לפני שהקורא ימחק
+        async with self._flush_lock:
+            pass
+
+    @asynccontextmanager
+    async def consistent_read(self):
+        """קריאה שלא חופפת ל-commit, כך שמיזוג DB + תור לא מכפיל ולא מפספס שורות"""
+        await self._no_flush.wait()
+        self._active_reads += 1
+        try:
+            yield
+        finally:
+            self._active_reads -= 1
+            if not self._active_reads:
+                self._reads_done.set()
+
+    async def flush(self) -> bool:
+        async with self._flush_lock:
+            if not self._history and not self._facts:
+                return True
+            self._inflight_history, self._history = self._history, []
+            self._inflight_facts, self._facts = self._facts, {}
+            self._full.clear()
+            self._no_flush.clear()
+            try:
+                while self._active_reads:
+                    self._reads_done.clear()
+                    await self._reads_done.wait()
+                started = time.perf_counter()
+                async with self.db.transaction() as conn:
+                    if self._inflight_history:
+                        await conn.executemany("INSERT INTO history VALUES (?, ?, ?, ?)", self._inflight_history)
+                    if self._inflight_facts:
+                        await conn.executemany(
+                            "INSERT INTO user_facts (user_id, key, value, updated_at) VALUES (?, ?, ?, ?) "
+                            "ON CONFLICT(user_id, key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at",
+                            [(uid, key, value, ts) for (uid, key), (value, ts) in self._inflight_facts.items()]
+                        )
+                logger.debug(f"Write-behind flushed {len(self._inflight_history)} messages, "
+                             f"{len(self._inflight_facts)} facts in {(time.perf_counter() - started) * 1000:.1f}ms")
+                return True
+            except Exception as e:
+                logger.error(f"Write-behind flush error: {e}")
+                # מחזירים לראש התור; עובדות חדשות יותר גוברות על הישנות
+                self._history = self._inflight_history + self._history
+                self._facts = {**self._inflight_facts, **self._facts}
+                return False
+            finally:
+                self._inflight_history, self._inflight_facts = [], {}
+                self._no_flush.set()
+
+    async def _run(self):
+        while True:
+            await self._has_data.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._has_data.clear()
+            if not await self.flush():
+                self._has_data.set()
+                await asyncio.sleep(1)
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """עצירה וריקון מלא של התור"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+write_behind = WriteBehind(db, max_rows=WRITE_BATCH_ROWS, max_delay_ms=WRITE_BATCH_MS)
+
+class _Window:
+    __slots__ = ("turns", "size", "last_used")
+
+    def __init__(self, turns: deque, size: int):
+        self.turns = turns
+        self.size = size
+        self.last_used = time.monotonic()
+
+class HistoryCache:
+    """LRU של חלון השיחה האחרון לכל משתמש פעיל (ring buffer), מתעדכן write-through"""
+
+    def __init__(self, window: int = 20, max_bytes: int = 32 * 1024 * 1024, idle_sec: int = 1800):
+        self.window = window
+        self.max_bytes = max_bytes
+        self.idle_sec = idle_sec
+        self._users: OrderedDict[int, _Window] = OrderedDict()
+        self._loading: dict[int, bool] = {}
+        self._bytes = 0
+        self._last_sweep = time.monotonic()
+        self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def _cost(turn: dict) -> int:
+        return sys.getsizeof(turn["content"]) + 64
+
+    def get(self, user_id: int, limit: int) -> list | None:
+        entry = self._users.get(user_id)
+        if entry is None or limit > self.window:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry.last_used = time.monotonic()
+        self._users.move_to_end(user_id)
+        turns = list(entry.turns)
+        return turns[-limit:] if limit < len(turns) else turns
+
+    def begin_load(self, user_id: int):
+        self._loading[user_id] = False
+
+    def abort_load(self, user_id: int):
+        self._loading.pop(user_id, None)
+
+    def end_load(self, user_id: int, turns: list):
+        """מאכלס אחרי החטאה, אלא אם נכתבה הודעה בזמן הטעינה (אז הטעינה כבר לא עדכנית)"""
+        if self._loading.pop(user_id, True) or user_id in self._users:
+            return
+        window = deque((dict(t) for t in turns[-self.window:]), maxlen=self.window)
+        entry = _Window(window, sum(self._cost(t) for t in window))
+        self._users[user_id] = entry
+        self._bytes += entry.size
+        self._evict()
+
+    def append(self, user_id: int, role: str, content: str):
+        if user_id in self._loading:
+            self._loading[user_id] = True
+        entry = self._users.get(user_id)
+        if entry is None:
+            return
+        turn = {"role": role, "content": content}
+        if len(entry.turns) == entry.turns.maxlen:
+            dropped = self._cost(entry.turns[0])
+            entry.size -= dropped
+            self._bytes -= dropped
+        entry.turns.append(turn)
+        cost = self._cost(turn)
+        entry.size += cost
+        self._bytes += cost
+        entry.last_used = time.monotonic()
+        self._users.move_to_end(user_id)
+        self._evict()
+
+    def invalidate(self, user_id: int | None = None):
+        if user_id is None:
+            self._users.clear()
+            self._bytes = 0
+            for uid in self._loading:
+                self._loading[uid] = True
+            return
+        if user_id in self._loading:
+            self._loading[user_id] = True
+        entry = self._users.pop(user_id, None)
+        if entry:
+            self._bytes -= entry.size
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._users:
+            _, entry = self._users.popitem(last=False)
+            self._bytes -= entry.size
+            self.evictions += 1
+        now = time.monotonic()
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        # ה-OrderedDict ממוין לפי שימוש אחרון, כך שהסריקה נעצרת במשתמש הפעיל הראשון
+        while self._users:
+            uid, entry = next(iter(self._users.items()))
+            if now - entry.last_used < self.idle_sec:
+                break
+            del self._users[uid]
+            self._bytes -= entry.size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "users": len(self._users), "bytes": self._bytes,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+history_cache = HistoryCache(
+    window=HISTORY_CACHE_WINDOW,
+    max_bytes=HISTORY_CACHE_MB * 1024 * 1024,
+    idle_sec=HISTORY_CACHE_IDLE_SEC,
+)
+
 async def init_db():
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute("""CREATE TABLE IF NOT EXISTS history (
+    await db.open()
+    async with db.transaction() as conn:
+        async with conn.execute("PRAGMA auto_vacuum") as cur:
+            if (await cur.fetchone())[0] != 2:
+                logger.info("Database is not in incremental auto_vacuum mode; run /vacuum once to convert it")
+        await conn.execute("""CREATE TABLE IF NOT EXISTS history (
             user_id INTEGER, role TEXT, content TEXT, timestamp INTEGER
         )""")
-        await db.execute("""CREATE TABLE IF NOT EXISTS bans (
+        await conn.execute("""CREATE TABLE IF NOT EXISTS bans (
             user_id INTEGER PRIMARY KEY
         )""")
-        await db.execute("""CREATE TABLE IF NOT EXISTS reminders (
+        await conn.execute("""CREATE TABLE IF NOT EXISTS reminders (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER, remind_at INTEGER, text TEXT, created_at INTEGER
         )""")
-        await db.execute("""CREATE TABLE IF NOT EXISTS notes (
+        await conn.execute("""CREATE TABLE IF NOT EXISTS notes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER, title TEXT, content TEXT, created_at INTEGER
         )""")
-        await db.execute("""CREATE TABLE IF NOT EXISTS user_memory (
-            user_id INTEGER PRIMARY KEY,
-            facts TEXT DEFAULT '{}',
-            updated_at INTEGER
+        await conn.execute("""CREATE TABLE IF NOT EXISTS user_facts (
+            user_id INTEGER, key TEXT, value TEXT, updated_at INTEGER,
+            PRIMARY KEY (user_id, key)
+        ) WITHOUT ROWID""")
+        async with conn.execute("SELECT 1 FROM sqlite_master WHERE name='user_memory'") as cur:
+            legacy_memory = await cur.fetchone() is not None
+        if legacy_memory:
+            # מעבר חד-פעמי מ-JSON blob לשורה לכל עובדה
+            await conn.execute("""INSERT OR IGNORE INTO user_facts (user_id, key, value, updated_at)
+                SELECT m.user_id, j.key, j.value, m.updated_at FROM user_memory m, json_each(m.facts) j""")
+            await conn.execute("DROP TABLE user_memory")
+        await conn.execute("""CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT, status TEXT, total INTEGER,
+            sent INTEGER DEFAULT 0, failed INTEGER DEFAULT 0, cursor INTEGER DEFAULT 0,
+            chat_id INTEGER, message_id INTEGER, created_at INTEGER, finished_at INTEGER
+        )""")
+        await conn.execute("""CREATE TABLE IF NOT EXISTS search_cache (
+            query_key TEXT PRIMARY KEY,
+            snippets TEXT, summary TEXT, created_at INTEGER
+        )""")
+        await conn.execute("""CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT UNIQUE, prompt TEXT, variant TEXT, seed INTEGER, size INTEGER,
+            path TEXT, bytes INTEGER, created_at INTEGER, last_used INTEGER
+        )""")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_images_lru ON images(last_used) WHERE path IS NOT NULL")
+        await conn.execute("""CREATE TABLE IF NOT EXISTS tts_cache (
+            key TEXT PRIMARY KEY,
+            path TEXT, bytes INTEGER, file_id TEXT, last_used INTEGER
+        )""")
+        await conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+        await conn.execute("""CREATE TABLE IF NOT EXISTS rate_limits (
+            user_id INTEGER, kind TEXT, window_sec INTEGER,
+            start INTEGER, prev INTEGER, curr INTEGER,
+            PRIMARY KEY (user_id, kind)
+        )""")
+        await conn.execute("""CREATE TABLE IF NOT EXISTS digest_prefs (
+            user_id INTEGER PRIMARY KEY, tz TEXT, hour INTEGER, minute INTEGER, enabled INTEGER DEFAULT 1
         )""")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_user_time ON history(user_id, timestamp)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_reminders ON reminders(remind_at)")
-        await db.execute("PRAGMA journal_mode=WAL")
-        await db.commit()
+        await init_notes_fts(conn)
+        await init_counters(conn)
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_time ON history(user_id, timestamp)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_reminders ON reminders(remind_at)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_notes_user ON notes(user_id, created_at)")
     logger.info("Database initialized")
 
 async def load_bans():
-    async with aiosqlite.connect(DB_FILE) as db:
-        async with db.execute("SELECT user_id FROM bans") as cursor:
-            for row in await cursor.fetchall():
-                banned.add(row[0])
+    for row in await db.fetchall("SELECT user_id FROM bans"):
+        banned.add(row[0])
 
 async def save_message(user_id: int, role: str, content: str):
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute("INSERT INTO history VALUES (?, ?, ?, ?)",
-            (user_id, role, content, int(time.time())))
-        await db.commit()
+    write_behind.add_message(user_id, role, content)
+    history_cache.append(user_id, role, content)
+    recall_memory.append(user_id, role, content)
 
 async def get_history(user_id: int, limit: int = 20):
-    async with aiosqlite.connect(DB_FILE) as db:
-        async with db.execute(
-            "SELECT role, content FROM history WHERE user_id=? ORDER BY timestamp DESC LIMIT ?",
-            (user_id, limit)
-        ) as cursor:
-            rows = await cursor.fetchall()
-            return [{"role": r[0], "content": r[1]} for r in reversed(rows)]
+    cached = history_cache.get(user_id, limit)
+    if cached is not None:
+        return cached
+    fetch = max(limit, history_cache.window)
+    history_cache.begin_load(user_id)
+    try:
+        async with write_behind.consistent_read():
+            rows = await db.fetchall(
+                "SELECT role, content FROM history WHERE user_id=? ORDER BY timestamp DESC, rowid DESC LIMIT ?",
+                (user_id, fetch)
+            )
+            pending = write_behind.pending_history(user_id)
+    except BaseException:
+        history_cache.abort_load(user_id)
+        raise
+    merged = [{"role": r[0], "content": r[1]} for r in reversed(rows)]
+    merged += [{"role": r[1], "content": r[2]} for r in pending]
+    merged = merged[-fetch:]
+    history_cache.end_load(user_id, merged)
+    return merged[-limit:]
+
+class RetentionEngine:
+    """מחיקת היסטוריה ישנה באצוות קטנות לפי טווחי rowid, עם הפסקה בין אצווה לאצווה כדי שכתיבות
+    השיחה לא ייתקעו מאחורי נעילה ארוכה. אופציונלית מעביר קודם לארכיון JSONL דחוס לפי תאריך,
+    ובסוף מחזיר את הדפים הפנויים לדיסק ב-incremental_vacuum"""
+
+    def __init__(self, database: Database, batch_rows: int = 500, pause_ms: int = 50,
+                 archive_dir: str = "", vacuum_pages: int = 512):
+        self.db = database
+        self.batch_rows = batch_rows
+        self.pause = pause_ms / 1000
+        self.archive_dir = archive_dir
+        self.vacuum_pages = vacuum_pages
+        self.last_run: dict = {}
+
+    def _archive(self, rows: list[tuple]):
+        """שורות לפי יום -> archive_dir/YYYY-MM-DD.jsonl.gz (הוספה כ-gzip member נוסף)"""
+        by_day: dict[str, list[str]] = {}
+        for _, user_id, role, content, ts in rows:
+            day = datetime.fromtimestamp(ts).strftime("%Y-%m-%d")
+            by_day.setdefault(day, []).append(json.dumps(
+                {"user_id": user_id, "role": role, "content": content, "timestamp": ts}, ensure_ascii=False
+            ))
+        os.makedirs(self.archive_dir, exist_ok=True)
+        for day, lines in by_day.items():
+            with gzip.open(os.path.join(self.archive_dir, f"{day}.jsonl.gz"), "at", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+
+    async def run(self, cutoff: int) -> int:
+        started = time.perf_counter()
+        lo = await self.db.fetchval("SELECT MIN(rowid) FROM history")
+        deleted = batches = 0
+        timings = []
+        while lo is not None:
+            hi = lo + self.batch_rows
+            t0 = time.perf_counter()
+            rows = await self.db.fetchall(
+                "SELECT rowid, user_id, role, content, timestamp FROM history "
+                "WHERE rowid >= ? AND rowid < ? AND timestamp < ?", (lo, hi, cutoff)
+            )
+            if not rows:
+                # rowid עולה עם הזמן: חלון בלי שורות שפג תוקפן = הגענו להיסטוריה העדכנית
+                if await self.db.fetchval("SELECT 1 FROM history WHERE rowid >= ? AND rowid < ? LIMIT 1", (lo, hi)):
+                    break
+                lo = await self.db.fetchval("SELECT MIN(rowid) FROM history WHERE rowid >= ?", (hi,))
+                continue
+            t1 = time.perf_counter()
+            if self.archive_dir:
+                await asyncio.to_thread(self._archive, rows)
+            t2 = time.perf_counter()
+            deleted += await self.db.execute(
+                "DELETE FROM history WHERE rowid >= ? AND rowid < ? AND timestamp < ?", (lo, hi, cutoff)
+            )
+            t3 = time.perf_counter()
+            batches += 1
+            timings.append((t3 - t0) * 1000)
+            logger.debug(f"Retention batch {batches}: {len(rows)} rows, select {(t1 - t0) * 1000:.1f}ms, "
+                         f"archive {(t2 - t1) * 1000:.1f}ms, delete {(t3 - t2) * 1000:.1f}ms")
+            lo = hi
+            await asyncio.sleep(self.pause)
+        timings.sort()
+        self.last_run = {
+            "deleted": deleted, "batches": batches,
+            "p50_ms": timings[len(timings) // 2] if timings else 0.0,
+            "max_ms": timings[-1] if timings else 0.0,
+            "total_sec": time.perf_counter() - started,
+        }
+        if deleted:
+            logger.info(f"Retention: deleted {deleted} messages in {batches} batches "
+                        f"(p50 {self.last_run['p50_ms']:.1f}ms, max {self.last_run['max_ms']:.1f}ms per batch)")
+            self.last_run["reclaimed_pages"] = await self.reclaim()
+        return deleted
+
+    async def reclaim(self) -> int:
+        """incremental_vacuum בצעדים קטנים עד שאין דפים פנויים"""
+        reclaimed = 0
+        while True:
+            async with self.db.transaction() as conn:
+                async with conn.execute("PRAGMA freelist_count") as cur:
+                    free = (await cur.fetchone())[0]
+                if not free:
+                    break
+                # execute() מקדם את הפרגמה צעד אחד (דף אחד); executescript מריץ אותה עד הסוף
+                await conn.executescript(f"PRAGMA incremental_vacuum({self.vacuum_pages})")
+                async with conn.execute("PRAGMA freelist_count") as cur:
+                    left = (await cur.fetchone())[0]
+            if left >= free:
+                break  # auto_vacuum לא פעיל - אין מה לשחרר בצעדים
+            reclaimed += free - left
+            await asyncio.sleep(self.pause)
+        if reclaimed:
+            logger.info(f"Retention: reclaimed {reclaimed} free pages")
+        return reclaimed
+
+    async def enable_incremental(self) -> dict:
+        """המרה חד-פעמית ל-auto_vacuum=INCREMENTAL: דורשת VACUUM מלא שחוסם כתיבות וצריך עד פי 2
+        מגודל ה-DB בדיסק, לכן רצה רק לפי בקשה מפורשת של מנהל"""
+        async with self.db.transaction() as conn:
+            async with conn.execute("PRAGMA auto_vacuum") as cur:
+                if (await cur.fetchone())[0] == 2:
+                    return {"converted": False}
+            size = os.path.getsize(self.db.path)
+            free = shutil.disk_usage(os.path.dirname(os.path.abspath(self.db.path))).free
+            if free < size * 2:
+                raise RuntimeError(f"not enough disk for VACUUM: {free // 2**20}MB free, need {size * 2 // 2**20}MB")
+            started = time.perf_counter()
+            await conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await conn.execute("VACUUM")
+        result = {"converted": True, "sec": time.perf_counter() - started,
+                  "before_mb": size / 2**20, "after_mb": os.path.getsize(self.db.path) / 2**20}
+        logger.info(f"Database switched to incremental auto_vacuum in {result['sec']:.1f}s "
+                    f"({result['before_mb']:.0f}MB -> {result['after_mb']:.0f}MB)")
+        return result
+
+retention = RetentionEngine(db, RETENTION_BATCH_ROWS, RETENTION_PAUSE_MS, HISTORY_ARCHIVE_DIR, VACUUM_STEP_PAGES)
 
 async def cleanup_old_history():
     cutoff = int((datetime.now() - timedelta(days=MAX_HISTORY_DAYS)).timestamp())
-    async with aiosqlite.connect(DB_FILE) as db:
-        result = await db.execute("DELETE FROM history WHERE timestamp < ?", (cutoff,))
-        await db.commit()
-        if result.rowcount > 0:
-            logger.info(f"Cleaned {result.rowcount} old messages")
-
-async def backup_before_wipe():
-    os.makedirs("backups", exist_ok=True)
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
-        await db.commit()
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    path = f"backups/bot_backup_{ts}.db"
-    await asyncio.to_thread(shutil.copy, DB_FILE, path)
-    return path
+    if await retention.run(cutoff):
+        history_cache.invalidate()
+        recall_memory.forget()
+
+# ====================== COUNTERS ======================
+# ספירות ש-/stats ומסך הסטטוס צריכים, מתוחזקות בטריגרים כך שהקריאה היא חיפוש לפי מפתח ולא COUNT על כל הטבלה.
+# user_id=0 הוא הסיכום הכללי (אין משתמש טלגרם עם מזהה 0)
+GLOBAL_COUNTER = 0
+COUNTED_TABLES = {"history": "messages", "notes": "notes", "reminders": "reminders"}
+
+async def init_counters(conn: aiosqlite.Connection):
+    async with conn.execute("SELECT 1 FROM sqlite_master WHERE name='counters'") as cur:
+        exists = await cur.fetchone() is not None
+    await conn.execute("""CREATE TABLE IF NOT EXISTS counters (
+        user_id INTEGER, name TEXT, value INTEGER,
+        PRIMARY KEY (user_id, name)
+    ) WITHOUT ROWID""")
+    for table, name in COUNTED_TABLES.items():
+        # משתמש חדש בהיסטוריה = users+1; משתמש שכל ההודעות שלו נמחקו = users-1
+        first_row = f"""INSERT INTO counters SELECT {GLOBAL_COUNTER}, 'users', 1 WHERE NOT EXISTS (
+            SELECT 1 FROM counters WHERE user_id=new.user_id AND name='messages' AND value > 0
+        ) ON CONFLICT DO UPDATE SET value=value+1;""" if table == "history" else ""
+        last_row = f"""UPDATE counters SET value=value-1 WHERE user_id={GLOBAL_COUNTER} AND name='users' AND EXISTS (
+            SELECT 1 FROM counters WHERE user_id=old.user_id AND name='messages' AND value=0
+        );""" if table == "history" else ""
+        await conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_count_ai AFTER INSERT ON {table} BEGIN
+            {first_row}
+            INSERT INTO counters VALUES (new.user_id, '{name}', 1) ON CONFLICT DO UPDATE SET value=value+1;
+            INSERT INTO counters VALUES ({GLOBAL_COUNTER}, '{name}', 1) ON CONFLICT DO UPDATE SET value=value+1;
+        END""")
+        await conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_count_ad AFTER DELETE ON {table} BEGIN
+            UPDATE counters SET value=value-1 WHERE name='{name}' AND user_id IN (old.user_id, {GLOBAL_COUNTER});
+            {last_row}
+            DELETE FROM counters WHERE user_id=old.user_id AND name='{name}' AND value <= 0;
+        END""")
+    if not exists:
+        await rebuild_counters(conn)
+
+async def rebuild_counters(conn: aiosqlite.Connection) -> dict:
+    """בנייה מחדש מהטבלאות עצמן (סריקה מלאה). מחזיר את הערכים החדשים"""
+    await conn.execute("DELETE FROM counters")
+    for table, name in COUNTED_TABLES.items():
+        await conn.execute(f"INSERT INTO counters SELECT user_id, '{name}', COUNT(*) FROM {table} GROUP BY user_id")
+        await conn.execute(f"INSERT INTO counters SELECT {GLOBAL_COUNTER}, '{name}', COUNT(*) FROM {table}")
+    await conn.execute(f"""INSERT INTO counters SELECT {GLOBAL_COUNTER}, 'users', COUNT(*) FROM counters
+        WHERE name='messages' AND user_id != {GLOBAL_COUNTER}""")
+    async with conn.execute("SELECT user_id, name, value FROM counters") as cur:
+        return {(uid, name): value for uid, name, value in await cur.fetchall()}
+
+async def get_counters(user_id: int = GLOBAL_COUNTER) -> dict:
+    rows = await db.fetchall("SELECT name, value FROM counters WHERE user_id=?", (user_id,))
+    counts = {name: 0 for name in ("users", *COUNTED_TABLES.values())}
+    counts.update(rows)
+    return counts
+
+async def reconcile_counters() -> int:
+    """משווה את המונים לספירה מלאה ומתקן. הסריקות רצות על חיבור קריאה (snapshot אחד, בלי לחסום את הכותב);
+    נעילת הכתיבה נלקחת רק להחלת ההפרשים, כתוספת יחסית כדי לא לדרוס כתיבות שקרו אחרי ה-snapshot.
+    מחזיר כמה מונים סטו"""
+    expected: dict[tuple[int, str], int] = {}
+    async with db.reader() as conn:
+        await conn.execute("BEGIN")
+        try:
+            async with conn.execute("SELECT user_id, name, value FROM counters") as cur:
+                current = {(uid, name): value for uid, name, value in await cur.fetchall()}
+            for table, name in COUNTED_TABLES.items():
+                async with conn.execute(f"SELECT user_id, COUNT(*) FROM {table} GROUP BY user_id") as cur:
+                    for uid, count in await cur.fetchall():
+                        expected[(uid, name)] = count
+                expected[(GLOBAL_COUNTER, name)] = sum(v for (_, n), v in expected.items() if n == name)
+        finally:
+            await conn.execute("COMMIT")
+    expected[(GLOBAL_COUNTER, "users")] = sum(1 for uid, n in expected if n == "messages" and uid != GLOBAL_COUNTER)
+    diffs = [(uid, name, expected.get((uid, name), 0) - current.get((uid, name), 0))
+             for uid, name in expected.keys() | current.keys()]
+    diffs = [d for d in diffs if d[2]]
+    if diffs:
+        async with db.transaction() as conn:
+            await conn.executemany(
+                "INSERT INTO counters VALUES (?, ?, ?) ON CONFLICT DO UPDATE SET value=value+excluded.value", diffs
+            )
+            await conn.execute(f"DELETE FROM counters WHERE value <= 0 AND user_id != {GLOBAL_COUNTER}")
+        logger.warning(f"Counters reconciled: {len(diffs)} drifted")
+    return len(diffs)
+
+# ====================== BACKUPS ======================
+class _BackupRestart(Exception):
+    pass
+
+class BackupManager:
+    """גיבוי חי דרך ה-backup API של SQLite: N דפים לצעד עם הפסקה קצרה, כך שהבוט ממשיך לכתוב.
+    כל גיבוי נבדק (quick_check) לפני הדחיסה ל-gzip, והסבב שומר את האחרונים + אחד לכל יום"""
+
+    PREFIX = "bot_"
+    SUFFIX = ".db.gz"
+    MAX_RESTARTS = 3  # כתיבה מחיבור אחר מתחילה את הגיבוי מחדש; אחרי כמה פעמים - צעד אחד לכל השאר
+
+    def __init__(self, database: Database, directory: str, step_pages: int = 256, pause_ms: int = 5,
+                 keep_hourly: int = 24, keep_daily: int = 7, keep_other: int = 10):
+        self.db = database
+        self.dir = directory
+        self.step_pages = step_pages
+        self.pause = pause_ms / 1000
+        self.keep_hourly = keep_hourly
+        self.keep_daily = keep_daily
+        self.keep_other = keep_other
+        self._lock = asyncio.Lock()
+        self.last: dict = {}
+
+    def _path(self, kind: str, stamp: datetime) -> str:
+        return os.path.join(self.dir, f"{self.PREFIX}{stamp.strftime('%Y%m%d_%H%M%S')}_{kind}{self.SUFFIX}")
+
+    @staticmethod
+    def _check(path: str) -> str:
+        conn = sqlite3.connect(path)
+        try:
+            return conn.execute("PRAGMA quick_check").fetchone()[0]
+        finally:
+            conn.close()
+
+    def _copy(self, target: str) -> dict:
+        """רץ ב-thread: backup מדורג לקובץ זמני, בדיקה, ודחיסה"""
+        raw = target[:-len(".gz")]
+        stats = {"steps": 0, "restarts": 0, "pages": 0}
+        remaining_before = None
+
+        def progress(status, remaining, total):
+            nonlocal remaining_before
+            stats["steps"] += 1
+            stats["pages"] = total
+            if remaining_before is not None and remaining > remaining_before:
+                stats["restarts"] += 1
+                if stats["restarts"] >= self.MAX_RESTARTS:
+                    raise _BackupRestart
+            remaining_before = remaining
+
+        src = sqlite3.connect(self.db.path, timeout=30)
+        dst = sqlite3.connect(raw)
+        try:
+            try:
+                src.backup(dst, pages=self.step_pages, progress=progress, sleep=self.pause)
+            except _BackupRestart:
+                # צעד יחיד = טרנזקציית קריאה אחת; ב-WAL זה לא חוסם את הכותב
+                src.backup(dst, pages=-1)
+        finally:
+            dst.close()
+            src.close()
+        try:
+            result = self._check(raw)
+            if result != "ok":
+                raise RuntimeError(f"backup failed quick_check: {result}")
+            with open(raw, "rb") as f_in, gzip.open(target + ".part", "wb", compresslevel=6) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            os.replace(target + ".part", target)
+            stats["raw_bytes"] = os.path.getsize(raw)
+        finally:
+            os.remove(raw)
+        stats["bytes"] = os.path.getsize(target)
+        return stats
+
+    async def create(self, kind: str = "hourly") -> str:
+        async with self._lock:
+            os.makedirs(self.dir, exist_ok=True)
+            path = self._path(kind, datetime.now())
+            started = time.perf_counter()
+            stats = await asyncio.to_thread(self._copy, path)
+            stats["sec"] = time.perf_counter() - started
+            self.last = {"path": path, "kind": kind, **stats}
+            logger.info(
+                f"Backup {os.path.basename(path)}: {stats['pages']} pages in {stats['steps']} steps "
+                f"({stats['restarts']} restarts), {stats['raw_bytes'] // 1024}KB -> {stats['bytes'] // 1024}KB, "
+                f"{stats['sec']:.1f}s"
+            )
+            await asyncio.to_thread(self.rotate)
+            return path
+
+    def list(self) -> list[str]:
+        """שמות הגיבויים, מהחדש לישן"""
+        if not os.path.isdir(self.dir):
+            return []
+        names = [n for n in os.listdir(self.dir) if n.startswith(self.PREFIX) and n.endswith(self.SUFFIX)]
+        return sorted(names, reverse=True)
+
+    def rotate(self) -> int:
+        """שומר את keep_hourly המתוזמנים האחרונים ועוד את האחרון בכל אחד מ-keep_daily הימים,
+        ומכל סוג אחר (ידני, לפני מחיקה, לפני שחזור) את keep_other האחרונים"""
+        keep, days, removed = 0, set(), 0
+        others: dict[str, int] = {}
+        for name in self.list():
+            stamp, kind = name[len(self.PREFIX):-len(self.SUFFIX)].rsplit("_", 1)
+            if kind != "hourly":
+                others[kind] = others.get(kind, 0) + 1
+                if others[kind] > self.keep_other:
+                    os.remove(os.path.join(self.dir, name))
+                    removed += 1
+                continue
+            day = stamp[:8]
+            if keep < self.keep_hourly:
+                keep += 1
+                days.add(day)
+            elif day not in days and len(days) < self.keep_daily:
+                days.add(day)
+            else:
+                os.remove(os.path.join(self.dir, name))
+                removed += 1
+        return removed
+
+    def _unpack(self, name: str) -> str:
+        """פריסה לקובץ זמני + quick_check; זורק אם הגיבוי פגום"""
+        if os.path.basename(name) != name or name not in self.list():
+            raise FileNotFoundError(name)
+        raw = os.path.join(self.dir, f".restore_{name[:-len('.gz')]}")
+        with gzip.open(os.path.join(self.dir, name), "rb") as f_in, open(raw, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        result = self._check(raw)
+        if result != "ok":
+            os.remove(raw)
+            raise RuntimeError(f"backup failed quick_check: {result}")
+        return raw
+
+    async def verify(self, name: str) -> dict:
+        """פריסה ובדיקה בלי לגעת ב-DB החי; מחזיר ספירת שורות לטבלאות העיקריות"""
+        raw = await asyncio.to_thread(self._unpack, name)
+        try:
+            conn = sqlite3.connect(raw)
+            try:
+                return {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+                        for t in ("history", "notes", "reminders", "user_facts")}
+            finally:
+                conn.close()
+        finally:
+            os.remove(raw)
+
+    async def restore(self, name: str) -> str:
+        """שחזור מאומת: בודק את הגיבוי, מגבה את המצב הנוכחי, ואז מעתיק לתוך ה-DB החי
+        תחת נעילת הכתיבה. את המטמונים שבזיכרון מאפס הקורא"""
+        raw = await asyncio.to_thread(self._unpack, name)
+        try:
+            safety = await self.create("prerestore")
+            await write_behind.flush()
+            async with self._lock, self.db.transaction():
+                def copy_in():
+                    src, dst = sqlite3.connect(raw), sqlite3.connect(self.db.path, timeout=30)
+                    try:
+                        src.backup(dst, pages=-1)
+                    finally:
+                        dst.close()
+                        src.close()
+                await asyncio.to_thread(copy_in)
+        finally:
+            os.remove(raw)
+        logger.warning(f"Database restored from {name} (previous state saved to {os.path.basename(safety)})")
+        return safety
+
+    def stats(self) -> dict:
+        return {"count": len(self.list()), **self.last}
+
+backups = BackupManager(db, BACKUP_DIR, BACKUP_STEP_PAGES, BACKUP_STEP_PAUSE_MS,
+                        BACKUP_KEEP_HOURLY, BACKUP_KEEP_DAILY, BACKUP_KEEP_OTHER)
 
 # ====================== USER MEMORY ======================
-async def get_user_facts(user_id: int) -> dict:
-    async with aiosqlite.connect(DB_FILE) as db:
-        async with db.execute("SELECT facts FROM user_memory WHERE user_id=?", (user_id,)) as c:
-            row = await c.fetchone()
-            return json.loads(row[0]) if row else {}
-
-async def save_user_facts(user_id: int, facts: dict):
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute(
-            "INSERT OR REPLACE INTO user_memory (user_id, facts, updated_at) VALUES (?, ?, ?)",
-            (user_id, json.dumps(facts, ensure_ascii=False), int(time.time()))
+FACT_PATTERNS = [
+    ("מיקום", r"אני גר ב(.+?)(?:\.|$)"),
+    ("עבודה", r"אני עובד ב(.+?)(?:\.|$)"),
+    ("שם", r"שמי הוא (.+?)(?:\.|$)"),
+    ("גיל", r"אני בן (\d+)"),
+    ("טלפון", r"הטלפון שלי (.+?)(?:\.|$)"),
+]
+
+class _Profile:
+    __slots__ = ("facts", "rendered")
+
+    def __init__(self, facts: dict):
+        self.facts = facts
+        self.rendered = "\n".join(f"- {k}: {v}" for k, v in facts.items()) if facts else "אין עדיין"
+
+class ProfileStore:
+    """עובדות על המשתמש: LRU של פרופילים מפוענחים עם בלוק facts_str מוכן לפרומפט.
+    כל התבניות מהודרות לביטוי אחד, ועובדה נכתבת (כשורה משלה ב-user_facts) רק כשהערך השתנה"""
+
+    # כל תבנית בתוך lookahead, כדי שהתאמה אחת לא "תבלע" את הבאה (כמו search נפרד לכל תבנית)
+    MATCHER = re.compile(
+        "|".join(f"(?=(?:{pattern.replace('(', f'(?P<f{i}>', 1)}))" for i, (_, pattern) in enumerate(FACT_PATTERNS)),
+        re.IGNORECASE
+    )
+    KEYS = {f"f{i}": key for i, (key, _) in enumerate(FACT_PATTERNS)}
+
+    def __init__(self, max_users: int = 5000):
+        self.max_users = max_users
+        self._profiles: OrderedDict[int, _Profile] = OrderedDict()
+        self._locks: dict[int, asyncio.Lock] = {}
+        self.hits = self.misses = self.writes = self.unchanged = 0
+
+    @classmethod
+    def extract(cls, text: str) -> dict:
+        found = {}
+        for m in cls.MATCHER.finditer(text):
+            group = m.lastgroup
+            key = cls.KEYS[group]
+            if key not in found:
+                found[key] = m.group(group).strip()
+        return found
+
+    async def _load(self, user_id: int) -> _Profile:
+        profile = self._profiles.get(user_id)
+        if profile is not None:
+            self.hits += 1
+            self._profiles.move_to_end(user_id)
+            return profile
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            profile = self._profiles.get(user_id)
+            if profile is None:
+                self.misses += 1
+                async with write_behind.consistent_read():
+                    rows = await db.fetchall(
+                        "SELECT key, value FROM user_facts WHERE user_id=? ORDER BY updated_at, key", (user_id,)
+                    )
+                    facts = {k: v for k, v in rows} | write_behind.pending_facts(user_id)
+                profile = self._profiles[user_id] = _Profile(facts)
+                while len(self._profiles) > self.max_users:
+                    self._profiles.popitem(last=False)
+            self._locks.pop(user_id, None)
+            return profile
+
+    async def get(self, user_id: int) -> dict:
+        return dict((await self._load(user_id)).facts)
+
+    async def facts_str(self, user_id: int) -> str:
+        return (await self._load(user_id)).rendered
+
+    async def observe(self, user_id: int, text: str):
+        """חלץ עובדות מהשיחה ושמור בזיכרון"""
+        found = self.extract(text)
+        if not found:
+            return
+        profile = await self._load(user_id)
+        changed = {k: v for k, v in found.items() if profile.facts.get(k) != v}
+        self.unchanged += len(found) - len(changed)
+        if not changed:
+            return
+        for key, value in changed.items():
+            write_behind.set_fact(user_id, key, value)
+        self.writes += len(changed)
+        self._profiles[user_id] = _Profile({**profile.facts, **changed})
+
+    def forget(self, user_id: int | None = None):
+        if user_id is None:
+            self._profiles.clear()
+        else:
+            self._profiles.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {"users": len(self._profiles), "hits": self.hits, "misses": self.misses,
+                "writes": self.writes, "unchanged": self.unchanged}
+
+profiles = ProfileStore(PROFILE_CACHE_USERS)
+
+# ====================== RECALL MEMORY ======================
+_NIQQUD = re.compile(r"[֑-ׇ]")
+_NON_WORD = re.compile(r"[^\w]+")
+
+np = None  # numpy נטען רק כשנבנה זיכרון ארוך ראשון, כמו לקוחות ה-API - לא מעכב את העלייה
+
+def load_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+    return np
+
+class _UserRecall:
+    __slots__ = ("vecs", "df", "turns", "count", "text_bytes", "size", "last_used")
+
+    def __init__(self, dim: int):
+        load_numpy()  # כל שימוש ב-np עובר דרך רשומה כזו (בנייה, הוספה, חיפוש)
+        self.vecs = np.zeros((0, dim), dtype=np.float32)
+        self.df = np.zeros(dim, dtype=np.float32)
+        self.turns: list[tuple[str, str]] = []
+        self.count = 0
+        self.text_bytes = 0
+        self.size = 0
+        self.last_used = time.monotonic()
+
+class RecallMemory:
+    """זיכרון ארוך-טווח מקומי: כל תור בהיסטוריה הופך לווקטור trigram-תווים מגובב (hashing trick)
+    בתוך מטריצת float32 לכל משתמש. בשאלה חדשה מחזירים את התורות הישנות הדומות ביותר (קוסינוס משוקלל IDF).
+    נבנה מה-DB בשימוש הראשון ומתעדכן מ-save_message; LRU לפי זיכרון"""
+
+    BATCH = 4096
+    TEXT_CAP = 2000
+
+    def __init__(self, dim: int = 128, max_mb: int = 256, min_score: float = 0.2):
+        self.dim = dim
+        self.max_bytes = max_mb * 1024 * 1024
+        self.min_score = min_score
+        self._users: OrderedDict[int, _UserRecall] = OrderedDict()
+        self._loading: dict[int, list] = {}
+        self._stale: set[int] = set()
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._bytes = 0
+        self.searches = self.search_ms = 0.0
+
+    @staticmethod
+    def _normalize(text: str) -> str:
+        return " " + _NON_WORD.sub(" ", _NIQQUD.sub("", text.lower())).strip() + " "
+
+    def vectorize(self, texts: list[str]) -> "np.ndarray":
+        """מטריצת (n, dim): log-tf חתום של trigrams מגובבים, מנורמל L2. מחושב בבת אחת ב-NumPy"""
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for start in range(0, len(texts), self.BATCH):
+            batch = texts[start:start + self.BATCH]
+            joined = "\0".join(self._normalize(t[:self.TEXT_CAP]) for t in batch)
+            codes = np.frombuffer(joined.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+            if len(codes) < 3:
+                continue
+            a, b, c = codes[:-2], codes[1:-1], codes[2:]
+            valid = (a != 0) & (b != 0) & (c != 0)
+            doc = np.cumsum(codes == 0)[:-2][valid]
+            h = ((a[valid] << np.uint64(42)) ^ (b[valid] << np.uint64(21)) ^ c[valid]) * np.uint64(0x9E3779B97F4A7C15)
+            bucket = (h >> np.uint64(40)) % np.uint64(self.dim)
+            sign = np.where((h >> np.uint64(39)) & np.uint64(1), 1.0, -1.0)
+            counts = np.bincount(
+                doc * self.dim + bucket.astype(np.int64), weights=sign, minlength=len(batch) * self.dim
+            ).reshape(len(batch), self.dim)
+            block = np.sign(counts) * np.log1p(np.abs(counts))
+            norms = np.linalg.norm(block, axis=1, keepdims=True)
+            out[start:start + len(batch)] = block / np.where(norms == 0, 1, norms)
+        return out
+
+    @staticmethod
+    def _cost(entry: _UserRecall) -> int:
+        return entry.vecs.nbytes + entry.df.nbytes + entry.text_bytes
+
+    def _add(self, entry: _UserRecall, turns: list[tuple[str, str]]):
+        vecs = self.vectorize([c for _, c in turns])
+        need = entry.count + len(turns)
+        if need > len(entry.vecs):
+            # גדילה כפולה - הוספה בודדת היא O(1) בממוצע
+            grown = np.zeros((max(need, 2 * len(entry.vecs), 64), self.dim), dtype=np.float32)
+            grown[:entry.count] = entry.vecs[:entry.count]
+            entry.vecs = grown
+        entry.vecs[entry.count:need] = vecs
+        entry.df += (vecs != 0).sum(axis=0)
+        entry.turns.extend(turns)
+        entry.text_bytes += sum(sys.getsizeof(c) + 64 for _, c in turns)
+        entry.count = need
+
+    def _store(self, user_id: int, entry: _UserRecall):
+        old = self._users.get(user_id)
+        if old is not None:
+            self._bytes -= old.size
+        entry.size = self._cost(entry)
+        entry.last_used = time.monotonic()
+        self._users[user_id] = entry
+        self._users.move_to_end(user_id)
+        self._bytes += entry.size
+        while self._bytes > self.max_bytes and len(self._users) > 1:
+            _, evicted = self._users.popitem(last=False)
+            self._bytes -= evicted.size
+
+    def append(self, user_id: int, role: str, content: str):
+        if user_id in self._loading:
+            self._loading[user_id].append((role, content))
+            return
+        entry = self._users.get(user_id)
+        if entry is not None:
+            self._add(entry, [(role, content)])
+            self._store(user_id, entry)
+
+    async def _ensure(self, user_id: int) -> _UserRecall:
+        entry = self._users.get(user_id)
+        if entry is not None:
+            return entry
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            entry = self._users.get(user_id)
+            if entry is not None:
+                return entry
+            try:
+                async with write_behind.consistent_read():
+                    rows = await db.fetchall(
+                        "SELECT role, content FROM history WHERE user_id=? ORDER BY timestamp, rowid", (user_id,)
+                    )
+                    rows += [(r[1], r[2]) for r in write_behind.pending_history(user_id)]
+                    # מכאן הודעות חדשות נאספות בצד ומתווספות אחרי הבנייה
+                    self._loading[user_id] = []
+                entry = _UserRecall(self.dim)
+                if rows:
+                    await asyncio.to_thread(self._add, entry, rows)
+                late = self._loading.pop(user_id, [])
+                if late:
+                    self._add(entry, late)
+                if user_id not in self._stale:
+                    self._store(user_id, entry)
+                return entry
+            finally:
+                self._loading.pop(user_id, None)
+                self._stale.discard(user_id)
+                self._locks.pop(user_id, None)
+
+    async def search(self, user_id: int, query: str, k: int = 4, exclude_recent: int = 0) -> list[dict]:
+        """k התורות הדומות ביותר מתוך ההיסטוריה, בלי exclude_recent האחרונות (שכבר בפרומפט)"""
+        entry = await self._ensure(user_id)
+        started = time.perf_counter()
+        eligible = entry.count - exclude_recent
+        if eligible <= 0 or not query.strip():
+            return []
+        idf = np.log((1 + entry.count) / (1 + entry.df)) + 1
+        q = self.vectorize([query])[0] * idf
+        norm = np.linalg.norm(q)
+        if not norm:
+            return []
+        scores = entry.vecs[:eligible] @ (q / norm)
+        top = np.argpartition(-scores, min(k, eligible - 1))[:k] if eligible > k else np.arange(eligible)
+        top = top[np.argsort(-scores[top])]
+        entry.last_used = time.monotonic()
+        self._users.move_to_end(user_id)
+        self.searches += 1
+        self.search_ms += (time.perf_counter() - started) * 1000
+        return [{"role": entry.turns[i][0], "content": entry.turns[i][1], "score": float(scores[i])}
+                for i in top if scores[i] >= self.min_score]
+
+    def forget(self, user_id: int | None = None):
+        # טעינה שבדרך קראה נתונים מלפני המחיקה - לא נשמור אותה
+        self._stale.update(self._loading if user_id is None else {user_id} & self._loading.keys())
+        if user_id is None:
+            self._users.clear()
+            self._bytes = 0
+        elif user_id in self._users:
+            self._bytes -= self._users.pop(user_id).size
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._users), "turns": sum(e.count for e in self._users.values()),
+            "mb": self._bytes / 1024 / 1024,
+            "avg_ms": self.search_ms / self.searches if self.searches else 0.0,
+        }
+
+recall_memory = RecallMemory(RECALL_DIM, RECALL_CACHE_MB, RECALL_MIN_SCORE)
+
+# ====================== NOTES SEARCH ======================
+NOTES_FTS = True
+FIND_PAGE_SIZE = 5
+
+async def init_notes_fts(conn: aiosqlite.Connection):
+    """notes_fts: אינדקס FTS5 עם tokenizer trigram (עובד גם בעברית, בלי תלות בניקוד/תחיליות)
+    שמסונכרן לטבלת notes בטריגרים. בגרסת SQLite בלי trigram נשארים עם LIKE"""
+    global NOTES_FTS
+    async with conn.execute("SELECT 1 FROM sqlite_master WHERE name='notes_fts'") as cur:
+        exists = await cur.fetchone() is not None
+    try:
+        await conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+            title, content, content='notes', content_rowid='id', tokenize='trigram'
+        )""")
+    except aiosqlite.OperationalError as e:
+        NOTES_FTS = False
+        logger.warning(f"FTS5 trigram unavailable, /find falls back to LIKE: {e}")
+        return
+    await conn.execute("""CREATE TRIGGER IF NOT EXISTS notes_fts_ai AFTER INSERT ON notes BEGIN
+        INSERT INTO notes_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""")
+    await conn.execute("""CREATE TRIGGER IF NOT EXISTS notes_fts_ad AFTER DELETE ON notes BEGIN
+        INSERT INTO notes_fts(notes_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+    END""")
+    await conn.execute("""CREATE TRIGGER IF NOT EXISTS notes_fts_au AFTER UPDATE ON notes BEGIN
+        INSERT INTO notes_fts(notes_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO notes_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""")
+    if not exists:
+        # פתקים שנשמרו לפני שהאינדקס נוסף
+        await conn.execute("INSERT INTO notes_fts(notes_fts) VALUES ('rebuild')")
+
+async def search_notes(user_id: int, query: str, limit: int = FIND_PAGE_SIZE,
+                       offset: int = 0) -> tuple[int, list[tuple]]:
+    """חיפוש פתקים: מחזיר (סה"כ תוצאות, [(id, title, snippet)]) מדורג BM25 (כותרת שווה פי 3).
+    trigram לא מתאים למילים של פחות מ-3 תווים, אז הן מסוננות ב-LIKE על התוצאות"""
+    terms = query.split()
+    long_terms = [t for t in terms if len(t) >= 3]
+    short_terms = [t for t in terms if len(t) < 3]
+    like_sql = "".join(" AND (n.title LIKE ? OR n.content LIKE ?)" for _ in short_terms)
+    like_args = [p for t in short_terms for p in (f"%{t}%", f"%{t}%")]
+
+    if NOTES_FTS and long_terms:
+        match = " ".join('"' + t.replace('"', '""') + '"' for t in long_terms)
+        # CROSS JOIN מכריח את SQLite להתחיל מה-FTS; אחרת הוא עלול לסרוק לפי idx_notes_user ולבדוק MATCH לכל פתק
+        where = f"FROM notes_fts CROSS JOIN notes n ON n.id = notes_fts.rowid " \
+                f"WHERE notes_fts MATCH ? AND n.user_id = ?{like_sql}"
+        args = (match, user_id, *like_args)
+        total = await db.fetchval(f"SELECT COUNT(*) {where}", args, 0)
+        rows = await db.fetchall(
+            f"SELECT n.id, n.title, snippet(notes_fts, 1, '**', '**', '…', 40) {where} "
+            f"ORDER BY bm25(notes_fts, 3.0, 1.0) LIMIT ? OFFSET ?",
+            (*args, limit, offset)
         )
-        await db.commit()
-
-async def extract_and_save_facts(user_id: int, text: str):
-    """חלץ עובדות מהשיחה ושמור בזיכרון"""
-    fact_patterns = [
-        (r"אני גר ב(.+?)(?:\.|$)", "מיקום"),
-        (r"אני עובד ב(.+?)(?:\.|$)", "עבודה"),
-        (r"שמי הוא (.+?)(?:\.|$)", "שם"),
-        (r"אני בן (\d+)", "גיל"),
-        (r"הטלפון שלי (.+?)(?:\.|$)", "טלפון"),
-    ]
-    facts = await get_user_facts(user_id)
-    changed = False
-    for pattern, key in fact_patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            facts[key] = match.group(1).strip()
-            changed = True
-    if changed:
-        await save_user_facts(user_id, facts)
+        return total, rows
+
+    if not terms:
+        return 0, []
+    where = "FROM notes n WHERE n.user_id = ?" + "".join(
+        " AND (n.title LIKE ? OR n.content LIKE ?)" for _ in terms
+    )
+    args = (user_id, *(p for t in terms for p in (f"%{t}%", f"%{t}%")))
+    total = await db.fetchval(f"SELECT COUNT(*) {where}", args, 0)
+    rows = await db.fetchall(
+        f"SELECT n.id, n.title, substr(n.content, 1, 60) {where} ORDER BY n.created_at DESC LIMIT ? OFFSET ?",
+        (*args, limit, offset)
+    )
+    return total, rows
 
 # ====================== RATE LIMITING ======================
-def clean_old_timestamps(user_id: int, key: str, seconds: int):
-    now = time.time()
-    rate_limit[user_id][key] = [t for t in rate_limit[user_id][key] if now - t < seconds]
+class _SlidingWindow:
+    __slots__ = ("window", "start", "prev", "curr")
+
+    def __init__(self, window: int, start: int, prev: int = 0, curr: int = 0):
+        self.window = window
+        self.start = start
+        self.prev = prev
+        self.curr = curr
+
+class RateLimiter:
+    """מגביל קצב O(1) לכל (משתמש, סוג): מונה חלון-זז משוקלל (החלון הקודם + הנוכחי),
+    פינוי משתמשים שהחלונות שלהם פגו, ושמירה/שחזור ב-SQLite בין הפעלות"""
+
+    SWEEP_EVERY = 4096
+    SWEEP_INTERVAL = 300
+
+    def __init__(self):
+        self._windows: dict[tuple[int, str], _SlidingWindow] = {}
+        self._checks = 0
+        self._last_sweep = time.monotonic()
+
+    def check(self, user_id: int, key: str, limit: int, window_sec: int, now: float | None = None) -> bool:
+        now = time.time() if now is None else now
+        idx = int(now // window_sec)
+        w = self._windows.get((user_id, key))
+        if w is None:
+            w = self._windows[(user_id, key)] = _SlidingWindow(window_sec, idx)
+        elif idx != w.start:
+            w.prev = w.curr if idx == w.start + 1 else 0
+            w.curr = 0
+            w.start = idx
+        # הערכת מספר הבקשות ב-window_sec האחרונות: חלק יחסי מהחלון הקודם + כל הנוכחי
+        elapsed = now / window_sec - idx
+        allowed = w.prev * (1 - elapsed) + w.curr < limit
+        if allowed:
+            w.curr += 1
+        self._checks += 1
+        if self._checks % self.SWEEP_EVERY == 0 and time.monotonic() - self._last_sweep > self.SWEEP_INTERVAL:
+            self.evict_idle(now)
+        return allowed
+
+    def evict_idle(self, now: float | None = None) -> int:
+        """מוחק רשומות ששני החלונות שלהן פגו - זהות לרשומה חדשה, כך שהמחיקה לא משנה התנהגות"""
+        now = time.time() if now is None else now
+        self._last_sweep = time.monotonic()
+        stale = [k for k, w in self._windows.items() if now // w.window >= w.start + 2]
+        for k in stale:
+            del self._windows[k]
+        return len(stale)
+
+    def clear(self):
+        self._windows.clear()
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+    async def snapshot(self):
+        self.evict_idle()
+        rows = [(uid, key, w.window, w.start, w.prev, w.curr) for (uid, key), w in self._windows.items()]
+        async with db.transaction() as conn:
+            await conn.execute("DELETE FROM rate_limits")
+            await conn.executemany(
+                "INSERT INTO rate_limits (user_id, kind, window_sec, start, prev, curr) VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+
+    async def restore(self):
+        for uid, key, window, start, prev, curr in await db.fetchall(
+            "SELECT user_id, kind, window_sec, start, prev, curr FROM rate_limits"
+        ):
+            self._windows[(uid, key)] = _SlidingWindow(window, start, prev, curr)
+        self.evict_idle()
+        logger.info(f"Rate limiter restored {len(self._windows)} windows")
+
+rate_limiter = RateLimiter()
 
 async def check_rate(user_id: int, key: str, limit: int, window_sec: int) -> bool:
-    clean_old_timestamps(user_id, key, window_sec)
-    if len(rate_limit[user_id][key]) >= limit:
+    return rate_limiter.check(user_id, key, limit, window_sec)
+
+class TokenBucket:
+    """דלי אסימונים גלובלי: rate אסימונים לשנייה, עד burst מצטברים. pause() מכבד retry_after"""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+# ====================== MODEL ROUTER ======================
+class _ModelHealth:
+    __slots__ = ("samples", "failures", "trips", "open_until", "trial", "last_error")
+
+    def __init__(self, window: int):
+        self.samples: deque[tuple[float, bool]] = deque(maxlen=window)  # (שניות, הצליח)
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self.trial = False
+        self.last_error = ""
+
+    def state(self, now: float) -> str:
+        if not self.open_until:
+            return "closed"
+        return "open" if self.open_until > now else "half-open"
+
+    def latency(self) -> float | None:
+        ok = sorted(s for s, good in self.samples if good)
+        return ok[len(ok) // 2] if ok else None
+
+    def error_rate(self) -> float:
+        return sum(1 for _, good in self.samples if not good) / len(self.samples) if self.samples else 0.0
+
+class ModelRouter:
+    """בחירת מודל לכל בקשה לפי חלון מתגלגל של זמני תגובה ושגיאות.
+    לכל מודל מפסק: אחרי כמה כשלונות ברצף (או 429 מיד) הוא נחסם לזמן קירור, ואחריו בקשת ניסיון אחת.
+    בשגיאה זמנית (429/5xx/timeout/חיבור) עוברים מיד למודל הבא בתור; שגיאת בקשה (4xx אחר) נזרקת כמו שהיא"""
+
+    DEFAULT_LATENCY = 1.0
+    RANK_PENALTY = 0.25    # מודל נמוך בסדר העדיפות נבחר רק כשהוא מהיר יותר בבירור
+    ERROR_PENALTY = 3.0
+    MAX_COOLDOWN = 900
+
+    def __init__(self, models: list[str], window: int = 20, fail_threshold: int = 3, cooldown: int = 60):
+        self.models = list(models)
+        self.fail_threshold = fail_threshold
+        self.cooldown = cooldown
+        self._health = {m: _ModelHealth(window) for m in self.models}
+        self.failovers = 0
+
+    def _score(self, model: str) -> float:
+        h = self._health[model]
+        latency = h.latency() or self.DEFAULT_LATENCY
+        return latency * (1 + self.ERROR_PENALTY * h.error_rate()) * (1 + self.RANK_PENALTY * self.models.index(model))
+
+    def ranked(self) -> list[str]:
+        now = time.monotonic()
+        ready = [m for m in self.models
+                 if self._health[m].state(now) == "closed"
+                 or (self._health[m].state(now) == "half-open" and not self._health[m].trial)]
+        if not ready:
+            # כולם חסומים - עדיף לנסות את זה שמשתחרר ראשון מאשר להיכשל בלי לנסות
+            return sorted(self.models, key=lambda m: self._health[m].open_until)
+        return sorted(ready, key=self._score)
+
+    def best(self) -> str:
+        return self.ranked()[0]
+
+    @staticmethod
+    def _retry_after(e: Exception) -> float | None:
+        if getattr(e, "status_code", None) != 429:
+            return None
+        try:
+            return float(e.response.headers.get("retry-after"))
+        except (AttributeError, TypeError, ValueError):
+            return 0.0
+
+    MODEL_GONE = {"model_not_found", "model_decommissioned"}
+
+    @classmethod
+    def _model_gone(cls, e: Exception) -> bool:
+        """המודל הוסר/לא קיים (404, או code מתאים בגוף השגיאה) - תקלה של המודל ולא של הבקשה"""
+        if getattr(e, "status_code", None) == 404:
+            return True
+        body = getattr(e, "body", None)
+        if isinstance(body, dict):
+            body = body.get("error", body)
+        code = getattr(e, "code", None) or (body.get("code") if isinstance(body, dict) else None)
+        return code in cls.MODEL_GONE
+
+    @classmethod
+    def _transient(cls, e: Exception) -> bool:
+        """תקלה של המודל/השירות (429, 5xx, timeout, חיבור, מודל שהוסר) ולא של הבקשה עצמה
+        (400 הקשר ארוך מדי, 401 וכו'). רק תקלה כזאת נספרת במפסק ומצדיקה מעבר למודל אחר"""
+        status = getattr(e, "status_code", None)
+        if status is not None:
+            return status == 429 or status >= 500 or cls._model_gone(e)
+        # APIConnectionError/APITimeoutError של groq נטענים בעצלות, לכן לפי שם
+        return isinstance(e, (asyncio.TimeoutError, TimeoutError, ConnectionError)) \
+            or type(e).__name__ in ("APIConnectionError", "APITimeoutError")
+
+    def _success(self, model: str, elapsed: float):
+        h = self._health[model]
+        h.samples.append((elapsed, True))
+        if h.open_until:
+            logger.info(f"Model {model} recovered")
+        h.failures = h.trips = 0
+        h.open_until = 0.0
+
+    def _failure(self, model: str, e: Exception, elapsed: float):
+        h = self._health[model]
+        h.samples.append((elapsed, False))
+        h.failures += 1
+        h.last_error = type(e).__name__
+        retry_after = self._retry_after(e)
+        gone = self._model_gone(e)
+        if gone or retry_after is not None or h.open_until or h.failures >= self.fail_threshold:
+            h.trips += 1
+            # מודל שהוסר לא יחזור בעוד דקה - חוסמים מיד לזמן המקסימלי
+            cooldown = self.MAX_COOLDOWN if gone else \
+                retry_after or min(self.cooldown * 2 ** (h.trips - 1), self.MAX_COOLDOWN)
+            h.open_until = time.monotonic() + cooldown
+            logger.warning(f"Model {model} breaker open for {cooldown:.0f}s ({h.last_error}: {e})")
+
+    async def create(self, **kwargs):
+        """chat.completions.create עם בחירת מודל ומעבר למודל הבא בשגיאה.
+        עם stream=True המעבר אפשרי רק עד שהזרם נפתח"""
+        last_error = None
+        for model in self.ranked():
+            h = self._health[model]
+            h.trial = h.state(time.monotonic()) == "half-open"
+            started = time.perf_counter()
+            try:
+                resp = await groq_client().chat.completions.create(model=model, **kwargs)
+            except Exception as e:
+                if not self._transient(e):
+                    raise  # אותה בקשה תיכשל גם במודל הבא - לא מענישים את המודל ולא עוברים
+                self._failure(model, e, time.perf_counter() - started)
+                last_error = e
+                self.failovers += 1
+                continue
+            finally:
+                h.trial = False
+            self._success(model, time.perf_counter() - started)
+            return resp
+        raise last_error
+
+    async def probe(self) -> str:
+        """בדיקת כל המודלים במקביל ועדכון המדדים שלהם"""
+        async def check(model: str):
+            started = time.perf_counter()
+            try:
+                resp = await groq_client().chat.completions.create(
+                    model=model, messages=[{"role": "user", "content": "hi"}], max_tokens=5
+                )
+                if not resp.choices:
+                    raise ValueError("empty response")
+            except Exception as e:
+                self._failure(model, e, time.perf_counter() - started)
+                return
+            self._success(model, time.perf_counter() - started)
+
+        await asyncio.gather(*(check(m) for m in self.models))
+        return self.best()
+
+    def export_state(self) -> dict:
+        return {m: {"latency": h.latency(), "ok": h.state(time.monotonic()) == "closed" and h.error_rate() < 1}
+                for m, h in self._health.items() if h.samples}
+
+    def import_state(self, state: dict):
+        """זריעת החלון מהמדידה האחרונה שנשמרה, כדי שאחרי עלייה ייבחר המודל שעבד לאחרונה בלי לחכות לבדיקה"""
+        for m, s in state.items():
+            h = self._health.get(m)
+            if h is not None and not h.samples:
+                h.samples.append((s["latency"] or self.DEFAULT_LATENCY, s["ok"]))
+
+    def stats(self) -> list[dict]:
+        now = time.monotonic()
+        out = []
+        for m in self.models:
+            h = self._health[m]
+            latency = h.latency()
+            out.append({
+                "model": m, "state": h.state(now), "samples": len(h.samples),
+                "latency_ms": int(latency * 1000) if latency is not None else None,
+                "error_rate": h.error_rate(), "last_error": h.last_error,
+                "retry_in": max(0, int(h.open_until - now)) if h.open_until > now else 0,
+            })
+        return out
+
+model_router = ModelRouter(list(GROQ_MODELS), ROUTER_WINDOW, ROUTER_FAIL_THRESHOLD, ROUTER_COOLDOWN_SEC)
+
+async def load_model_state():
+    raw = await db.fetchval("SELECT value FROM settings WHERE key='model_state'")
+    if raw:
+        model_router.import_state(json.loads(raw))
+
+async def save_model_state():
+    await db.execute(
+        "INSERT INTO settings (key, value) VALUES ('model_state', ?) "
+        "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+        (json.dumps(model_router.export_state()),)
+    )
+
+# ====================== PROMPT ======================
+def estimate_tokens(text: str) -> int:
+    """הערכת טוקנים מהירה בלי tokenizer: ~4 תווים לטוקן באנגלית, ~1.6 בעברית"""
+    if not text:
+        return 0
+    ascii_len = len(text.encode("ascii", "ignore"))
+    return int(ascii_len / 4 + (len(text) - ascii_len) / 1.6) + 1
+
+class PromptBuilder:
+    """הרכבת פרומפט לפי תקציב טוקנים: מערכת + עובדות + היסטוריה מהחדש לישן, והשאר כסיכום מתגלגל"""
+
+    MSG_OVERHEAD = 4
+    SUMMARY_MIN_NEW = 6
+    SUMMARY_MAX_TOKENS = 300
+    MAX_USERS = 1000
+
+    def __init__(self, cap: int = 6000):
+        self.cap = cap
+        self._summaries: OrderedDict[int, tuple[str, int]] = OrderedDict()
+        self._refreshing: set[int] = set()
+        self.requests = self.trimmed = self.total_tokens = self.max_seen = 0
+
+    def budget(self, model: str, max_tokens: int) -> int:
+        window = GROQ_MODELS.get(model, 8192)
+        return min(self.cap, window - max_tokens)
+
+    def _cost(self, text: str) -> int:
+        return estimate_tokens(text) + self.MSG_OVERHEAD
+
+    @staticmethod
+    def _fingerprint(turn: dict) -> int:
+        return hash((turn["role"], turn["content"]))
+
+    def forget(self, user_id: int | None = None):
+        if user_id is None:
+            self._summaries.clear()
+        else:
+            self._summaries.pop(user_id, None)
+
+    def _summary_for(self, user_id: int, overflow: list[dict]) -> str | None:
+        """מחזיר את הסיכום השמור ומרענן ברקע כשהצטברו מספיק תורות חדשות שנשרו מהחלון"""
+        cached = self._summaries.get(user_id)
+        summary, last = cached if cached else (None, None)
+        if cached:
+            self._summaries.move_to_end(user_id)
+        marks = [self._fingerprint(t) for t in overflow]
+        new_turns = overflow[marks.index(last) + 1:] if last in marks else overflow
+        if len(new_turns) >= self.SUMMARY_MIN_NEW and user_id not in self._refreshing:
+            self._refreshing.add(user_id)
+            asyncio.create_task(self._refresh(user_id, summary, new_turns, marks[-1]))
+        return summary
+
+    async def _refresh(self, user_id: int, previous: str | None, turns: list[dict], mark: int):
+        try:
+            transcript = "\n".join(f"{t['role']}: {t['content'][:1000]}" for t in turns)
+            prompt = (f"סיכום קודם:\n{previous}\n\n" if previous else "") + \
+                f"עדכן סיכום קצר בעברית של השיחה (עובדות, החלטות, נושאים פתוחים):\n\n{transcript}"
+            resp = await model_router.create(
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=self.SUMMARY_MAX_TOKENS, temperature=0.3
+            )
+            self._summaries[user_id] = (resp.choices[0].message.content.strip(), mark)
+            self._summaries.move_to_end(user_id)
+            while len(self._summaries) > self.MAX_USERS:
+                self._summaries.popitem(last=False)
+        except Exception as e:
+            logger.error(f"Summary refresh error: {e}")
+        finally:
+            self._refreshing.discard(user_id)
+
+    def build(self, user_id: int, system: str, user_text: str, history: list[dict],
+              model: str, max_tokens: int) -> list[dict]:
+        budget = self.budget(model, max_tokens)
+        remaining = budget - self._cost(system) - self._cost(user_text)
+        kept = []
+        for turn in reversed(history):
+            cost = self._cost(turn["content"])
+            if cost > remaining:
+                break
+            kept.append(turn)
+            remaining -= cost
+        kept.reverse()
+        overflow = history[:len(history) - len(kept)]
+        summary_msgs = []
+        if overflow:
+            summary = self._summary_for(user_id, overflow)
+            if summary:
+                cost = self._cost(summary)
+                while kept and cost > remaining:
+                    remaining += self._cost(kept.pop(0)["content"])
+                if cost <= remaining:
+                    remaining -= cost
+                    summary_msgs = [{"role": "system", "content": f"סיכום השיחה הקודמת:\n{summary}"}]
+        used = budget - remaining
+        self.requests += 1
+        self.total_tokens += used
+        self.max_seen = max(self.max_seen, used)
+        if overflow:
+            self.trimmed += 1
+        logger.debug(f"Prompt user={user_id} model={model} ~{used}/{budget} tokens, "
+                     f"history {len(kept)}/{len(history)}, summary={'yes' if summary_msgs else 'no'}")
+        return [{"role": "system", "content": system}] + summary_msgs + kept + [{"role": "user", "content": user_text}]
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests, "trimmed": self.trimmed, "max": self.max_seen,
+            "avg": self.total_tokens // self.requests if self.requests else 0,
+        }
+
+prompt_builder = PromptBuilder(PROMPT_TOKEN_CAP)
+
+# ====================== REMINDERS ======================
+class ParsedTime:
+    __slots__ = ("at", "text", "kind", "seconds")
+
+    def __init__(self, at: int, text: str, kind: str, seconds: int):
+        self.at = at            # unix timestamp
+        self.text = text        # טקסט התזכורת בלי ביטויי הזמן
+        self.kind = kind        # relative / clock / day / weekday / date
+        self.seconds = seconds  # כמה שניות מעכשיו
+
+    def __repr__(self):
+        return f"ParsedTime({datetime.fromtimestamp(self.at):%d/%m/%Y %H:%M}, {self.kind}, {self.text!r})"
+
+class ReminderTimeParser:
+    """מנתח זמנים לתזכורות במעבר אחד על המילים: משכים (גם משולבים - "שעה ו-20 דקות", "2h30m"),
+    שעה ("18:30", "ב-9 בערב", "at 7pm"), "היום/מחר/מחרתיים", ימי שבוע ותאריכים ("25/12"), בעברית ובאנגלית.
+    הזיהוי הוא חיפושי מילון לכל מילה, וביטויים רגולריים מהודרים רק למילים שמתחילות בספרה"""
+
+    DEFAULT_HOUR = 9
+    UNITS = {
+        **dict.fromkeys(("שבועות", "שבוע", "w", "wk", "wks", "week", "weeks"), 604800),
+        **dict.fromkeys(("ימים", "ימי", "יום", "d", "day", "days"), 86400),
+        **dict.fromkeys(("שעות", "שעה", "ש", "ש'", "ש׳", "שע'", "h", "hr", "hrs", "hour", "hours"), 3600),
+        **dict.fromkeys(("דקות", "דקה", "דק", "דק'", "ד", "ד'", "ד׳", "m", "min", "mins", "minute", "minutes"), 60),
+        **dict.fromkeys(("שניות", "שנייה", "שניה", "s", "sec", "secs", "second", "seconds"), 1),
+    }
+    DUALS = {"שעתיים": 7200, "יומיים": 172800, "שבועיים": 1209600}
+    SINGLES = {"שעה": 3600, "דקה": 60, "יום": 86400, "שבוע": 604800}  # רק אחרי "בעוד"/"ו-"
+    PHRASES = {
+        ("חצי", "שעה"): 1800, ("רבע", "שעה"): 900, ("שעה", "וחצי"): 5400,
+        ("half", "an", "hour"): 1800, ("an", "hour"): 3600, ("a", "minute"): 60, ("a", "day"): 86400, ("a", "week"): 604800,
+    }
+    LEADS = {"בעוד", "תוך", "in", "within"}
+    FILLERS = {"תזכורת", "remind"}
+    FILLER_PAIRS = {("תזכיר", "לי"), ("תזכור", "לי"), ("remind", "me")}
+    AT = {"בשעה", "at", "ב"}  # "ב" לבד: "ב 10 בלילה"
+    DAYS = {"היום": 0, "today": 0, "מחר": 1, "tomorrow": 1, "מחרתיים": 2}
+    NEXT_WEEK = {("שבוע", "הבא"), ("שבוע", "הבאה"), ("next", "week")}  # גם "בשבוע הבא"
+    HE_WEEKDAYS = {"שני": 0, "שלישי": 1, "רביעי": 2, "חמישי": 3, "שישי": 4, "שבת": 5, "ראשון": 6}
+    EN_WEEKDAYS = {"monday": 0, "tuesday": 1, "wednesday": 2, "thursday": 3, "friday": 4, "saturday": 5, "sunday": 6}
+    PM = {"pm", "בערב", "בלילה", 'אחה"צ', "אחהצ", "בצהריים"}
+    AM = {"am", "בבוקר"}
+    PARTS = PM | AM
+    PUNCT = ",!?;()\"“”"
+    PHRASE_STARTS = {p[0] for p in PHRASES}
+    # כל מילה שיכולה להתחיל ביטוי זמן; שאר המילים (רוב הטקסט) מדולגות בבדיקה אחת
+    KEYWORDS = (LEADS | FILLERS | {p[0] for p in FILLER_PAIRS} | AT | PHRASE_STARTS | DAYS.keys() | DUALS.keys()
+                | SINGLES.keys() | EN_WEEKDAYS.keys() | {"שבת", "next"})
+
+    CLOCK = re.compile(r"(\d{1,2}):(\d{2})(am|pm)?")
+    DATE = re.compile(r"(\d{1,2})[./](\d{1,2})(?:[./](\d{2,4}))?\.?")
+    AMOUNTS = re.compile(r"(?:\d+(?:\.\d+)?[^\W\d]*['׳]?)+")
+    AMOUNT = re.compile(r"(\d+(?:\.\d+)?)([^\W\d]*['׳]?)")
+
+    def parse(self, text: str, now: datetime | None = None) -> ParsedTime | None:
+        now = now or datetime.now()
+        words = text.split()
+        punct = self.PUNCT
+        lower = [w.strip(punct) for w in text.lower().split()]  # lower() אחד לכל הטקסט ולא לכל מילה
+        n = len(lower)
+        used = [False] * n
+        seconds = 0
+        day = weekday = clock = day_date = None
+        lead = at = -1
+        i = 0
+        keywords = self.KEYWORDS
+        while i < n:
+            w = lower[i]
+            # תחילית ו/ב/ל ומקף: "ב-9", "ו-20", "ביום", "לשבת"
+            bare = w[1:].lstrip("-") if len(w) > 1 and w[0] in "ובל" else ""
+            if w not in keywords and not w[:1].isdigit() and (
+                    not bare or (bare not in keywords and not bare[0].isdigit())):
+                i += 1
+                continue
+            nxt = lower[i + 1] if i + 1 < n else ""
+            step = 1
+            phrase = None
+            if w in self.PHRASE_STARTS:
+                phrase = self.PHRASES.get((w, nxt)) or (self.PHRASES.get((w, nxt, lower[i + 2])) if i + 2 < n else None)
+            if (w, nxt) in self.FILLER_PAIRS:
+                used[i] = used[i + 1] = True
+                step = 2
+            elif w in self.FILLERS:
+                used[i] = True
+            elif w in self.LEADS:
+                lead = i
+            elif w in self.AT:
+                at = i
+            elif phrase:
+                step = 3 if (w, nxt) not in self.PHRASES else 2
+                seconds += phrase
+                used[i:i + step] = [True] * step
+                if lead == i - 1 and lead >= 0:
+                    used[lead] = True
+            else:
+                for c in (w, bare):
+                    if not c:
+                        continue
+                    if c[0].isdigit():  # הנפוץ ביותר, ואף מילת מפתח לא מתחילה בספרה
+                        result = self._numeric(c, nxt, prefixed=c is bare and w[0] == "ב" or at == i - 1, now=now)
+                        if result is None:
+                            continue
+                        kind, value, step = result
+                        if kind == "dur":
+                            seconds += value
+                        elif kind == "date":
+                            day_date = value
+                        else:
+                            clock = value
+                    elif (c, nxt) in self.NEXT_WEEK:
+                        day = 7
+                        step = 2
+                    elif c in self.DUALS or (c in self.SINGLES and ((lead >= 0 and lead == i - 1) or (c is bare and w[0] == "ו"))):
+                        seconds += self.DUALS.get(c) or self.SINGLES[c]
+                    elif c in self.DAYS:
+                        day = self.DAYS[c]
+                    elif c == "יום" and nxt in self.HE_WEEKDAYS:
+                        weekday = self.HE_WEEKDAYS[nxt]
+                        step = 2
+                    elif c == "שבת":
+                        weekday = 5
+                    elif c in self.EN_WEEKDAYS:
+                        weekday = self.EN_WEEKDAYS[c]
+                        if i and lower[i - 1] in ("on", "next"):
+                            used[i - 1] = True
+                    else:
+                        continue
+                    used[i:i + step] = [True] * step
+                    for prev in (lead, at):
+                        if prev == i - 1 and prev >= 0:
+                            used[prev] = True
+                    break
+            i += step
+
+        if seconds > 0:
+            # משך גובר על שעה/יום (כמו בפענוח הקודם)
+            return ParsedTime(int(now.timestamp()) + int(seconds), self._rest(words, used), "relative", int(seconds))
+        if clock is None and day is None and weekday is None and day_date is None:
+            return None
+
+        h, mi, ambiguous = clock or (self.DEFAULT_HOUR, 0, False)
+        base = now.replace(hour=h, minute=mi, second=0, microsecond=0)
+        if day_date is not None:
+            kind = "date"
+            date, roll_year = day_date
+            target = base.replace(year=date.year, month=date.month, day=date.day)
+            if target <= now and roll_year:
+                try:
+                    target = target.replace(year=target.year + 1)
+                except ValueError:
+                    return None
+        elif weekday is not None:
+            kind = "weekday"
+            target = base + timedelta(days=(weekday - now.weekday()) % 7)
+            if target <= now:
+                target += timedelta(days=7)
+        elif day is not None:
+            kind = "day"
+            target = base + timedelta(days=day)
+            if target <= now and ambiguous and h < 12:
+                target += timedelta(hours=12)
+        else:
+            kind = "clock"
+            target = base
+            if target <= now and ambiguous and h < 12 and target + timedelta(hours=12) > now:
+                target += timedelta(hours=12)
+            elif target <= now:
+                target += timedelta(days=1)
+        if target <= now:
+            return None
+        at_ts = int(target.timestamp())
+        return ParsedTime(at_ts, self._rest(words, used), kind, at_ts - int(now.timestamp()))
+
+    def _numeric(self, c: str, nxt: str, prefixed: bool, now: datetime) -> tuple | None:
+        """מילה שמתחילה בספרה: (סוג, ערך, כמה מילים נצרכו) או None"""
+        if c.isdecimal():
+            # מספר לבד ("10 דקות", "ב-9 בערב") - בלי ביטויים רגולריים
+            if nxt in self.UNITS:
+                return "dur", float(c) * self.UNITS[nxt], 2
+            h = int(c)
+            part = nxt if nxt in self.PARTS else ""
+            if not (prefixed or part) or h > 23:
+                return None
+            if part in self.PM and h < 12:
+                h += 12
+            return "clock", (h, 0, not part), 2 if part else 1
+        m = self.CLOCK.fullmatch(c) if ":" in c else None
+        if m:
+            h, mi = int(m.group(1)), int(m.group(2))
+            part = m.group(3) or (nxt if nxt in self.PARTS else "")
+            if part in self.PM and h < 12:
+                h += 12
+            if h > 23 or mi > 59:
+                return None
+            return "clock", (h, mi, False), 2 if part and not m.group(3) else 1
+        if self.AMOUNTS.fullmatch(c):
+            total, bare = 0.0, None
+            for number, unit in self.AMOUNT.findall(c):
+                if unit in self.UNITS:
+                    total += float(number) * self.UNITS[unit]
+                elif not unit and nxt in self.UNITS:
+                    return "dur", total + float(number) * self.UNITS[nxt], 2
+                elif unit in ("am", "pm") or not unit:
+                    bare = (int(float(number)), unit)
+                else:
+                    return None
+            if bare is None:
+                return "dur", total, 1
+            h, part = bare
+            if not part and nxt in self.PARTS:
+                part, step = nxt, 2
+            else:
+                step = 1
+            if total or not (prefixed or part) or h > 23:
+                return None
+            if part in self.PM and h < 12:
+                h += 12
+            return "clock", (h, 0, not part), step
+        m = self.DATE.fullmatch(c)
+        if m:
+            year = int(m.group(3)) if m.group(3) else None
+            if year is not None and year < 100:
+                year += 2000
+            try:
+                return "date", (datetime(year or now.year, int(m.group(2)), int(m.group(1))), year is None), 1
+            except ValueError:
+                return None
+        return None
+
+    @staticmethod
+    def _rest(words: list[str], used: list[bool]) -> str:
+        return " ".join(w for w, u in zip(words, used) if not u).strip(" ,-–:.") or "תזכורת"
+
+time_parser = ReminderTimeParser()
+
+def parse_reminder_time(text: str) -> tuple:
+    parsed = time_parser.parse(text)
+    return (parsed.at, parsed.text) if parsed else (None, text)
+
+class ReminderScheduler:
+    """min-heap של תזכורות בזיכרון: ישן בדיוק עד הבאה בתור ומתעורר כשנוספת תזכורת מוקדמת יותר"""
+
+    MAX_SLEEP = 3600  # בדיקה חוזרת מדי פעם למקרה ששעון המערכת זז
+
+    def __init__(self):
+        self._heap: list[tuple[int, int]] = []
+        self._live: dict[int, int] = {}
+        self._wake = asyncio.Event()
+
+    async def load(self):
+        rows = await db.fetchall("SELECT id, remind_at FROM reminders ORDER BY remind_at")
+        self._live = {r_id: remind_at for r_id, remind_at in rows}
+        self._heap = [(remind_at, r_id) for r_id, remind_at in rows]
+        self._wake.set()
+        logger.info(f"Reminder scheduler loaded {len(rows)} reminders")
+
+    def add(self, r_id: int, remind_at: int):
+        self._live[r_id] = remind_at
+        heapq.heappush(self._heap, (remind_at, r_id))
+        if self._heap[0][1] == r_id:
+            self._wake.set()
+
+    def remove(self, r_id: int):
+        # מחיקה עצלה: הרשומה בערימה תדולג כשתגיע לראש
+        self._live.pop(r_id, None)
+
+    def clear(self):
+        self._live.clear()
+        self._heap.clear()
+        self._wake.set()
+
+    def _pop_due(self, now: float) -> list[int]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            remind_at, r_id = heapq.heappop(self._heap)
+            if self._live.get(r_id) == remind_at:
+                del self._live[r_id]
+                due.append(r_id)
+        return due
+
+    def _next_delay(self) -> float | None:
+        while self._heap and self._live.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return min(self._heap[0][0] - time.time(), self.MAX_SLEEP)
+
+    async def run(self, dispatch):
+        while True:
+            self._wake.clear()
+            delay = self._next_delay()
+            if delay is None:
+                await self._wake.wait()
+                continue
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            due = self._pop_due(time.time())
+            if due:
+                try:
+                    await dispatch(due)
+                except Exception as e:
+                    logger.error(f"Reminder dispatch error: {e}")
+
+reminder_scheduler = ReminderScheduler()
+
+async def add_reminder(user_id: int, remind_at: int, text: str) -> int:
+    r_id = await db.insert(
+        "INSERT INTO reminders (user_id, remind_at, text, created_at) VALUES (?, ?, ?, ?)",
+        (user_id, remind_at, text, int(time.time()))
+    )
+    reminder_scheduler.add(r_id, remind_at)
+    return r_id
+
+class ReminderDispatcher:
+    """שליחת תזכורות שהגיע זמנן במקביל (מוגבל בסמפור), כיבוד retry_after ומחיקה מרוכזת של מה שנמסר"""
+
+    CHUNK = 500
+
+    def __init__(self, concurrency: int = 20, max_attempts: int = 5):
+        self._sem = asyncio.Semaphore(concurrency)
+        self.max_attempts = max_attempts
+        self._attempts: dict[int, int] = {}
+        self._paused_until = 0.0
+
+    async def _send(self, r_id: int, user_id: int, text: str) -> bool | None:
+        """True - נמסר, False - כישלון זמני (ננסה שוב), None - כישלון סופי"""
+        kb = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="✅ בוצע", callback_data=f"done_reminder_{r_id}"),
+            InlineKeyboardButton(text="⏰ עוד 30 דק'", callback_data=f"snooze_{r_id}_30"),
+            InlineKeyboardButton(text="⏰ עוד שעה", callback_data=f"snooze_{r_id}_60"),
+        ]])
+        async with self._sem:
+            for _ in range(3):
+                # retry_after של טלגרם חל על כל הבוט, לכן ההשהיה משותפת לכל השליחות
+                wait = self._paused_until - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                try:
+                    await bot.send_message(user_id, f"⏰ **תזכורת:**\n{text}", reply_markup=kb)
+                    return True
+                except TelegramRetryAfter as e:
+                    self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                except (TelegramForbiddenError, TelegramBadRequest) as e:
+                    logger.warning(f"Reminder {r_id} undeliverable to {user_id}: {e}")
+                    return None
+                except Exception as e:
+                    logger.error(f"Reminder send error: {e}")
+                    return False
+            return False
+
+    async def __call__(self, ids: list[int]):
+        for i in range(0, len(ids), self.CHUNK):
+            chunk = ids[i:i + self.CHUNK]
+            rows = await db.fetchall(
+                f"SELECT id, user_id, text FROM reminders WHERE id IN ({','.join('?' * len(chunk))})",
+                tuple(chunk)
+            )
+            results = await asyncio.gather(*(self._send(*row) for row in rows))
+            finished = []
+            for (r_id, _, _), ok in zip(rows, results):
+                if ok is not False:
+                    self._attempts.pop(r_id, None)
+                    finished.append(r_id)
+                    continue
+                attempts = self._attempts.get(r_id, 0) + 1
+                if attempts >= self.max_attempts:
+                    logger.error(f"Reminder {r_id} dropped after {attempts} attempts")
+                    self._attempts.pop(r_id, None)
+                    finished.append(r_id)
+                    continue
+                self._attempts[r_id] = attempts
+                reminder_scheduler.add(r_id, int(time.time()) + min(30 * 2 ** (attempts - 1), 3600))
+            if finished:
+                await db.execute(
+                    f"DELETE FROM reminders WHERE id IN ({','.join('?' * len(finished))})", tuple(finished)
+                )
+            if len(rows) > 50:
+                logger.info(f"Dispatched {len(rows)} reminders: {len(rows) - len(finished)} pending retry")
+
+send_due_reminders = ReminderDispatcher(REMINDER_CONCURRENCY, REMINDER_MAX_ATTEMPTS)
+
+async def reminder_checker():
+    await reminder_scheduler.load()
+    await reminder_scheduler.run(send_due_reminders)
+
+# ====================== DAILY DIGEST ======================
+class DigestEngine:
+    """סיכום בוקר לכל משתמש בשעה ובאזור הזמן שלו. תור טיימרים אחד (min-heap) לכל המשתמשים:
+    כל מי שהגיע זמנו נאסף יחד, התזכורות של כולם נשלפות בשאילתה אחת, וההודעות נשלחות במקביל בקצב מוגבל"""
+
+    CHUNK = 500
+    WINDOW = 86400  # מה נכלל בסיכום: כל מה שמתוזמן עד 24 שעות קדימה (כולל מה שפספסנו)
+
+    def __init__(self, default_time: str = "08:00", default_tz: str = "", rate: float = 25, workers: int = 8):
+        hour, minute = default_time.split(":")
+        self.default = (default_tz, int(hour), int(minute))
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self._prefs: dict[int, tuple[str, int, int, bool]] = {}
+        self._heap: list[tuple[float, int]] = []
+        self._live: dict[int, float] = {}
+        self._wake = asyncio.Event()
+        self.last_run: dict = {}
+
+    @staticmethod
+    def zone(tz: str):
+        return ZoneInfo(tz) if tz else None
+
+    @staticmethod
+    def next_fire(tz: str, hour: int, minute: int, after: float) -> float:
+        """הפעם הבאה (timestamp) שבה השעון המקומי ב-tz מראה hour:minute, אחרי after"""
+        zone = DigestEngine.zone(tz)
+        local = datetime.fromtimestamp(after, zone)
+        target = local.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if target.timestamp() <= after:
+            # חיבור יום על השעון המקומי (לא 86400 שניות) כדי שמעבר שעון קיץ/חורף לא יזיז את השעה
+            target = datetime.combine(local.date() + timedelta(days=1), target.time(), zone)
+        return target.timestamp()
+
+    def prefs(self, user_id: int) -> tuple[str, int, int, bool]:
+        return self._prefs.get(user_id, (*self.default, True))
+
+    def recipients(self) -> set[int]:
+        users = (ALLOWED_IDS | ADMIN_IDS | self._prefs.keys())
+        return {uid for uid in users if self.prefs(uid)[3] and is_allowed(uid) and uid not in banned}
+
+    def schedule(self, user_id: int, after: float | None = None):
+        tz, hour, minute, enabled = self.prefs(user_id)
+        if not enabled or not is_allowed(user_id):
+            self._live.pop(user_id, None)
+            return
+        at = self.next_fire(tz, hour, minute, time.time() if after is None else after)
+        self._live[user_id] = at
+        heapq.heappush(self._heap, (at, user_id))
+        if self._heap[0][1] == user_id:
+            self._wake.set()
+
+    async def load(self):
+        rows = await db.fetchall("SELECT user_id, tz, hour, minute, enabled FROM digest_prefs")
+        self._prefs = {uid: (tz or "", hour, minute, bool(enabled)) for uid, tz, hour, minute, enabled in rows}
+        self._heap, self._live = [], {}
+        for uid in self.recipients():
+            self.schedule(uid)
+        self._wake.set()
+        logger.info(f"Digest scheduler loaded {len(self._live)} users")
+
+    async def set_prefs(self, user_id: int, tz: str | None = None, hour: int | None = None,
+                        minute: int | None = None, enabled: bool | None = None):
+        cur_tz, cur_hour, cur_minute, cur_enabled = self.prefs(user_id)
+        new = (
+            cur_tz if tz is None else tz, cur_hour if hour is None else hour,
+            cur_minute if minute is None else minute, cur_enabled if enabled is None else enabled,
+        )
+        await db.execute(
+            "INSERT OR REPLACE INTO digest_prefs (user_id, tz, hour, minute, enabled) VALUES (?, ?, ?, ?, ?)",
+            (user_id, new[0], new[1], new[2], int(new[3]))
+        )
+        self._prefs[user_id] = new
+        self.schedule(user_id)
+
+    def _pop_due(self, now: float) -> list[tuple[int, float]]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            at, uid = heapq.heappop(self._heap)
+            if self._live.get(uid) == at:
+                del self._live[uid]
+                due.append((uid, at))
+        return due
+
+    def render(self, tz: str, items: list[tuple[int, str]]) -> str:
+        zone = self.zone(tz)
+        lines = ["☀️ **תזכורות להיום:**\n"]
+        for remind_at, text in items:
+            lines.append(f"• {datetime.fromtimestamp(remind_at, zone).strftime('%H:%M')} – {text}")
+        return "\n".join(lines)
+
+    async def _send(self, user_id: int, text: str) -> bool:
+        for _ in range(3):
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(user_id, text)
+                return True
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest):
+                return False
+            except Exception as e:
+                logger.error(f"Digest send error to {user_id}: {e}")
+                return False
         return False
-    rate_limit[user_id][key].append(time.time())
-    return True
 
-# ====================== MODEL AUTO-UPDATE ======================
-async def get_best_model() -> str:
-    global active_model
-    for model in GROQ_MODELS:
-        try:
-            test = await groq_client.chat.completions.create(
-                model=model,
-                messages=[{"role": "user", "content": "hi"}],
-                max_tokens=5
-            )
-            if test.choices:
-                active_model = model
-                return model
-        except Exception:
-            continue
-    return active_model
+    async def deliver(self, due: list[tuple[int, float]]) -> int:
+        """שאילתה מקובצת אחת לכל CHUNK משתמשים, רינדור בזיכרון ושליחה מקבילית"""
+        started = time.perf_counter()
+        cutoffs = {uid: int(at) + self.WINDOW for uid, at in due}
+        by_user: dict[int, list[tuple[int, str]]] = {}
+        uids = list(cutoffs)
+        for i in range(0, len(uids), self.CHUNK):
+            chunk = uids[i:i + self.CHUNK]
+            rows = await db.fetchall(
+                f"SELECT user_id, remind_at, text FROM reminders WHERE user_id IN ({','.join('?' * len(chunk))}) "
+                f"AND remind_at < ? ORDER BY user_id, remind_at",
+                (*chunk, max(cutoffs[uid] for uid in chunk))
+            )
+            for uid, remind_at, text in rows:
+                if remind_at < cutoffs[uid]:
+                    by_user.setdefault(uid, []).append((remind_at, text))
+        fetched = time.perf_counter()
+
+        sem = asyncio.Semaphore(self.workers)
+
+        async def worker(uid, text):
+            async with sem:
+                return await self._send(uid, text)
+        results = await asyncio.gather(*(
+            worker(uid, self.render(self.prefs(uid)[0], items)) for uid, items in by_user.items()
+        ))
+        sent = sum(results)
+        self.last_run = {
+            "users": len(due), "messages": len(by_user), "sent": sent,
+            "query_ms": (fetched - started) * 1000, "total_sec": time.perf_counter() - started,
+        }
+        if by_user:
+            logger.info(f"Digest: {sent}/{len(by_user)} sent to {len(due)} due users "
+                        f"(query {self.last_run['query_ms']:.0f}ms, total {self.last_run['total_sec']:.1f}s)")
+        return sent
+
+    async def run(self):
+        while True:
+            self._wake.clear()
+            if not self._heap:
+                await self._wake.wait()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), min(delay, ReminderScheduler.MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            due = self._pop_due(time.time())
+            for uid, at in due:
+                self.schedule(uid, after=at)
+            if due:
+                try:
+                    await self.deliver(due)
+                except Exception as e:
+                    logger.error(f"Daily summary error: {e}")
+
+digests = DigestEngine(DIGEST_TIME, DIGEST_TZ, DIGEST_RATE, DIGEST_WORKERS)
+
+# ====================== BROADCAST ======================
+class BroadcastEngine:
+    """שידורים כמשימות רקע שמורות ב-SQLite: קצב מוגבל, עובדים במקביל, המשך אחרי הפעלה מחדש"""
+
+    PAGE = 100
+    REPORT_EVERY = 3
+
+    def __init__(self, rate: float = 25, workers: int = 8):
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._cancelled: set[int] = set()
+
+    async def start(self, text: str, chat_id: int, message_id: int) -> int:
+        # בדיוק מי שיקבל: בלי חסומים ומנהלים, שמדולגים בשליחה
+        admins = tuple(ADMIN_IDS)
+        sql = "SELECT COUNT(DISTINCT user_id) FROM history WHERE user_id NOT IN (SELECT user_id FROM bans)"
+        if admins:
+            sql += f" AND user_id NOT IN ({','.join('?' * len(admins))})"
+        total = await db.fetchval(sql, admins, default=0)
+        job_id = await db.insert(
+            "INSERT INTO broadcasts (text, status, total, chat_id, message_id, created_at) VALUES (?, 'running', ?, ?, ?, ?)",
+            (text, total, chat_id, message_id, int(time.time()))
+        )
+        self._spawn(job_id)
+        return job_id
+
+    async def resume(self):
+        for (job_id,) in await db.fetchall("SELECT id FROM broadcasts WHERE status='running'"):
+            logger.info(f"Resuming broadcast #{job_id}")
+            self._spawn(job_id)
+
+    def cancel(self, job_id: int) -> bool:
+        if job_id not in self._tasks:
+            return False
+        self._cancelled.add(job_id)
+        return True
+
+    def _spawn(self, job_id: int):
+        task = asyncio.create_task(self._run(job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _send(self, uid: int, text: str) -> bool:
+        for _ in range(3):
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(uid, f"📢 {text}")
+                return True
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest):
+                return False
+            except Exception as e:
+                logger.error(f"Broadcast send error to {uid}: {e}")
+                return False
+        return False
+
+    async def _deliver(self, uids: list[int], text: str) -> list[bool]:
+        sem = asyncio.Semaphore(self.workers)
+
+        async def worker(uid):
+            async with sem:
+                return await self._send(uid, text)
+        return await asyncio.gather(*(worker(uid) for uid in uids))
+
+    async def _report(self, job: dict, final: bool = False):
+        progress = f"{job['sent'] + job['failed']}/{job['total']}"
+        if final:
+            title = "🛑 שידור בוטל" if job["status"] == "cancelled" else "✅ שידור הסתיים"
+            text = f"{title} #{job['id']}\n✅ נשלח: {job['sent']} | נכשל: {job['failed']}"
+            kb = None
+        else:
+            text = f"📢 שידור #{job['id']} רץ... {progress}\n✅ נשלח: {job['sent']} | נכשל: {job['failed']}"
+            kb = InlineKeyboardMarkup(inline_keyboard=[[
+                InlineKeyboardButton(text="🛑 בטל", callback_data=f"bc_cancel_{job['id']}")
+            ]])
+        try:
+            await bot.edit_message_text(text, chat_id=job["chat_id"], message_id=job["message_id"], reply_markup=kb)
+        except Exception:
+            pass
+
+    async def _run(self, job_id: int):
+        row = await db.fetchone(
+            "SELECT text, total, sent, failed, cursor, chat_id, message_id FROM broadcasts WHERE id=?", (job_id,)
+        )
+        if not row:
+            return
+        job = dict(zip(("text", "total", "sent", "failed", "cursor", "chat_id", "message_id"), row))
+        job.update(id=job_id, status="running")
+        last_report = 0.0
+        try:
+            while job_id not in self._cancelled:
+                page = [r[0] for r in await db.fetchall(
+                    "SELECT DISTINCT user_id FROM history WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                    (job["cursor"], self.PAGE)
+                )]
+                if not page:
+                    break
+                targets = [uid for uid in page if uid not in banned and uid not in ADMIN_IDS]
+                results = await self._deliver(targets, job["text"])
+                job["sent"] += sum(results)
+                job["failed"] += len(results) - sum(results)
+                job["cursor"] = page[-1]
+                # נקודת ביקורת אחרי כל עמוד: אחרי קריסה ממשיכים מהמשתמש הבא
+                await db.execute(
+                    "UPDATE broadcasts SET sent=?, failed=?, cursor=? WHERE id=?",
+                    (job["sent"], job["failed"], job["cursor"], job_id)
+                )
+                if time.monotonic() - last_report >= self.REPORT_EVERY:
+                    last_report = time.monotonic()
+                    await self._report(job)
+            job["status"] = "cancelled" if job_id in self._cancelled else "done"
+            await db.execute(
+                "UPDATE broadcasts SET status=?, finished_at=? WHERE id=?",
+                (job["status"], int(time.time()), job_id)
+            )
+            await self._report(job, final=True)
+        except Exception as e:
+            logger.error(f"Broadcast #{job_id} error: {e}")
+        finally:
+            self._cancelled.discard(job_id)
+
+    async def list_jobs(self, limit: int = 5) -> list:
+        return await db.fetchall(
+            "SELECT id, status, total, sent, failed, created_at FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,)
+        )
+
+broadcaster = BroadcastEngine(BROADCAST_RATE, BROADCAST_WORKERS)
+
+# ====================== FILES ======================
+def write_file_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def read_file(path: str) -> bytes | None:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+class SpooledInputFile(types.InputFile):
+    """העלאה לטלגרם ישירות מקובץ פתוח (גם SpooledTemporaryFile) בחתיכות, בלי להעתיק לזיכרון"""
+
+    def __init__(self, file, filename: str, chunk_size: int = 64 * 1024):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, bot_: Bot):
+        self.file.seek(0)
+        while chunk := self.file.read(self.chunk_size):
+            yield chunk
+
+# ====================== EXPORT ======================
+class ExportBuilder:
+    """כותב ייצוא שורה-שורה לקבצים זמניים (בזיכרון עד EXPORT_SPOOL_MB, אחר כך לדיסק).
+    כשחלק עובר את part_bytes נפתח חלק חדש שעומד בפני עצמו: ב-md הכותרת חוזרת, ב-zip נפתח ארכיון חדש"""
+
+    FORMATS = ("md", "jsonl", "zip")
+
+    def __init__(self, fmt: str, part_bytes: int, spool_bytes: int):
+        self.fmt = fmt
+        self.part_bytes = part_bytes
+        self.spool_bytes = spool_bytes
+        self.parts: list = []
+        self.rows = 0
+        self._section: tuple[str, str] | None = None
+        self._zip: zipfile.ZipFile | None = None
+        self._entry = None
+        self._part_rows = 0
+        self._open_part()
+
+    def _open_part(self):
+        self._file = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        self.parts.append(self._file)
+        self._part_rows = 0
+        if self.fmt == "zip":
+            self._zip = zipfile.ZipFile(self._file, "w", zipfile.ZIP_DEFLATED)
+        if self._section:
+            self._start_section(*self._section, continued=True)
 
-# ====================== REMINDERS ======================
-def parse_reminder_time(text: str) -> tuple:
-    now = int(time.time())
-    total_seconds = 0
-    reminder_text = text
-    patterns = [
-        (r'(\d+)\s*(?:שעות?|ש\'?)', 3600),
-        (r'(\d+)\s*(?:דקות?|ד\'?)', 60),
-        (r'(\d+)\s*(?:ימים?)', 86400),
-        (r'(\d+)h', 3600),
-        (r'(\d+)m', 60),
-        (r'(\d+)d', 86400),
-    ]
-    for pattern, multiplier in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            total_seconds += int(match.group(1)) * multiplier
-            reminder_text = re.sub(pattern, '', reminder_text, flags=re.IGNORECASE).strip()
+    def _close_part(self):
+        if self._entry:
+            self._entry.close()
+            self._entry = None
+        if self._zip:
+            self._zip.close()
+            self._zip = None
 
-    time_match = re.search(r'(\d{1,2}):(\d{2})', text)
-    if time_match and total_seconds == 0:
-        h, m = int(time_match.group(1)), int(time_match.group(2))
-        target = datetime.now().replace(hour=h, minute=m, second=0, microsecond=0)
-        if target <= datetime.now():
-            target += timedelta(days=1)
-        total_seconds = int(target.timestamp()) - now
-        reminder_text = re.sub(r'\d{1,2}:\d{2}', '', reminder_text).strip()
+    def _start_section(self, name: str, title: str, continued: bool = False):
+        if self.fmt == "zip":
+            if self._entry:
+                self._entry.close()
+            self._entry = self._zip.open(f"{name}.jsonl", "w")
+        elif self.fmt == "md":
+            self._file.write(f"\n## {title}{' (המשך)' if continued else ''}\n\n".encode("utf-8"))
 
-    if total_seconds <= 0:
-        return None, text
+    def section(self, name: str, title: str):
+        self._section = (name, title)
+        self._start_section(name, title)
 
-    for word in ['תזכיר לי', 'תזכור לי', 'תזכורת', 'remind', 'בעוד', 'תוך']:
-        reminder_text = reminder_text.replace(word, '').strip()
+    def write(self, text: str):
+        data = text.encode("utf-8")
+        # tell() ב-zip מפגר במעט אחרי הדחיסה - המרווח מתחת ל-50MB מכסה את זה
+        if self._part_rows and self._file.tell() + len(data) > self.part_bytes:
+            self._close_part()
+            self._open_part()
+        (self._entry or self._file).write(data)
+        self._part_rows += 1
+        self.rows += 1
 
-    return now + total_seconds, reminder_text or "תזכורת"
+    def finish(self) -> list:
+        self._close_part()
+        return self.parts
 
-async def reminder_checker():
-    while True:
+def _export_md(kind: str, row: tuple) -> str:
+    if kind == "facts":
+        return f"- **{row[0]}:** {row[1]}\n"
+    if kind == "notes":
+        return f"### {row[1]} ({datetime.fromtimestamp(row[3]).strftime('%d/%m/%Y')})\n{row[2] or ''}\n\n"
+    if kind == "reminders":
+        return f"- {datetime.fromtimestamp(row[1]).strftime('%d/%m/%Y %H:%M')}: {row[2]}\n"
+    who = "אני" if row[0] == "user" else BOT_NAME
+    return f"**[{datetime.fromtimestamp(row[2]).strftime('%d/%m/%Y %H:%M')}] {who}:** {row[1]}\n\n"
+
+# (שם, כותרת, שאילתה, עמודות ל-JSON)
+EXPORT_SECTIONS = (
+    ("facts", "מה אני זוכר עליך",
+     "SELECT key, value, updated_at FROM user_facts WHERE user_id=? ORDER BY key", ("key", "value", "updated_at")),
+    ("notes", "פתקים",
+     "SELECT id, title, content, created_at FROM notes WHERE user_id=? ORDER BY created_at DESC",
+     ("id", "title", "content", "created_at")),
+    ("reminders", "תזכורות פעילות",
+     "SELECT id, remind_at, text FROM reminders WHERE user_id=? ORDER BY remind_at", ("id", "remind_at", "text")),
+    ("history", "היסטוריית שיחה",
+     "SELECT role, content, timestamp FROM history WHERE user_id=? ORDER BY timestamp", ("role", "content", "timestamp")),
+)
+
+async def export_user(user_id: int, fmt: str = "md") -> ExportBuilder:
+    """כל הנתונים של המשתמש, בקריאה אחת עקבית ובזרימה: cursor על חיבור קריאה, 500 שורות לכל פעם"""
+    await write_behind.flush()
+    out = ExportBuilder(fmt, EXPORT_PART_MB * 1024 * 1024, EXPORT_SPOOL_MB * 1024 * 1024)
+    if fmt == "md":
+        out.write(f"# הייצוא של {BOT_NAME}\n\nתאריך: {datetime.now().strftime('%d/%m/%Y %H:%M')}\n")
+    async with db.reader() as conn:
+        await conn.execute("BEGIN")  # snapshot אחד לכל הטבלאות
         try:
-            now = int(time.time())
-            async with aiosqlite.connect(DB_FILE) as db:
-                async with db.execute(
-                    "SELECT id, user_id, text FROM reminders WHERE remind_at <= ?", (now,)
-                ) as cursor:
-                    due = await cursor.fetchall()
-                for r_id, user_id, text in due:
-                    try:
-                        kb = InlineKeyboardMarkup(inline_keyboard=[[
-                            InlineKeyboardButton(text="✅ בוצע", callback_data=f"done_reminder_{r_id}"),
-                            InlineKeyboardButton(text="⏰ עוד 30 דק'", callback_data=f"snooze_{r_id}_30"),
-                            InlineKeyboardButton(text="⏰ עוד שעה", callback_data=f"snooze_{r_id}_60"),
-                        ]])
-                        await bot.send_message(user_id, f"⏰ **תזכורת:**\n{text}", reply_markup=kb)
-                    except Exception as e:
-                        logger.error(f"Reminder send error: {e}")
-                    await db.execute("DELETE FROM reminders WHERE id=?", (r_id,))
-                await db.commit()
-        except Exception as e:
-            logger.error(f"Reminder checker error: {e}")
-        await asyncio.sleep(30)
+            for name, title, sql, columns in EXPORT_SECTIONS:
+                started = False
+                async with conn.execute(sql, (user_id,)) as cur:
+                    cur.arraysize = 500
+                    async for row in cur:
+                        if not started:
+                            out.section(name, title)
+                            started = True
+                        if fmt == "md":
+                            out.write(_export_md(name, row))
+                        else:
+                            record = dict(zip(columns, row))
+                            if fmt == "jsonl":
+                                record = {"type": name, **record}
+                            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        finally:
+            await conn.execute("COMMIT")
+    out.finish()
+    return out
 
 # ====================== VOICE ======================
 async def transcribe_voice(file_bytes: bytes) -> str:
@@ -282,7 +2583,7 @@ async def transcribe_voice(file_bytes: bytes) -> str:
     try:
         audio_file = io.BytesIO(file_bytes)
         audio_file.name = "voice.ogg"
-        transcription = await groq_client.audio.transcriptions.create(
+        transcription = await groq_client().audio.transcriptions.create(
             file=audio_file,
             model=WHISPER_MODEL,
             language="he",
@@ -296,9 +2597,9 @@ async def transcribe_voice(file_bytes: bytes) -> str:
 async def text_to_voice(text: str) -> io.BytesIO | None:
     """המרת טקסט לקול עם Groq TTS"""
     try:
-        response = await groq_client.audio.speech.create(
-            model="playai-tts",
-            voice="Cheyenne-PlayAI",
+        response = await groq_client().audio.speech.create(
+            model=TTS_MODEL,
+            voice=TTS_VOICE,
             input=text[:500],
             response_format="wav"
         )
@@ -309,39 +2610,519 @@ async def text_to_voice(text: str) -> io.BytesIO | None:
         logger.error(f"TTS error: {e}")
         return None
 
+class TtsCache:
+    """מטמון הקראות לפי hash(טקסט, מודל, קול): שכבה חמה בזיכרון, LRU מוגבל בדיסק,
+    ו-file_id של טלגרם כדי שהשמעה חוזרת תישלח בלי להעלות אף בייט"""
+
+    def __init__(self, directory: str, max_bytes: int, hot_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hot_bytes = hot_bytes
+        self._hot: OrderedDict[str, bytes] = OrderedDict()
+        self._hot_size = 0
+        self.synth = self.disk_hits = self.hot_hits = self.id_hits = 0
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha256(f"{TTS_MODEL}|{TTS_VOICE}|{text}".encode()).hexdigest()
+
+    def _remember_hot(self, key: str, data: bytes):
+        if len(data) > self.hot_bytes // 4 or key in self._hot:
+            return
+        self._hot[key] = data
+        self._hot_size += len(data)
+        while self._hot_size > self.hot_bytes:
+            _, old = self._hot.popitem(last=False)
+            self._hot_size -= len(old)
+
+    async def file_id(self, key: str) -> str | None:
+        return await db.fetchval("SELECT file_id FROM tts_cache WHERE key=?", (key,))
+
+    async def audio(self, key: str) -> bytes | None:
+        data = self._hot.get(key)
+        if data is not None:
+            self._hot.move_to_end(key)
+            self.hot_hits += 1
+            return data
+        path = await db.fetchval("SELECT path FROM tts_cache WHERE key=?", (key,))
+        data = await asyncio.to_thread(read_file, path) if path else None
+        if data is not None:
+            self.disk_hits += 1
+            self._remember_hot(key, data)
+            await db.execute("UPDATE tts_cache SET last_used=? WHERE key=?", (int(time.time()), key))
+        return data
+
+    async def store(self, key: str, data: bytes):
+        self.synth += 1
+        self._remember_hot(key, data)
+        path = os.path.join(self.directory, key[:2], f"{key}.wav")
+        await asyncio.to_thread(write_file_atomic, path, data)
+        await db.execute(
+            "INSERT INTO tts_cache (key, path, bytes, last_used) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET path=excluded.path, bytes=excluded.bytes, last_used=excluded.last_used",
+            (key, path, len(data), int(time.time()))
+        )
+        await self._evict()
+
+    async def set_file_id(self, key: str, file_id: str | None):
+        await db.execute("UPDATE tts_cache SET file_id=? WHERE key=?", (file_id, key))
+
+    async def _evict(self):
+        total = await db.fetchval("SELECT COALESCE(SUM(bytes), 0) FROM tts_cache", default=0)
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for key, path, size in await db.fetchall(
+            "SELECT key, path, bytes FROM tts_cache WHERE path IS NOT NULL ORDER BY last_used LIMIT 200"
+        ):
+            if total <= self.max_bytes:
+                break
+            victims.append((key, path))
+            total -= size
+        for _, path in victims:
+            try:
+                await asyncio.to_thread(os.remove, path)
+            except OSError:
+                pass
+        # ה-file_id נשאר תקף בשרתי טלגרם גם אחרי שהקובץ המקומי נמחק
+        async with db.transaction() as conn:
+            await conn.executemany(
+                "UPDATE tts_cache SET path=NULL, bytes=0 WHERE key=?", [(k,) for k, _ in victims]
+            )
+            await conn.execute("DELETE FROM tts_cache WHERE path IS NULL AND file_id IS NULL")
+
+tts_cache = TtsCache(TTS_CACHE_DIR, TTS_CACHE_MB * 1024 * 1024, TTS_HOT_MB * 1024 * 1024)
+
+async def _tts_bytes(key: str, text: str) -> bytes | None:
+    data = await tts_cache.audio(key)
+    if data is None:
+        buf = await text_to_voice(text)
+        if not buf:
+            return None
+        data = buf.getvalue()
+        await tts_cache.store(key, data)
+    return data
+
+async def prepare_voice(text: str) -> tuple | None:
+    """שלב ההכנה (אפשר להריץ כמה במקביל): file_id אם כבר הועלה, אחרת אודיו מהמטמון או מסינתזה"""
+    text = text[:500]
+    key = tts_cache.key(text)
+    file_id = await tts_cache.file_id(key)
+    if file_id:
+        return key, text, None, file_id
+    data = await _tts_bytes(key, text)
+    return (key, text, data, None) if data is not None else None
+
+async def deliver_voice(message: types.Message, prepared: tuple, caption: str) -> bool:
+    key, text, data, file_id = prepared
+    if file_id:
+        # "kind:id" - העלאת WAV עשויה לחזור מטלגרם כ-audio/document ולא כ-voice; רשומות ישנות הן id בלבד
+        kind, _, file_id = file_id.rpartition(":")
+        send = {"audio": message.answer_audio, "document": message.answer_document}.get(kind, message.answer_voice)
+        try:
+            await send(file_id, caption=caption)
+            tts_cache.id_hits += 1
+            return True
+        except TelegramBadRequest:
+            await tts_cache.set_file_id(key, None)
+            data = await _tts_bytes(key, text)
+            if data is None:
+                return False
+    sent = await message.answer_voice(types.BufferedInputFile(data, filename="reply.wav"), caption=caption)
+    for kind in ("voice", "audio", "document"):
+        if media := getattr(sent, kind):
+            await tts_cache.set_file_id(key, f"{kind}:{media.file_id}")
+            break
+    return True
+
+async def send_voice_reply(message: types.Message, text: str, caption: str) -> bool:
+    """שולח הקראה של text: לפי file_id אם כבר הועלתה, אחרת מהמטמון, ורק בלית ברירה מסנתז"""
+    prepared = await prepare_voice(text)
+    return bool(prepared) and await deliver_voice(message, prepared, caption)
+
 # ====================== SEARCH & IMAGE ======================
-async def async_web_search(query: str) -> str:
+class SearchCache:
+    """מטמון חיפושים לפי שאילתה מנורמלת: TTL + LRU בזיכרון, נשמר ב-SQLite, ובקשה אחת לכל שאילתה זהה שבדרך"""
+
+    PRUNE_EVERY = 50
+
+    def __init__(self, ttl: int = 1800, max_entries: int = 500):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[str, str, int]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._puts = 0
+        self.hits = self.misses = self.joined = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+    def _fresh(self, created_at: int) -> bool:
+        return time.time() - created_at < self.ttl
+
+    async def _lookup(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            row = await db.fetchone(
+                "SELECT snippets, summary, created_at FROM search_cache WHERE query_key=?", (key,)
+            )
+            if row:
+                entry = tuple(row)
+                self._remember(key, entry)
+        if entry is None or not self._fresh(entry[2]):
+            self._entries.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _remember(self, key: str, entry: tuple):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _put(self, key: str, snippets: str, summary: str):
+        entry = (snippets, summary, int(time.time()))
+        self._remember(key, entry)
+        await db.execute(
+            "INSERT OR REPLACE INTO search_cache (query_key, snippets, summary, created_at) VALUES (?, ?, ?, ?)",
+            (key, *entry)
+        )
+        self._puts += 1
+        if self._puts % self.PRUNE_EVERY == 0:
+            await db.execute("DELETE FROM search_cache WHERE created_at < ?", (int(time.time()) - self.ttl,))
+            await db.execute(
+                "DELETE FROM search_cache WHERE query_key NOT IN "
+                "(SELECT query_key FROM search_cache ORDER BY created_at DESC LIMIT ?)", (self.max_entries,)
+            )
+
+    async def is_free(self, query: str) -> bool:
+        """האם התשובה כבר במטמון או בדרך (ולכן לא נספרת במגבלת החיפושים)"""
+        key = self.normalize(query)
+        return key in self._inflight or await self._lookup(key) is not None
+
+    async def get_or_fetch(self, query: str, loader) -> str:
+        key = self.normalize(query)
+        cached = await self._lookup(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        task = self._inflight.get(key)
+        if task:
+            self.joined += 1
+        else:
+            self.misses += 1
+            task = asyncio.create_task(self._load(key, query, loader))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, key: str, query: str, loader) -> str:
+        snippets, summary = await loader(query)
+        if snippets:
+            await self._put(key, snippets, summary)
+        return summary
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "joined": self.joined}
+
+search_cache = SearchCache(SEARCH_CACHE_TTL, SEARCH_CACHE_MAX)
+
+async def search_and_summarize(query: str) -> tuple[str, str]:
     def sync_search():
+        from duckduckgo_search import DDGS
         with DDGS() as ddgs:
             results = list(ddgs.text(query, max_results=6))
         return "\n".join([f"• {r['title']}: {r['body'][:200]}" for r in results])
+    snippets = await asyncio.to_thread(sync_search)
+    if not snippets:
+        return "", "לא נמצאו תוצאות."
+    resp = await model_router.create(
+        messages=[{"role": "user", "content": f"סכם בעברית בקצרה:\n\n{snippets}"}],
+        max_tokens=600
+    )
+    return snippets, resp.choices[0].message.content
+
+async def async_web_search(query: str) -> str:
     try:
-        snippets = await asyncio.to_thread(sync_search)
-        if not snippets:
-            return "לא נמצאו תוצאות."
-        resp = await groq_client.chat.completions.create(
-            model=active_model,
-            messages=[{"role": "user", "content": f"סכם בעברית בקצרה:\n\n{snippets}"}],
-            max_tokens=600
-        )
-        return resp.choices[0].message.content
+        return await search_cache.get_or_fetch(query, search_and_summarize)
     except Exception as e:
         logger.error(f"Search error: {e}")
         return "שגיאה בחיפוש."
 
-async def async_generate_flux(prompt: str, variant: str = "schnell") -> io.BytesIO:
-    def sync_flux():
-        return hf.text_to_image(
-            prompt,
-            model=f"black-forest-labs/FLUX.1-{variant}",
-            num_inference_steps=4 if variant == "schnell" else 28,
-            width=1024, height=1024
-        )
-    image = await asyncio.to_thread(sync_flux)
+def generate_flux_png(prompt: str, variant: str = "schnell", seed: int = IMAGE_DEFAULT_SEED) -> bytes:
+    """רץ בתוך ה-thread pool של תור התמונות (כולל קידוד ה-PNG)"""
+    image = hf_client().text_to_image(
+        prompt,
+        model=f"black-forest-labs/FLUX.1-{variant}",
+        num_inference_steps=4 if variant == "schnell" else 28,
+        width=IMAGE_SIZE, height=IMAGE_SIZE,
+        seed=seed
+    )
     buf = io.BytesIO()
     image.save(buf, "PNG")
-    buf.seek(0)
-    return buf
+    return buf.getvalue()
+
+class ImageCancelled(Exception):
+    pass
+
+class ImageJob:
+    __slots__ = ("id", "user_id", "variant", "prompt", "seed", "status", "future", "position")
+
+    def __init__(self, job_id: int, user_id: int, variant: str, prompt: str, seed: int, status: types.Message):
+        self.id = job_id
+        self.user_id = user_id
+        self.variant = variant
+        self.prompt = prompt
+        self.seed = seed
+        self.status = status
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.position = 0
+
+class ImageQueue:
+    """תורי תמונות נפרדים ל-schnell ול-dev: thread pool ייעודי, סבב הוגן בין משתמשים, מיקום בתור, ביטול ו-timeout"""
+
+    MAX_POSITION_EDITS = 30
+
+    def __init__(self, workers: dict[str, int], timeout: int = 180):
+        self.workers = workers
+        self.timeout = timeout
+        # pool נפרד לכל וריאנט: thread תקוע של dev לא יכול לתפוס מקום של schnell
+        self._executors = {
+            v: ThreadPoolExecutor(max_workers=n, thread_name_prefix=f"flux-{v}") for v, n in workers.items()
+        }
+        # threads פנויים בפועל: משתחרר כשהקריאה ב-thread מסתיימת, לא כשה-timeout פג
+        self._free = {v: asyncio.Semaphore(n) for v, n in workers.items()}
+        # לכל וריאנט: משתמש -> תור העבודות שלו; סדר המשתמשים הוא סדר הסבב
+        self._queues: dict[str, OrderedDict[int, deque]] = {v: OrderedDict() for v in workers}
+        self._pending = {v: asyncio.Semaphore(0) for v in workers}
+        self._jobs: dict[int, ImageJob] = {}
+        self._next_id = 0
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        for variant, count in self.workers.items():
+            for _ in range(count):
+                self._tasks.append(asyncio.create_task(self._worker(variant)))
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        for executor in self._executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _cancel_kb(job_id: int) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="✖️ בטל", callback_data=f"img_cancel_{job_id}")
+        ]])
+
+    def _positions(self, variant: str) -> list[tuple[ImageJob, int]]:
+        """מיקום כל עבודה ממתינה לפי סדר הסבב (משתמש אחד בכל סיבוב)"""
+        users = list(self._queues[variant].values())
+        result = []
+        for u_idx, jobs in enumerate(users):
+            for k, job in enumerate(jobs):
+                ahead = sum(min(len(q), k + 1) if i < u_idx else min(len(q), k) for i, q in enumerate(users) if i != u_idx)
+                result.append((job, ahead + k + 1))
+        return result
+
+    def _refresh_positions(self, variant: str):
+        edits = 0
+        for job, pos in sorted(self._positions(variant), key=lambda p: p[1]):
+            if pos == job.position:
+                continue
+            job.position = pos
+            if edits < self.MAX_POSITION_EDITS:
+                edits += 1
+                asyncio.create_task(self._set_status(job, f"⏳ בתור ל-Flux {variant.upper()}: מקום {pos}", True))
+
+    async def _set_status(self, job: ImageJob, text: str, cancellable: bool = False):
+        try:
+            await job.status.edit_text(text, reply_markup=self._cancel_kb(job.id) if cancellable else None)
+        except Exception:
+            pass
+
+    async def submit(self, message: types.Message, user_id: int, prompt: str, variant: str,
+                     seed: int = IMAGE_DEFAULT_SEED) -> io.BytesIO:
+        """מכניס לתור ומחכה לתמונה. זורק ImageCancelled / asyncio.TimeoutError"""
+        # המזהה נלקח לפני ה-await: שתי בקשות במקביל לא יקבלו אותו מספר
+        job_id = self._next_id = self._next_id + 1
+        status = await message.answer(f"⏳ נכנס לתור Flux {variant.upper()}...", reply_markup=self._cancel_kb(job_id))
+        job = ImageJob(job_id, user_id, variant, prompt, seed, status)
+        self._jobs[job.id] = job
+        self._queues[variant].setdefault(job.user_id, deque()).append(job)
+        self._refresh_positions(variant)
+        self._pending[variant].release()
+        try:
+            return io.BytesIO(await job.future)
+        finally:
+            self._jobs.pop(job.id, None)
+            try:
+                await status.delete()
+            except Exception:
+                pass
+
+    def cancel(self, job_id: int, user_id: int) -> bool:
+        job = self._jobs.get(job_id)
+        if not job or job.user_id != user_id or job.future.done():
+            return False
+        queue = self._queues[job.variant].get(user_id)
+        if queue and job in queue:
+            queue.remove(job)
+            if not queue:
+                del self._queues[job.variant][user_id]
+            self._refresh_positions(job.variant)
+        # עבודה שכבר רצה ב-thread תסתיים, אבל התוצאה תיזרק
+        job.future.set_exception(ImageCancelled())
+        return True
+
+    def _next(self, variant: str) -> ImageJob | None:
+        users = self._queues[variant]
+        if not users:
+            return None
+        user_id, jobs = next(iter(users.items()))
+        job = jobs.popleft()
+        users.move_to_end(user_id)
+        if not jobs:
+            del users[user_id]
+        return job
+
+    async def _worker(self, variant: str):
+        loop = asyncio.get_running_loop()
+        free = self._free[variant]
+        while True:
+            # עבודה נשלפת רק כשיש thread פנוי, כך שה-timeout מודד יצירה ולא המתנה בתור של ה-pool
+            await free.acquire()
+            await self._pending[variant].acquire()
+            job = self._next(variant)
+            if job is None:
+                free.release()
+                continue
+            self._refresh_positions(variant)
+            await self._set_status(job, f"🎨 יוצר עם Flux {variant.upper()}...", True)
+            try:
+                running = self._executors[variant].submit(generate_flux_png, job.prompt, variant, job.seed)
+            except RuntimeError as e:  # pool נסגר
+                free.release()
+                if not job.future.done():
+                    job.future.set_exception(e)
+                continue
+            running.add_done_callback(lambda _: loop.is_closed() or loop.call_soon_threadsafe(free.release))
+            try:
+                png = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(running)), self.timeout)
+                if not job.future.done():
+                    job.future.set_result(png)
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+
+    def stats(self) -> dict:
+        return {v: sum(len(q) for q in users.values()) for v, users in self._queues.items()}
+
+image_queue = ImageQueue({"schnell": IMAGE_WORKERS_SCHNELL, "dev": IMAGE_WORKERS_DEV}, IMAGE_TIMEOUT)
+
+class ImageStore:
+    """מאגר תמונות לפי תוכן: מפתח = hash(prompt, variant, seed, size), תיקייה מוגבלת בגודל (LRU) + אינדקס ב-SQLite.
+    אחרי פינוי הקובץ נשארת שורת המטא-דאטה, כך שכפתורי "גרסה חדשה" ישנים עדיין עובדים"""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def key(prompt: str, variant: str, seed: int, size: int) -> str:
+        return hashlib.sha256(f"{variant}|{seed}|{size}|{prompt}".encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.png")
+
+    async def get(self, key: str) -> tuple[int, bytes] | None:
+        row = await db.fetchone("SELECT id, path FROM images WHERE key=?", (key,))
+        data = await asyncio.to_thread(read_file, row[1]) if row and row[1] else None
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        await db.execute("UPDATE images SET last_used=? WHERE id=?", (int(time.time()), row[0]))
+        return row[0], data
+
+    async def put(self, key: str, prompt: str, variant: str, seed: int, data: bytes) -> int:
+        path = self._path(key)
+        await asyncio.to_thread(write_file_atomic, path, data)
+        now = int(time.time())
+        await db.execute(
+            "INSERT INTO images (key, prompt, variant, seed, size, path, bytes, created_at, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET path=excluded.path, bytes=excluded.bytes, last_used=excluded.last_used",
+            (key, prompt, variant, seed, IMAGE_SIZE, path, len(data), now, now)
+        )
+        await self._evict()
+        return await db.fetchval("SELECT id FROM images WHERE key=?", (key,))
+
+    async def record(self, image_id: int) -> tuple[str, str, int] | None:
+        row = await db.fetchone("SELECT prompt, variant, seed FROM images WHERE id=?", (image_id,))
+        return tuple(row) if row else None
+
+    async def _evict(self):
+        total = await db.fetchval("SELECT COALESCE(SUM(bytes), 0) FROM images WHERE path IS NOT NULL", default=0)
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for image_id, path, size in await db.fetchall(
+            "SELECT id, path, bytes FROM images WHERE path IS NOT NULL ORDER BY last_used LIMIT 200"
+        ):
+            if total <= self.max_bytes:
+                break
+            victims.append((image_id, path))
+            total -= size
+        for _, path in victims:
+            try:
+                await asyncio.to_thread(os.remove, path)
+            except OSError:
+                pass
+        await db.executemany("UPDATE images SET path=NULL, bytes=0 WHERE id=?", [(i,) for i, _ in victims])
+
+image_store = ImageStore(IMAGE_CACHE_DIR, IMAGE_CACHE_MB * 1024 * 1024)
+
+async def get_image(message: types.Message, user_id: int, prompt: str, variant: str,
+                    seed: int = IMAGE_DEFAULT_SEED, hit: tuple[int, bytes] | bool | None = None) -> tuple[int, bytes]:
+    """מהדיסק אם כבר נוצרה תמונה זהה, אחרת דרך תור התמונות.
+    hit: תוצאת image_store.get אם הקורא כבר בדק (False = נבדק ואין), None = לבדוק כאן"""
+    key = image_store.key(prompt, variant, seed, IMAGE_SIZE)
+    if hit is None:
+        hit = await image_store.get(key)
+    if hit:
+        return hit
+    buf = await image_queue.submit(message, user_id, prompt, variant, seed)
+    data = buf.getvalue()
+    return await image_store.put(key, prompt, variant, seed, data), data
+
+def image_kb(image_id: int) -> list[InlineKeyboardButton]:
+    return [
+        InlineKeyboardButton(text="🔄 גרסה חדשה", callback_data=f"regen_new_{image_id}"),
+        InlineKeyboardButton(text="🖼 גרסה איכותית", callback_data=f"regen_dev_{image_id}"),
+    ]
+
+async def send_image(message: types.Message, user_id: int, prompt: str, variant: str,
+                     seed: int = IMAGE_DEFAULT_SEED, extra_buttons: list | None = None,
+                     hit: tuple[int, bytes] | bool | None = None):
+    try:
+        image_id, data = await get_image(message, user_id, prompt, variant, seed, hit)
+        await message.answer_photo(
+            types.BufferedInputFile(data, filename="flux.png"),
+            caption=f"🎨 Flux {variant.upper()}\n📝 {prompt}",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[image_kb(image_id) + (extra_buttons or [])])
+        )
+    except ImageCancelled:
+        await message.answer("✖️ יצירת התמונה בוטלה")
+    except asyncio.TimeoutError:
+        await message.answer("⌛ יצירת התמונה לקחה יותר מדי זמן")
+    except Exception as e:
+        logger.error(f"Flux error: {e}")
+        await message.answer("❌ שגיאה ביצירת תמונה")
 
 # ====================== KEYBOARDS ======================
 def main_menu_kb() -> InlineKeyboardMarkup:
@@ -372,6 +3153,192 @@ def after_reply_kb() -> InlineKeyboardMarkup:
         InlineKeyboardButton(text="🎤 השמע", callback_data="tts_last"),
     ]])
 
+# ====================== STREAMING ======================
+class StreamingReply:
+    """תשובה שמוצגת תוך כדי יצירה: הודעה ראשונה עם הטוקנים הראשונים, ואז עריכות מרוכזות ומרווחות"""
+
+    LIMIT = 4096
+
+    def __init__(self, message: types.Message, interval: float = 1.2):
+        self.message = message
+        self.interval = interval
+        self.text = ""
+        self._messages: list[types.Message] = []
+        self._shown: list[str] = []
+        self._next_flush = 0.0
+        self.first_token_at: float | None = None
+
+    def _chunks(self) -> list[str]:
+        # חיתוך בגודל קבוע שומר על יציבות ההודעות שכבר מלאות
+        return [self.text[i:i + self.LIMIT] for i in range(0, len(self.text), self.LIMIT)]
+
+    async def feed(self, delta: str):
+        if not delta:
+            return
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.text += delta
+        if time.monotonic() >= self._next_flush:
+            await self._flush()
+
+    async def _flush(self, reply_markup=None):
+        self._next_flush = time.monotonic() + self.interval
+        chunks = self._chunks()
+        for i, chunk in enumerate(chunks):
+            markup = reply_markup if i == len(chunks) - 1 else None
+            try:
+                if i >= len(self._messages):
+                    self._messages.append(await self.message.answer(chunk, reply_markup=markup))
+                    self._shown.append(chunk)
+                elif self._shown[i] != chunk or markup:
+                    await self._messages[i].edit_text(chunk, reply_markup=markup)
+                    self._shown[i] = chunk
+            except TelegramRetryAfter as e:
+                self._next_flush = time.monotonic() + e.retry_after
+                if reply_markup is None:
+                    return
+                await asyncio.sleep(e.retry_after)
+                return await self._flush(reply_markup)
+            except TelegramBadRequest as e:
+                if "not modified" not in str(e):
+                    raise
+
+    async def finish(self, reply_markup=None) -> str:
+        if not self.text:
+            raise ValueError("empty completion")
+        await self._flush(reply_markup)
+        return self.text
+
+async def stream_completion(message: types.Message, messages: list, max_tokens: int) -> str:
+    """Groq בסטרימינג אל StreamingReply. מחזיר את הטקסט המלא"""
+    started = time.perf_counter()
+    stream = await model_router.create(
+        messages=messages, max_tokens=max_tokens, temperature=0.7, stream=True
+    )
+    out = StreamingReply(message, STREAM_EDIT_INTERVAL)
+    async for chunk in stream:
+        if chunk.choices:
+            await out.feed(chunk.choices[0].delta.content or "")
+    reply = await out.finish(reply_markup=after_reply_kb())
+    if out.first_token_at:
+        logger.debug(f"Stream TTFT {(out.first_token_at - started) * 1000:.0f}ms, "
+                     f"total {(time.perf_counter() - started) * 1000:.0f}ms, {len(reply)} chars")
+    return reply
+
+class SentenceChunker:
+    """מפרק טקסט זורם למקטעים להקראה: המשפט הראשון לבד (כדי שהאודיו הראשון יגיע מהר),
+    ואחריו מקטעים של כמה משפטים עד max_len"""
+
+    BOUNDARY = re.compile(r"[.!?…\n]+[\"')\]]*\s+")
+
+    def __init__(self, target: int = 160, max_len: int = 400):
+        self.target = target
+        self.max_len = max_len
+        self._buffer = ""
+        self._pending = ""
+        self._emitted = 0
+
+    def _take(self) -> list[str]:
+        out = []
+        while True:
+            last = None
+            for m in self.BOUNDARY.finditer(self._buffer):
+                if len(self._pending) + m.end() > self.max_len and last is not None:
+                    break
+                last = m
+                if self._emitted == 0 or len(self._pending) + m.end() >= self.target:
+                    break
+            if last is None:
+                if len(self._pending) + len(self._buffer) > self.max_len:
+                    # אין גבול משפט בטווח: חותכים ברווח האחרון
+                    room = max(self.max_len - len(self._pending), 1)
+                    cut = self._buffer.rfind(" ", 0, room)
+                    cut = cut if cut > 0 else room
+                    out.append((self._pending + self._buffer[:cut]).strip())
+                    self._buffer, self._pending = self._buffer[cut:], ""
+                    self._emitted += 1
+                    continue
+                return [c for c in out if c]
+            self._pending += self._buffer[:last.end()]
+            self._buffer = self._buffer[last.end():]
+            if self._emitted == 0 or len(self._pending) >= self.target:
+                out.append(self._pending.strip())
+                self._pending = ""
+                self._emitted += 1
+
+    def feed(self, delta: str) -> list[str]:
+        self._buffer += delta
+        return self._take()
+
+    def flush(self) -> list[str]:
+        out = self._take()
+        rest = (self._pending + self._buffer).strip()
+        self._pending = self._buffer = ""
+        return out + ([rest] if rest else [])
+
+async def voice_reply_pipeline(message: types.Message, messages: list, max_tokens: int,
+                               send_after: asyncio.Task | None = None) -> str:
+    """LLM בסטרימינג -> מקטעי משפטים -> TTS במקביל (מוגבל) -> שליחה לפי הסדר ברגע שכל מקטע מוכן.
+    send_after: הודעה שצריכה להופיע לפני האודיו הראשון"""
+    started = time.perf_counter()
+    sem = asyncio.Semaphore(TTS_CONCURRENCY)
+    ready: asyncio.Queue = asyncio.Queue()
+
+    async def synth(chunk: str):
+        async with sem:
+            return await prepare_voice(chunk)
+
+    async def sender():
+        nonlocal send_after
+        first = True
+        while (item := await ready.get()) is not None:
+            chunk, task = item
+            prepared = await task
+            if send_after:
+                await send_after
+                send_after = None
+            if not prepared or not await deliver_voice(message, prepared, f"💬 {chunk[:200]}"):
+                await message.answer(chunk)
+            if first:
+                first = False
+                logger.debug(f"Voice first audio after {(time.perf_counter() - started) * 1000:.0f}ms")
+
+    synth_tasks: list[asyncio.Task] = []
+
+    def enqueue(chunks: list[str]):
+        if sender_task.done():
+            return  # השולח נפל - אין טעם לסנתז עוד מקטעים
+        for chunk in chunks:
+            task = asyncio.create_task(synth(chunk))
+            synth_tasks.append(task)
+            ready.put_nowait((chunk, task))
+
+    sender_task = asyncio.create_task(sender())
+    chunker = SentenceChunker()
+    reply = ""
+    try:
+        stream = await model_router.create(
+            messages=messages, max_tokens=max_tokens, temperature=0.7, stream=True
+        )
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                reply += delta
+                enqueue(chunker.feed(delta))
+        enqueue(chunker.flush())
+    finally:
+        ready.put_nowait(None)
+        try:
+            await sender_task
+        finally:
+            # אם השולח נכשל, סינתזות שכבר יצאו לדרך מבוטלות ונאספות (בלי "Task exception was never retrieved")
+            for task in synth_tasks:
+                task.cancel()
+            await asyncio.gather(*synth_tasks, return_exceptions=True)
+            if send_after:
+                await send_after
+    return reply
+
 # ====================== HANDLERS ======================
 @dp.message(Command("start"))
 async def start_handler(message: types.Message):
@@ -413,22 +3380,35 @@ async def process_image_prompt(message: types.Message, state: FSMContext):
     data = await state.get_data()
     variant = data.get("variant", "schnell")
     await state.clear()
-    prompt = message.text
-    await message.answer(f"🎨 יוצר עם Flux {variant.upper()}...")
-    try:
-        buf = await async_generate_flux(prompt, variant)
-        kb = InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text="🔄 גרסה חדשה", callback_data=f"regen_{variant}_{prompt[:30]}"),
-            InlineKeyboardButton(text="🖼 גרסה איכותית", callback_data=f"regen_dev_{prompt[:30]}"),
-        ]])
-        await message.answer_photo(
-            types.BufferedInputFile(buf.read(), filename="flux.png"),
-            caption=f"🎨 Flux {variant.upper()}\n📝 {prompt}",
-            reply_markup=kb
-        )
-    except Exception as e:
-        logger.error(f"Flux error: {e}")
-        await message.answer("❌ שגיאה ביצירת תמונה")
+    await send_image(message, message.from_user.id, message.text, variant)
+
+@dp.callback_query(F.data.startswith("regen_"))
+async def cb_regen(callback: CallbackQuery):
+    if not is_allowed(callback.from_user.id):
+        return await callback.answer("🔒 אין גישה")
+    # כפתורים מלפני המעבר ל-image_id נושאים regen_<variant>_<prompt>
+    parts = callback.data.split("_", 2)
+    if len(parts) != 3 or parts[1] not in ("new", "dev") or not parts[2].isdigit():
+        return await callback.answer("התמונה לא זמינה יותר", show_alert=True)
+    _, mode, image_id = parts
+    record = await image_store.record(int(image_id))
+    if not record:
+        return await callback.answer("התמונה לא זמינה יותר", show_alert=True)
+    prompt, variant, seed = record
+    if mode == "dev":
+        variant = "dev"
+    else:
+        seed = random.randint(1, 2**31 - 1)
+    hit = await image_store.get(image_store.key(prompt, variant, seed, IMAGE_SIZE)) or False
+    if not hit and not await check_rate(callback.from_user.id, "images", RATE_IMAGES, 3600):
+        return await callback.answer(f"⏳ מגבלה: {RATE_IMAGES} תמונות/שעה", show_alert=True)
+    await callback.answer()
+    await send_image(callback.message, callback.from_user.id, prompt, variant, seed, hit=hit)
+
+@dp.callback_query(F.data.startswith("img_cancel_"))
+async def cb_img_cancel(callback: CallbackQuery):
+    ok = image_queue.cancel(int(callback.data.rsplit("_", 1)[1]), callback.from_user.id)
+    await callback.answer("✖️ בוטל" if ok else "❌ כבר לא בתור")
 
 @dp.callback_query(F.data == "remind_mode")
 async def cb_remind(callback: CallbackQuery, state: FSMContext):
@@ -459,12 +3439,7 @@ async def cb_remind_time(callback: CallbackQuery, state: FSMContext):
     seconds = time_map.get(callback.data, 3600)
     remind_at = int(time.time()) + seconds
     await state.clear()
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute(
-            "INSERT INTO reminders (user_id, remind_at, text, created_at) VALUES (?, ?, ?, ?)",
-            (callback.from_user.id, remind_at, text, int(time.time()))
-        )
-        await db.commit()
+    await add_reminder(callback.from_user.id, remind_at, text)
     dt = datetime.fromtimestamp(remind_at).strftime('%d/%m %H:%M')
     await callback.message.answer(f"✅ תזכורת נקבעה:\n**{text}**\n⏰ {dt}")
     await callback.answer()
@@ -475,14 +3450,9 @@ async def remind_time_text(message: types.Message, state: FSMContext):
     text = data.get("text", "תזכורת")
     remind_at, _ = parse_reminder_time(message.text)
     if not remind_at:
-        return await message.answer("❌ לא הבנתי את הזמן. נסה: `2h`, `30m`, `18:30`")
+        return await message.answer("❌ לא הבנתי את הזמן. נסה: `2h`, `30m`, `18:30`, `מחר ב-9`")
     await state.clear()
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute(
-            "INSERT INTO reminders (user_id, remind_at, text, created_at) VALUES (?, ?, ?, ?)",
-            (message.from_user.id, remind_at, text, int(time.time()))
-        )
-        await db.commit()
+    await add_reminder(message.from_user.id, remind_at, text)
     dt = datetime.fromtimestamp(remind_at).strftime('%d/%m %H:%M')
     await message.answer(f"✅ תזכורת:\n**{text}**\n⏰ {dt}")
 
@@ -492,12 +3462,7 @@ async def cb_snooze(callback: CallbackQuery):
     r_id = parts[1]
     minutes = int(parts[2])
     new_time = int(time.time()) + minutes * 60
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute(
-            "INSERT INTO reminders (user_id, remind_at, text, created_at) VALUES (?, ?, ?, ?)",
-            (callback.from_user.id, new_time, "⏰ תזכורת נדחתה", int(time.time()))
-        )
-        await db.commit()
+    await add_reminder(callback.from_user.id, new_time, "⏰ תזכורת נדחתה")
     await callback.answer(f"⏰ נדחה ב-{minutes} דקות")
     await callback.message.edit_reply_markup(reply_markup=None)
 
@@ -510,12 +3475,10 @@ async def cb_done_reminder(callback: CallbackQuery):
 async def cb_show_notes(callback: CallbackQuery):
     if not is_allowed(callback.from_user.id):
         return
-    async with aiosqlite.connect(DB_FILE) as db:
-        async with db.execute(
-            "SELECT id, title, content, created_at FROM notes WHERE user_id=? ORDER BY created_at DESC LIMIT 10",
-            (callback.from_user.id,)
-        ) as cursor:
-            rows = await cursor.fetchall()
+    rows = await db.fetchall(
+        "SELECT id, title, content, created_at FROM notes WHERE user_id=? ORDER BY created_at DESC LIMIT 10",
+        (callback.from_user.id,)
+    )
     if not rows:
         await callback.answer("📭 אין פתקים", show_alert=True)
         return
@@ -532,12 +3495,10 @@ async def cb_show_notes(callback: CallbackQuery):
 async def cb_show_reminders(callback: CallbackQuery):
     if not is_allowed(callback.from_user.id):
         return
-    async with aiosqlite.connect(DB_FILE) as db:
-        async with db.execute(
-            "SELECT id, remind_at, text FROM reminders WHERE user_id=? ORDER BY remind_at",
-            (callback.from_user.id,)
-        ) as cursor:
-            rows = await cursor.fetchall()
+    rows = await db.fetchall(
+        "SELECT id, remind_at, text FROM reminders WHERE user_id=? ORDER BY remind_at",
+        (callback.from_user.id,)
+    )
     if not rows:
         await callback.answer("📭 אין תזכורות", show_alert=True)
         return
@@ -552,7 +3513,7 @@ async def cb_show_reminders(callback: CallbackQuery):
 async def cb_show_memory(callback: CallbackQuery):
     if not is_allowed(callback.from_user.id):
         return
-    facts = await get_user_facts(callback.from_user.id)
+    facts = await profiles.get(callback.from_user.id)
     if not facts:
         await callback.answer("🧠 לא נצברו עובדות עדיין", show_alert=True)
         return
@@ -566,20 +3527,14 @@ async def cb_show_memory(callback: CallbackQuery):
 async def cb_show_status(callback: CallbackQuery):
     if not is_allowed(callback.from_user.id):
         return
-    async with aiosqlite.connect(DB_FILE) as db:
-        async with db.execute("SELECT COUNT(*) FROM history WHERE user_id=?", (callback.from_user.id,)) as c:
-            msgs = (await c.fetchone())[0]
-        async with db.execute("SELECT COUNT(*) FROM reminders WHERE user_id=?", (callback.from_user.id,)) as c:
-            reminders = (await c.fetchone())[0]
-        async with db.execute("SELECT COUNT(*) FROM notes WHERE user_id=?", (callback.from_user.id,)) as c:
-            notes = (await c.fetchone())[0]
+    counts = await get_counters(callback.from_user.id)
     now_str = datetime.now().strftime('%d/%m/%Y %H:%M')
     await callback.message.answer(
         f"📊 **הסטטוס שלך:**\n"
-        f"• הודעות: {msgs:,}\n"
-        f"• תזכורות פעילות: {reminders}\n"
-        f"• פתקים: {notes}\n"
-        f"• מודל: `{active_model}`\n"
+        f"• הודעות: {counts['messages']:,}\n"
+        f"• תזכורות פעילות: {counts['reminders']}\n"
+        f"• פתקים: {counts['notes']}\n"
+        f"• מודל: `{model_router.best()}`\n"
         f"• שעה: {now_str}"
     )
     await callback.answer()
@@ -595,13 +3550,7 @@ async def cb_tts_last(callback: CallbackQuery):
     last_reply = next((m["content"] for m in reversed(history) if m["role"] == "assistant"), None)
     if not last_reply:
         return await callback.message.answer("❌ אין תשובה להשמיע")
-    audio = await text_to_voice(last_reply[:500])
-    if audio:
-        await callback.message.answer_voice(
-            types.BufferedInputFile(audio.read(), filename="reply.wav"),
-            caption="🔊 תשובה קולית"
-        )
-    else:
+    if not await send_voice_reply(callback.message, last_reply, "🔊 תשובה קולית"):
         await callback.message.answer("❌ שגיאה ביצירת קול")
 
 @dp.callback_query(F.data == "search_mode")
@@ -619,12 +3568,10 @@ async def cb_save_note(callback: CallbackQuery):
     last_reply = next((m["content"] for m in reversed(history) if m["role"] == "assistant"), None)
     if not last_reply:
         return await callback.answer("❌ אין מה לשמור", show_alert=True)
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute(
-            "INSERT INTO notes (user_id, title, content, created_at) VALUES (?, ?, ?, ?)",
-            (callback.from_user.id, f"תשובה {datetime.now().strftime('%d/%m %H:%M')}", last_reply[:500], int(time.time()))
-        )
-        await db.commit()
+    await db.insert(
+        "INSERT INTO notes (user_id, title, content, created_at) VALUES (?, ?, ?, ?)",
+        (callback.from_user.id, f"תשובה {datetime.now().strftime('%d/%m %H:%M')}", last_reply[:500], int(time.time()))
+    )
     await callback.answer("✅ נשמר כפתק!")
 
 # ====================== VOICE HANDLER ======================
@@ -646,34 +3593,34 @@ async def voice_handler(message: types.Message):
         if not text:
             return await message.answer("❌ לא הצלחתי לתמלל. נסה שוב.")
 
-        await message.answer(f"🎤 **שמעתי:** {text}")
+        # ההדהוד נשלח ברקע כדי לא לעכב את תחילת התשובה
+        echo = asyncio.create_task(message.answer(f"🎤 **שמעתי:** {text}"))
 
         # תשובה מה-AI
-        history = await get_history(message.from_user.id)
+        history = await get_history(message.from_user.id, limit=PROMPT_HISTORY_TURNS)
         now_str = datetime.now().strftime('%d/%m/%Y %H:%M')
-        messages = [{"role": "system", "content": f"""אתה הבוט האישי של אביאל - איש IT ואוטומציה מישראל.
+        system = f"""אתה הבוט האישי של אביאל - איש IT ואוטומציה מישראל.
 אופי: ציני, ישיר, לא מבזבז מילים. הומור יבש וסארקזם במינון נכון.
 מומחיות: IT, Windows/Active Directory, Python, אוטומציה, AI, טלגרם בוטים, ענן.
 השעה: {now_str}. עברית בלבד. תשובות קצרות וממוקדות.
-אל תתחיל ב"בהחלט!" / "כמובן!" / "שאלה מצוינת!""""}
-        ] + history + [{"role": "user", "content": text}]
+אל תתחיל ב"בהחלט!" / "כמובן!" / "שאלה מצוינת!\""""
+        messages = prompt_builder.build(message.from_user.id, system, text, history, model_router.best(), max_tokens=400)
+        await save_message(message.from_user.id, "user", f"[קולי] {text}")
 
-        response = await groq_client.chat.completions.create(
-            model=active_model, messages=messages, max_tokens=400, temperature=0.7
-        )
-        reply = response.choices[0].message.content
-
-        # שלח תשובה קולית
-        audio_reply = await text_to_voice(reply)
-        if audio_reply:
-            await message.answer_voice(
-                types.BufferedInputFile(audio_reply.read(), filename="reply.wav"),
-                caption=f"💬 {reply[:200]}{'...' if len(reply) > 200 else ''}"
-            )
+        if VOICE_PIPELINE:
+            reply = await voice_reply_pipeline(message, messages, max_tokens=400, send_after=echo)
         else:
-            await message.answer(reply, reply_markup=after_reply_kb())
+            response = await model_router.create(
+                messages=messages, max_tokens=400, temperature=0.7
+            )
+            reply = response.choices[0].message.content
+            await echo
+
+            # שלח תשובה קולית
+            caption = f"💬 {reply[:200]}{'...' if len(reply) > 200 else ''}"
+            if not await send_voice_reply(message, reply, caption):
+                await message.answer(reply, reply_markup=after_reply_kb())
 
-        await save_message(message.from_user.id, "user", f"[קולי] {text}")
         await save_message(message.from_user.id, "assistant", reply)
 
     except Exception as e:
@@ -687,17 +3634,13 @@ async def remind_handler(message: types.Message, command: CommandObject):
         return
     if not command.args:
         return await message.answer(
-            "❓ שימוש:\n`/remind 2h לקנות חלב`\n`/remind 18:30 פגישה`\n`/remind 1d חידוש מנוי`"
+            "❓ שימוש:\n`/remind 2h לקנות חלב`\n`/remind 18:30 פגישה`\n`/remind 1d חידוש מנוי`\n"
+            "`/remind מחר ב-9 להתקשר`\n`/remind יום שני 10:15 ישיבה`\n`/remind 25/12 מתנה`"
         )
     remind_at, text = parse_reminder_time(command.args)
     if not remind_at:
         return await message.answer("❌ לא הבנתי את הזמן")
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute(
-            "INSERT INTO reminders (user_id, remind_at, text, created_at) VALUES (?, ?, ?, ?)",
-            (message.from_user.id, remind_at, text, int(time.time()))
-        )
-        await db.commit()
+    await add_reminder(message.from_user.id, remind_at, text)
     dt = datetime.fromtimestamp(remind_at).strftime('%d/%m/%Y %H:%M')
     await message.answer(f"✅ **תזכורת:**\n📝 {text}\n⏰ {dt}")
 
@@ -705,12 +3648,10 @@ async def remind_handler(message: types.Message, command: CommandObject):
 async def reminders_handler(message: types.Message):
     if not is_allowed(message.from_user.id):
         return
-    async with aiosqlite.connect(DB_FILE) as db:
-        async with db.execute(
-            "SELECT id, remind_at, text FROM reminders WHERE user_id=? ORDER BY remind_at",
-            (message.from_user.id,)
-        ) as cursor:
-            rows = await cursor.fetchall()
+    rows = await db.fetchall(
+        "SELECT id, remind_at, text FROM reminders WHERE user_id=? ORDER BY remind_at",
+        (message.from_user.id,)
+    )
     if not rows:
         return await message.answer("📭 אין תזכורות פעילות")
     lines = ["⏰ **תזכורות:**\n"]
@@ -725,10 +3666,41 @@ async def delremind_handler(message: types.Message, command: CommandObject):
     if not is_allowed(message.from_user.id) or not command.args or not command.args.strip().isdigit():
         return await message.answer("❓ `/delremind <מספר>`")
     r_id = int(command.args.strip())
-    async with aiosqlite.connect(DB_FILE) as db:
-        result = await db.execute("DELETE FROM reminders WHERE id=? AND user_id=?", (r_id, message.from_user.id))
-        await db.commit()
-    await message.answer(f"{'✅ נמחק' if result.rowcount else '❌ לא נמצא'}")
+    deleted = await db.execute("DELETE FROM reminders WHERE id=? AND user_id=?", (r_id, message.from_user.id))
+    if deleted:
+        reminder_scheduler.remove(r_id)
+    await message.answer(f"{'✅ נמחק' if deleted else '❌ לא נמצא'}")
+
+@dp.message(Command("digest"))
+async def digest_handler(message: types.Message, command: CommandObject):
+    if not is_allowed(message.from_user.id):
+        return
+    uid = message.from_user.id
+    args = (command.args or "").split()
+    if args[:1] == ["off"]:
+        await digests.set_prefs(uid, enabled=False)
+    elif args[:1] == ["on"]:
+        await digests.set_prefs(uid, enabled=True)
+    elif args[:1] == ["tz"] and len(args) == 2:
+        try:
+            ZoneInfo(args[1])
+        except (ZoneInfoNotFoundError, ValueError):
+            return await message.answer("❌ אזור זמן לא מוכר. דוגמה: `Asia/Jerusalem`")
+        await digests.set_prefs(uid, tz=args[1])
+    elif len(args) == 1 and (m := re.fullmatch(r"(\d{1,2}):(\d{2})", args[0])) \
+            and int(m.group(1)) < 24 and int(m.group(2)) < 60:
+        await digests.set_prefs(uid, hour=int(m.group(1)), minute=int(m.group(2)))
+    elif args:
+        return await message.answer("❓ `/digest 07:30` | `/digest tz Europe/London` | `/digest on|off`")
+    tz, hour, minute, enabled = digests.prefs(uid)
+    if not enabled:
+        return await message.answer("🔕 סיכום הבוקר כבוי (`/digest on` להפעלה)")
+    at = datetime.fromtimestamp(digests.next_fire(tz, hour, minute, time.time()), digests.zone(tz))
+    await message.answer(
+        f"☀️ סיכום בוקר ב-{hour:02d}:{minute:02d} ({tz or 'שעון השרת'})\n"
+        f"הבא: {at.strftime('%d/%m %H:%M')}\n\n"
+        f"`/digest 07:30` | `/digest tz Europe/London` | `/digest off`"
+    )
 
 @dp.message(Command("note"))
 async def note_handler(message: types.Message, command: CommandObject):
@@ -736,22 +3708,18 @@ async def note_handler(message: types.Message, command: CommandObject):
         return await message.answer("❓ `/note כותרת | תוכן`")
     parts = command.args.split("|", 1)
     title, content = parts[0].strip(), parts[1].strip() if len(parts) > 1 else ""
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute("INSERT INTO notes (user_id, title, content, created_at) VALUES (?, ?, ?, ?)",
-            (message.from_user.id, title, content, int(time.time())))
-        await db.commit()
+    await db.insert("INSERT INTO notes (user_id, title, content, created_at) VALUES (?, ?, ?, ?)",
+        (message.from_user.id, title, content, int(time.time())))
     await message.answer(f"📝 פתק נשמר: **{title}**")
 
 @dp.message(Command("notes"))
 async def notes_handler(message: types.Message):
     if not is_allowed(message.from_user.id):
         return
-    async with aiosqlite.connect(DB_FILE) as db:
-        async with db.execute(
-            "SELECT id, title, content, created_at FROM notes WHERE user_id=? ORDER BY created_at DESC LIMIT 20",
-            (message.from_user.id,)
-        ) as cursor:
-            rows = await cursor.fetchall()
+    rows = await db.fetchall(
+        "SELECT id, title, content, created_at FROM notes WHERE user_id=? ORDER BY created_at DESC LIMIT 20",
+        (message.from_user.id,)
+    )
     if not rows:
         return await message.answer("📭 אין פתקים")
     lines = ["📋 **פתקים:**\n"]
@@ -767,62 +3735,76 @@ async def delnote_handler(message: types.Message, command: CommandObject):
     if not is_allowed(message.from_user.id) or not command.args or not command.args.strip().isdigit():
         return await message.answer("❓ `/delnote <מספר>`")
     n_id = int(command.args.strip())
-    async with aiosqlite.connect(DB_FILE) as db:
-        result = await db.execute("DELETE FROM notes WHERE id=? AND user_id=?", (n_id, message.from_user.id))
-        await db.commit()
-    await message.answer(f"{'✅ נמחק' if result.rowcount else '❌ לא נמצא'}")
+    deleted = await db.execute("DELETE FROM notes WHERE id=? AND user_id=?", (n_id, message.from_user.id))
+    await message.answer(f"{'✅ נמחק' if deleted else '❌ לא נמצא'}")
+
+async def find_page(user_id: int, query: str, page: int) -> tuple[str, InlineKeyboardMarkup | None]:
+    total, rows = await search_notes(user_id, query, FIND_PAGE_SIZE, page * FIND_PAGE_SIZE)
+    if not rows:
+        return f"🔍 לא נמצא: `{query}`", None
+    pages = (total + FIND_PAGE_SIZE - 1) // FIND_PAGE_SIZE
+    lines = [f"🔍 **תוצאות עבור '{query}'** ({total}, עמוד {page + 1}/{pages}):\n"]
+    for n_id, title, snippet in rows:
+        lines.append(f"• `#{n_id}` **{title}**\n  {snippet or ''}")
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="◀️ הקודם", callback_data=f"find_{page - 1}"))
+    if page + 1 < pages:
+        nav.append(InlineKeyboardButton(text="הבא ▶️", callback_data=f"find_{page + 1}"))
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
 
 @dp.message(Command("find"))
-async def find_handler(message: types.Message, command: CommandObject):
+async def find_handler(message: types.Message, command: CommandObject, state: FSMContext):
     if not is_allowed(message.from_user.id) or not command.args:
         return await message.answer("❓ `/find <מילה>`")
     query = command.args.strip()
-    async with aiosqlite.connect(DB_FILE) as db:
-        async with db.execute(
-            "SELECT id, title, content FROM notes WHERE user_id=? AND (title LIKE ? OR content LIKE ?)",
-            (message.from_user.id, f"%{query}%", f"%{query}%")
-        ) as cursor:
-            rows = await cursor.fetchall()
-    if not rows:
-        return await message.answer(f"🔍 לא נמצא: `{query}`")
-    lines = [f"🔍 **תוצאות עבור '{query}':**\n"]
-    for n_id, title, content in rows:
-        preview = content[:60] + "..." if content and len(content) > 60 else content or ""
-        lines.append(f"• `#{n_id}` **{title}**\n  {preview}")
-    await message.answer("\n".join(lines))
+    await state.update_data(find_query=query)
+    text, markup = await find_page(message.from_user.id, query, 0)
+    await message.answer(text, reply_markup=markup)
+
+@dp.callback_query(F.data.startswith("find_"))
+async def cb_find_page(callback: CallbackQuery, state: FSMContext):
+    if not is_allowed(callback.from_user.id):
+        return
+    query = (await state.get_data()).get("find_query")
+    if not query:
+        return await callback.answer("❌ החיפוש פג, שלח /find שוב", show_alert=True)
+    text, markup = await find_page(callback.from_user.id, query, int(callback.data.split("_")[1]))
+    await callback.message.edit_text(text, reply_markup=markup)
+    await callback.answer()
 
 @dp.message(Command("export"))
-async def export_handler(message: types.Message):
+async def export_handler(message: types.Message, command: CommandObject):
     if not is_allowed(message.from_user.id):
         return
-    async with aiosqlite.connect(DB_FILE) as db:
-        async with db.execute("SELECT title, content, created_at FROM notes WHERE user_id=? ORDER BY created_at DESC", (message.from_user.id,)) as c:
-            notes = await c.fetchall()
-        async with db.execute("SELECT remind_at, text FROM reminders WHERE user_id=? ORDER BY remind_at", (message.from_user.id,)) as c:
-            reminders = await c.fetchall()
-    lines = [f"# הייצוא של {BOT_NAME}\n", f"תאריך: {datetime.now().strftime('%d/%m/%Y %H:%M')}\n"]
-    if notes:
-        lines.append("\n## פתקים\n")
-        for title, content, ts in notes:
-            dt = datetime.fromtimestamp(ts).strftime('%d/%m/%Y')
-            lines.append(f"### {title} ({dt})\n{content or ''}\n")
-    if reminders:
-        lines.append("\n## תזכורות פעילות\n")
-        for remind_at, text in reminders:
-            dt = datetime.fromtimestamp(remind_at).strftime('%d/%m/%Y %H:%M')
-            lines.append(f"- {dt}: {text}\n")
-    buf = io.BytesIO("\n".join(lines).encode('utf-8'))
-    buf.seek(0)
-    await message.answer_document(
-        types.BufferedInputFile(buf.read(), filename=f"export_{datetime.now().strftime('%Y%m%d')}.md"),
-        caption="📤 הייצוא שלך"
-    )
+    fmt = (command.args or "md").strip().lower()
+    if fmt not in ExportBuilder.FORMATS:
+        return await message.answer("❓ `/export` (Markdown) | `/export jsonl` | `/export zip`")
+    status = await message.answer("📦 מכין ייצוא...")
+    out = None
+    try:
+        out = await export_user(message.from_user.id, fmt)
+        stamp = datetime.now().strftime('%Y%m%d')
+        total = len(out.parts)
+        for i, part in enumerate(out.parts, 1):
+            suffix = f".part{i}of{total}" if total > 1 else ""
+            await message.answer_document(
+                SpooledInputFile(part, filename=f"export_{stamp}{suffix}.{fmt}"),
+                caption=f"📤 הייצוא שלך ({out.rows:,} רשומות)" + (f" – חלק {i}/{total}" if total > 1 else "")
+            )
+        await status.delete()
+    except Exception as e:
+        logger.error(f"Export error: {e}")
+        await status.edit_text("❌ הייצוא נכשל")
+    finally:
+        for part in out.parts if out else ():
+            part.close()
 
 @dp.message(Command("memory"))
 async def memory_handler(message: types.Message):
     if not is_allowed(message.from_user.id):
         return
-    facts = await get_user_facts(message.from_user.id)
+    facts = await profiles.get(message.from_user.id)
     if not facts:
         return await message.answer("🧠 לא נצברו עובדות עדיין.\nאמור לי דברים עליך ואזכור.")
     lines = ["🧠 **מה שזכרתי עליך:**\n"]
@@ -835,29 +3817,40 @@ async def memory_handler(message: types.Message):
 async def clearmemory_handler(message: types.Message):
     if not is_allowed(message.from_user.id):
         return
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute("DELETE FROM user_memory WHERE user_id=?", (message.from_user.id,))
-        await db.commit()
+    await write_behind.discard(message.from_user.id, history=False)
+    profiles.forget(message.from_user.id)
+    await db.execute("DELETE FROM user_facts WHERE user_id=?", (message.from_user.id,))
     await message.answer("✅ הזיכרון נוקה")
 
 @dp.message(Command("model"))
 async def model_handler(message: types.Message):
     if not is_allowed(message.from_user.id):
         return
-    await message.answer(f"🤖 מודל פעיל: `{active_model}`\n\nבודק...")
-    best = await get_best_model()
+    await message.answer(f"🤖 מודל מועדף: `{model_router.best()}`\n\nבודק את כל המודלים...")
+    best = await model_router.probe()
+    icons = {"closed": "🟢", "half-open": "🟡", "open": "🔴"}
+    lines = []
+    for st in model_router.stats():
+        latency = f"{st['latency_ms']}ms" if st["latency_ms"] is not None else "—"
+        line = f"{icons[st['state']]}{' ✅' if st['model'] == best else ''} `{st['model']}`\n" \
+               f"    {latency}, שגיאות {st['error_rate']:.0%} ({st['samples']} דגימות)"
+        if st["retry_in"]:
+            line += f", חסום עוד {st['retry_in']}s ({st['last_error']})"
+        lines.append(line)
     await message.answer(
-        f"✅ מודל עדכני: `{best}`\n\n" +
-        "\n".join([f"{'✅' if m == best else '⬜'} `{m}`" for m in GROQ_MODELS])
+        f"✅ מודל מועדף: `{best}`\n\n" + "\n".join(lines) +
+        f"\n\nמעברים בין מודלים: {model_router.failovers}"
     )
 
 @dp.message(Command("clear"))
 async def clear_handler(message: types.Message):
     if not is_allowed(message.from_user.id):
         return
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute("DELETE FROM history WHERE user_id=?", (message.from_user.id,))
-        await db.commit()
+    await write_behind.discard(message.from_user.id, facts=False)
+    history_cache.invalidate(message.from_user.id)
+    prompt_builder.forget(message.from_user.id)
+    recall_memory.forget(message.from_user.id)
+    await db.execute("DELETE FROM history WHERE user_id=?", (message.from_user.id,))
     await message.answer("✅ היסטוריה נוקתה")
 
 @dp.message(Command("myid"))
@@ -872,11 +3865,12 @@ async def myid_handler(message: types.Message):
 async def search_handler(message: types.Message):
     if not is_allowed(message.from_user.id):
         return await message.answer("🔒 אין גישה")
-    if not await check_rate(message.from_user.id, "search", RATE_SEARCH, 3600):
-        return await message.answer(f"⏳ מגבלה: {RATE_SEARCH} חיפושים/שעה")
     query = message.text.replace("/search", "").strip()
     if not query:
         return await message.answer("❓ `/search <שאילתה>`")
+    if not await search_cache.is_free(query) and \
+            not await check_rate(message.from_user.id, "search", RATE_SEARCH, 3600):
+        return await message.answer(f"⏳ מגבלה: {RATE_SEARCH} חיפושים/שעה")
     await bot.send_chat_action(message.chat.id, "typing")
     result = await async_web_search(query)
     await message.answer(result, reply_markup=after_reply_kb())
@@ -885,26 +3879,18 @@ async def search_handler(message: types.Message):
 async def flux_handler(message: types.Message):
     if not is_allowed(message.from_user.id):
         return await message.answer("🔒 אין גישה")
-    if not await check_rate(message.from_user.id, "images", RATE_IMAGES, 3600):
-        return await message.answer(f"⏳ מגבלה: {RATE_IMAGES} תמונות/שעה")
     variant = "dev" if message.text.startswith("/fluxdev") else "schnell"
     prompt = message.text.replace(f"/{message.text.split()[0][1:]}", "").strip()
     if not prompt:
         return await message.answer("❓ `/flux <תיאור>`")
-    await bot.send_chat_action(message.chat.id, "upload_photo")
-    try:
-        buf = await async_generate_flux(prompt, variant)
-        kb = InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text="🔄 נסה שוב", callback_data=f"img_{variant}"),
-        ]])
-        await message.answer_photo(
-            types.BufferedInputFile(buf.read(), filename="flux.png"),
-            caption=f"🎨 Flux {variant.upper()}\n📝 {prompt}",
-            reply_markup=kb
-        )
-    except Exception as e:
-        logger.error(f"Flux error: {e}")
-        await message.answer("❌ שגיאה ביצירת תמונה")
+    # בקשה זהה שכבר במטמון לא עולה מהמכסה (כמו ב-cb_regen)
+    hit = await image_store.get(image_store.key(prompt, variant, IMAGE_DEFAULT_SEED, IMAGE_SIZE)) or False
+    if not hit and not await check_rate(message.from_user.id, "images", RATE_IMAGES, 3600):
+        return await message.answer(f"⏳ מגבלה: {RATE_IMAGES} תמונות/שעה")
+    await send_image(
+        message, message.from_user.id, prompt, variant,
+        extra_buttons=[InlineKeyboardButton(text="🔄 נסה שוב", callback_data=f"img_{variant}")], hit=hit
+    )
 
 # ====================== ADMIN ======================
 @dp.message(Command("admin"))
@@ -913,32 +3899,52 @@ async def admin_panel(message: types.Message):
         return
     await message.answer(
         "🔧 **פאנל מנהל:**\n\n"
-        "• `/stats` – סטטיסטיקות\n"
+        "• `/stats` – סטטיסטיקות (`/stats rebuild` – ספירה מחדש)\n"
         "• `/ban <ID>` – חסום\n"
         "• `/unban <ID>` – שחרר\n"
         "• `/broadcast <הודעה>` – שלח לכולם\n"
+        "• `/broadcasts` – מצב שידורים\n"
         "• `/model` – בדוק מודל\n"
+        "• `/vacuum` – המרה חד-פעמית לשחרור מקום הדרגתי\n"
+        "• `/backup` – גיבוי עכשיו | `/backup list`\n"
+        "• `/backup verify <קובץ>` – בדיקת גיבוי\n"
+        "• `/restore <קובץ> CONFIRM` – שחזור\n"
         "• `/wipeall CONFIRM` – מחק הכל"
     )
 
 @dp.message(Command("stats"))
-async def stats_handler(message: types.Message):
+async def stats_handler(message: types.Message, command: CommandObject):
     if message.from_user.id not in ADMIN_IDS:
         return
-    async with aiosqlite.connect(DB_FILE) as db:
-        async with db.execute("SELECT COUNT(*) FROM history") as c:
-            total = (await c.fetchone())[0]
-        async with db.execute("SELECT COUNT(DISTINCT user_id) FROM history") as c:
-            users = (await c.fetchone())[0]
-        async with db.execute("SELECT COUNT(*) FROM reminders") as c:
-            reminders = (await c.fetchone())[0]
-        async with db.execute("SELECT COUNT(*) FROM notes") as c:
-            notes = (await c.fetchone())[0]
+    if (command.args or "").strip() == "rebuild":
+        drift = await reconcile_counters()
+        await message.answer(f"🔁 המונים נבנו מחדש ({drift} תוקנו)")
+    counts = await get_counters()
+    cache = history_cache.stats()
+    prompts = prompt_builder.stats()
+    searches = search_cache.stats()
+    recall = recall_memory.stats()
+    profile = profiles.stats()
     await message.answer(
         f"📈 **סטטיסטיקות:**\n"
-        f"• הודעות: {total:,}\n• משתמשים: {users}\n"
-        f"• תזכורות: {reminders}\n• פתקים: {notes}\n"
-        f"• מודל: `{active_model}`"
+        f"• הודעות: {counts['messages']:,}\n• משתמשים: {counts['users']}\n"
+        f"• תזכורות: {counts['reminders']}\n• פתקים: {counts['notes']}\n"
+        f"• מודל: `{model_router.best()}`\n"
+        f"• מטמון שיחות: {cache['users']} משתמשים, {cache['bytes'] // 1024}KB, "
+        f"פגיעות {cache['hit_rate']:.0%} ({cache['hits']}/{cache['hits'] + cache['misses']})\n"
+        f"• פרומפטים: {prompts['requests']}, ממוצע ~{prompts['avg']} טוקנים, "
+        f"מקס' ~{prompts['max']}, קוצרו {prompts['trimmed']}\n"
+        f"• מטמון חיפוש: {searches['entries']} שאילתות, פגיעות {searches['hits']}, "
+        f"הצטרפו {searches['joined']}, החטאות {searches['misses']}\n"
+        f"• מגביל קצב: {len(rate_limiter)} חלונות פעילים\n"
+        f"• זיכרון ארוך: {recall['users']} משתמשים, {recall['turns']:,} תורות, "
+        f"{recall['mb']:.1f}MB, חיפוש ~{recall['avg_ms']:.1f}ms\n"
+        f"• פרופילים: {profile['users']} במטמון, עובדות נכתבו {profile['writes']}, "
+        f"ללא שינוי {profile['unchanged']}"
+        + (f"\n• ניקוי אחרון: {run['deleted']:,} הודעות ב-{run['batches']} אצוות, "
+           f"p50 {run['p50_ms']:.0f}ms, מקס' {run['max_ms']:.0f}ms" if (run := retention.last_run) else "")
+        + (f"\n• גיבוי אחרון: `{os.path.basename(last['path'])}` {last['bytes'] // 1024:,}KB "
+           f"ב-{last['sec']:.1f}s" if (last := backups.last) else "")
     )
 
 @dp.message(Command("ban"))
@@ -949,9 +3955,7 @@ async def ban_handler(message: types.Message, command: CommandObject):
         uid = int(command.args.strip())
         if uid in ADMIN_IDS:
             return await message.answer("❌ לא ניתן לחסום מנהל")
-        async with aiosqlite.connect(DB_FILE) as db:
-            await db.execute("INSERT OR IGNORE INTO bans VALUES (?)", (uid,))
-            await db.commit()
+        await db.execute("INSERT OR IGNORE INTO bans VALUES (?)", (uid,))
         banned.add(uid)
         await message.answer(f"🚫 {uid} נחסם")
     except ValueError:
@@ -963,9 +3967,7 @@ async def unban_handler(message: types.Message, command: CommandObject):
         return
     try:
         uid = int(command.args.strip())
-        async with aiosqlite.connect(DB_FILE) as db:
-            await db.execute("DELETE FROM bans WHERE user_id=?", (uid,))
-            await db.commit()
+        await db.execute("DELETE FROM bans WHERE user_id=?", (uid,))
         banned.discard(uid)
         await message.answer(f"✅ {uid} שוחרר")
     except ValueError:
@@ -975,35 +3977,133 @@ async def unban_handler(message: types.Message, command: CommandObject):
 async def broadcast_handler(message: types.Message, command: CommandObject):
     if message.from_user.id not in ADMIN_IDS or not command.args:
         return
-    async with aiosqlite.connect(DB_FILE) as db:
-        async with db.execute("SELECT DISTINCT user_id FROM history") as cursor:
-            users = [r[0] for r in await cursor.fetchall()]
-    sent = failed = 0
-    for uid in users:
-        if uid in banned or uid in ADMIN_IDS:
-            continue
+    status = await message.answer("📢 מתחיל שידור...")
+    await broadcaster.start(command.args, status.chat.id, status.message_id)
+
+@dp.message(Command("broadcasts"))
+async def broadcasts_handler(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    jobs = await broadcaster.list_jobs()
+    if not jobs:
+        return await message.answer("📭 אין שידורים")
+    icons = {"running": "⏳", "done": "✅", "cancelled": "🛑"}
+    lines = ["📢 **שידורים אחרונים:**\n"]
+    for job_id, status, total, sent, failed, created_at in jobs:
+        dt = datetime.fromtimestamp(created_at).strftime('%d/%m %H:%M')
+        lines.append(f"{icons.get(status, '•')} `#{job_id}` [{dt}] {sent + failed}/{total} (נכשל: {failed})")
+    lines.append("\nלביטול: `/bccancel <מספר>`")
+    await message.answer("\n".join(lines))
+
+@dp.message(Command("bccancel"))
+async def bccancel_handler(message: types.Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    if not command.args or not command.args.strip().isdigit():
+        return await message.answer("❓ `/bccancel <מספר>`")
+    ok = broadcaster.cancel(int(command.args.strip()))
+    await message.answer("🛑 מבטל..." if ok else "❌ אין שידור פעיל כזה")
+
+@dp.callback_query(F.data.startswith("bc_cancel_"))
+async def cb_broadcast_cancel(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        return await callback.answer("🔒 אין גישה")
+    ok = broadcaster.cancel(int(callback.data.rsplit("_", 1)[1]))
+    await callback.answer("🛑 מבטל..." if ok else "❌ השידור כבר הסתיים")
+
+async def reset_memory_state():
+    """איפוס כל מה שמוחזק בזיכרון מעל ה-DB (אחרי מחיקה גורפת או שחזור)"""
+    await write_behind.discard()
+    history_cache.invalidate()
+    prompt_builder.forget()
+    recall_memory.forget()
+    profiles.forget()
+    reminder_scheduler.clear()
+    banned.clear()
+    rate_limiter.clear()
+
+@dp.message(Command("vacuum"))
+async def vacuum_handler(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    status = await message.answer("🧹 ממיר (VACUUM מלא, הכתיבות ממתינות עד הסוף)...")
+    try:
+        result = await retention.enable_incremental()
+    except Exception as e:
+        logger.error(f"Vacuum error: {e}")
+        return await status.edit_text(f"❌ ההמרה נכשלה: {e}")
+    if not result["converted"]:
+        return await status.edit_text("✅ ה-DB כבר במצב incremental")
+    await status.edit_text(
+        f"✅ הומר ב-{result['sec']:.1f}s ({result['before_mb']:.0f}MB → {result['after_mb']:.0f}MB)"
+    )
+
+@dp.message(Command("backup"))
+async def backup_handler(message: types.Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = (command.args or "").split()
+    if args[:1] == ["list"]:
+        names = backups.list()
+        if not names:
+            return await message.answer("📭 אין גיבויים")
+        return await message.answer("🗄 **גיבויים:**\n" + "\n".join(f"`{n}`" for n in names[:30]))
+    if args[:1] == ["verify"] and len(args) == 2:
         try:
-            await bot.send_message(uid, f"📢 {command.args}")
-            sent += 1
-        except Exception:
-            failed += 1
-        if sent % 20 == 0:
-            await asyncio.sleep(1)
-    await message.answer(f"✅ נשלח: {sent} | נכשל: {failed}")
+            counts = await backups.verify(args[1])
+        except FileNotFoundError:
+            return await message.answer("❌ אין גיבוי כזה")
+        except Exception as e:
+            return await message.answer(f"❌ הגיבוי פגום: {e}")
+        return await message.answer("✅ הגיבוי תקין:\n" + "\n".join(f"• {t}: {n:,}" for t, n in counts.items()))
+    status = await message.answer("🗄 מגבה...")
+    try:
+        path = await backups.create("manual")
+    except Exception as e:
+        logger.error(f"Backup error: {e}")
+        return await status.edit_text("❌ הגיבוי נכשל")
+    last = backups.last
+    await status.edit_text(
+        f"✅ `{os.path.basename(path)}`\n{last['raw_bytes'] // 1024:,}KB → {last['bytes'] // 1024:,}KB, "
+        f"{last['steps']} צעדים, {last['sec']:.1f}s"
+    )
+
+@dp.message(Command("restore"))
+async def restore_handler(message: types.Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = (command.args or "").split()
+    if len(args) != 2 or args[1].upper() != "CONFIRM":
+        return await message.answer("⚠️ לשחזור: `/restore <קובץ> CONFIRM` (רשימה: `/backup list`)")
+    status = await message.answer("♻️ בודק ומשחזר...")
+    try:
+        safety = await backups.restore(args[0])
+    except FileNotFoundError:
+        return await status.edit_text("❌ אין גיבוי כזה")
+    except Exception as e:
+        logger.error(f"Restore error: {e}")
+        return await status.edit_text(f"❌ השחזור נכשל, ה-DB לא שונה: {e}")
+    await reset_memory_state()
+    await init_db()  # גיבוי ישן יותר עשוי לחסור טבלאות/טריגרים חדשים
+    await reconcile_counters()
+    await load_bans()
+    await reminder_scheduler.load()
+    await digests.load()
+    if RATE_PERSIST:
+        await rate_limiter.restore()
+    await status.edit_text(f"✅ שוחזר מ-`{args[0]}`\nהמצב הקודם נשמר ב-`{os.path.basename(safety)}`")
 
 @dp.message(Command("wipeall"))
 async def wipeall_handler(message: types.Message, command: CommandObject):
     if message.from_user.id not in ADMIN_IDS:
         return
     if command.args and command.args.strip().upper() == "CONFIRM":
-        backup = await backup_before_wipe()
-        async with aiosqlite.connect(DB_FILE) as db:
-            for table in ["history", "bans", "reminders", "notes", "user_memory"]:
-                await db.execute(f"DELETE FROM {table}")
-            await db.commit()
-        banned.clear()
-        rate_limit.clear()
-        await message.answer(f"✅ הכל נמחק. גיבוי: `{backup}`")
+        backup = await backups.create("wipe")
+        await reset_memory_state()
+        async with db.transaction() as conn:
+            for table in ["history", "bans", "reminders", "notes", "user_facts"]:
+                await conn.execute(f"DELETE FROM {table}")
+        await message.answer(f"✅ הכל נמחק. גיבוי: `{os.path.basename(backup)}`")
     else:
         await message.answer("⚠️ לאישור: `/wipeall CONFIRM`")
 
@@ -1022,41 +4122,46 @@ async def chat_handler(message: types.Message, state: FSMContext):
     if any(kw in message.text.lower() for kw in reminder_keywords):
         remind_at, text = parse_reminder_time(message.text)
         if remind_at:
-            async with aiosqlite.connect(DB_FILE) as db:
-                await db.execute(
-                    "INSERT INTO reminders (user_id, remind_at, text, created_at) VALUES (?, ?, ?, ?)",
-                    (message.from_user.id, remind_at, text, int(time.time()))
-                )
-                await db.commit()
+            await add_reminder(message.from_user.id, remind_at, text)
             dt = datetime.fromtimestamp(remind_at).strftime('%d/%m/%Y %H:%M')
             return await message.answer(f"✅ תזכורת נקבעה:\n**{text}**\n⏰ {dt}")
 
     # שמירת עובדות
-    await extract_and_save_facts(message.from_user.id, message.text)
+    await profiles.observe(message.from_user.id, message.text)
 
     await bot.send_chat_action(message.chat.id, "typing")
 
     try:
-        history = await get_history(message.from_user.id)
-        facts = await get_user_facts(message.from_user.id)
-        facts_str = "\n".join([f"- {k}: {v}" for k, v in facts.items()]) if facts else "אין עדיין"
+        history = await get_history(message.from_user.id, limit=PROMPT_HISTORY_TURNS)
+        facts_str = await profiles.facts_str(message.from_user.id)
         now_str = datetime.now().strftime('%d/%m/%Y %H:%M')
+        recalled = await recall_memory.search(
+            message.from_user.id, message.text, RECALL_TOP_K, exclude_recent=len(history)
+        ) if RECALL_ENABLED else []
+        recall_str = "\n".join(
+            f"- {'המשתמש' if t['role'] == 'user' else 'אתה'}: {t['content'][:300]}" for t in recalled
+        )
 
-        messages = [{"role": "system", "content": f"""אתה הבוט האישי של אביאל - איש IT ואוטומציה מישראל.
+        system = f"""אתה הבוט האישי של אביאל - איש IT ואוטומציה מישראל.
 אופי: ציני, ישיר, לא מבזבז מילים. הומור יבש וסארקזם במינון נכון.
 מומחיות: IT, Windows/Active Directory, Python, אוטומציה, AI, טלגרם בוטים, ענן.
 השעה: {now_str}
 עובדות שאתה זוכר על המשתמש:
-{facts_str}
+{facts_str}""" + (f"\nקטעים רלוונטיים משיחות קודמות:\n{recall_str}" if recall_str else "") + """
 עברית בלבד. תשובות קצרות וממוקדות.
-אל תתחיל ב"בהחלט!" / "כמובן!" / "שאלה מצוינת!""""}
-        ] + history + [{"role": "user", "content": message.text}]
-
-        response = await groq_client.chat.completions.create(
-            model=active_model, messages=messages, max_tokens=900, temperature=0.7
+אל תתחיל ב"בהחלט!" / "כמובן!" / "שאלה מצוינת!\""""
+        messages = prompt_builder.build(
+            message.from_user.id, system, message.text, history, model_router.best(), max_tokens=900
         )
-        reply = response.choices[0].message.content
-        await message.answer(reply, reply_markup=after_reply_kb())
+
+        if STREAM_REPLIES:
+            reply = await stream_completion(message, messages, max_tokens=900)
+        else:
+            response = await model_router.create(
+                messages=messages, max_tokens=900, temperature=0.7
+            )
+            reply = response.choices[0].message.content
+            await message.answer(reply, reply_markup=after_reply_kb())
         await save_message(message.from_user.id, "user", message.text)
         await save_message(message.from_user.id, "assistant", reply)
 
@@ -1073,12 +4178,31 @@ async def cleanup_task():
         except Exception as e:
             logger.error(f"Cleanup error: {e}")
 
-async def model_check_task():
+async def backup_task():
     while True:
-        await asyncio.sleep(86400)
+        await asyncio.sleep(BACKUP_EVERY_SEC)
+        try:
+            await backups.create("hourly")
+        except Exception as e:
+            logger.error(f"Backup error: {e}")
+
+async def rate_snapshot_task():
+    while True:
+        await asyncio.sleep(RATE_SNAPSHOT_SEC)
+        try:
+            await rate_limiter.snapshot()
+        except Exception as e:
+            logger.error(f"Rate snapshot error: {e}")
+
+async def model_check_task(delay: int = 0):
+    """בדיקת כל המודלים ברקע - בעלייה (בלי לעכב את ה-polling) ואחר כך כל MODEL_PROBE_SEC"""
+    while True:
+        await asyncio.sleep(delay)
+        delay = MODEL_PROBE_SEC
         try:
-            old = active_model
-            new = await get_best_model()
+            old = model_router.best()
+            new = await model_router.probe()
+            await save_model_state()
             if new != old:
                 for admin_id in ADMIN_IDS:
                     try:
@@ -1089,44 +4213,56 @@ async def model_check_task():
             logger.error(f"Model check error: {e}")
 
 async def daily_summary_task():
-    """סיכום יומי בכל בוקר ב-8:00"""
-    while True:
-        now = datetime.now()
-        next_run = now.replace(hour=8, minute=0, second=0, microsecond=0)
-        if next_run <= now:
-            next_run += timedelta(days=1)
-        await asyncio.sleep((next_run - now).total_seconds())
-        try:
-            for user_id in ALLOWED_IDS | ADMIN_IDS:
-                async with aiosqlite.connect(DB_FILE) as db:
-                    async with db.execute(
-                        "SELECT remind_at, text FROM reminders WHERE user_id=? AND remind_at < ? ORDER BY remind_at",
-                        (user_id, int((datetime.now() + timedelta(days=1)).timestamp()))
-                    ) as c:
-                        todays = await c.fetchall()
-                if todays:
-                    lines = ["☀️ **תזכורות להיום:**\n"]
-                    for remind_at, text in todays:
-                        dt = datetime.fromtimestamp(remind_at).strftime('%H:%M')
-                        lines.append(f"• {dt} – {text}")
-                    try:
-                        await bot.send_message(user_id, "\n".join(lines))
-                    except Exception:
-                        pass
-        except Exception as e:
-            logger.error(f"Daily summary error: {e}")
+    await digests.load()
+    await digests.run()
 
 # ====================== MAIN ======================
+BOOT_IMPORTED = time.perf_counter()
+boot_times = {}
+
+async def first_poll_timer(make_request, bot_, method):
+    """middleware חד-פעמי: רושם מתי יצאה בקשת ה-getUpdates הראשונה (הבוט מתחיל לשמוע משתמשים)"""
+    if isinstance(method, GetUpdates):
+        bot_.session.middleware.unregister(first_poll_timer)
+        ready = time.perf_counter()
+        logger.info(
+            f"Startup: imports {(BOOT_IMPORTED - BOOT_STARTED) * 1000:.0f}ms, "
+            f"db init {boot_times['db'] * 1000:.0f}ms, "
+            f"first poll after {(ready - BOOT_STARTED) * 1000:.0f}ms"
+        )
+    return await make_request(bot_, method)
+
 async def main():
+    started = time.perf_counter()
     await init_db()
     await load_bans()
-    await get_best_model()
+    await load_model_state()
+    boot_times["db"] = time.perf_counter() - started
+    if RATE_PERSIST:
+        await rate_limiter.restore()
+        asyncio.create_task(rate_snapshot_task())
+    write_behind.start()
+    await broadcaster.resume()
+    image_queue.start()
+    if not FAST_START:
+        await model_router.probe()
+        await save_model_state()
     asyncio.create_task(cleanup_task())
+    if BACKUP_EVERY_SEC:
+        asyncio.create_task(backup_task())
     asyncio.create_task(reminder_checker())
-    asyncio.create_task(model_check_task())
+    asyncio.create_task(model_check_task(0 if FAST_START else MODEL_PROBE_SEC))
     asyncio.create_task(daily_summary_task())
-    logger.info(f"Starting {BOT_NAME} v5.0 with model {active_model}...")
-    await dp.start_polling(bot)
+    logger.info(f"Starting {BOT_NAME} v5.0 with model {model_router.best()}...")
+    bot.session.middleware(first_poll_timer)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        image_queue.close()
+        if RATE_PERSIST:
+            await rate_limiter.snapshot()
+        await write_behind.close()
+        await db.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# הבוט קורא את ההגדרות בזמן import - ערכי דמה מספיקים לבדיקות
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:test")
+os.environ.setdefault("GROQ_API_KEY", "test")
+os.environ.setdefault("HF_TOKEN", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
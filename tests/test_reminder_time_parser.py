@@ -0,0 +1,116 @@
+"""ReminderTimeParser: זהות לפענוח הקודם על התחביר הישן, fuzz, ומקרי קצה ידועים"""
+import random
+import re
+from datetime import datetime, timedelta
+
+import pytest
+
+import bot
+
+NOW = datetime(2026, 3, 15, 13, 37, 12)  # יום ראשון
+
+
+def legacy_parse_reminder_time(text: str, now: datetime) -> tuple:
+    """העתק של המנתח הקודם (עם now מוזרק) - בסיס להשוואה"""
+    stamp = int(now.timestamp())
+    total_seconds = 0
+    reminder_text = text
+    patterns = [
+        (r'(\d+)\s*(?:שעות?|ש\'?)', 3600),
+        (r'(\d+)\s*(?:דקות?|ד\'?)', 60),
+        (r'(\d+)\s*(?:ימים?)', 86400),
+        (r'(\d+)h', 3600),
+        (r'(\d+)m', 60),
+        (r'(\d+)d', 86400),
+    ]
+    for pattern, multiplier in patterns:
+        match = re.search(pattern, text, re.IGNORECASE)
+        if match:
+            total_seconds += int(match.group(1)) * multiplier
+            reminder_text = re.sub(pattern, '', reminder_text, flags=re.IGNORECASE).strip()
+    time_match = re.search(r'(\d{1,2}):(\d{2})', text)
+    if time_match and total_seconds == 0:
+        h, m = int(time_match.group(1)), int(time_match.group(2))
+        target = now.replace(hour=h, minute=m, second=0, microsecond=0)
+        if target <= now:
+            target += timedelta(days=1)
+        total_seconds = int(target.timestamp()) - stamp
+        reminder_text = re.sub(r'\d{1,2}:\d{2}', '', reminder_text).strip()
+    if total_seconds <= 0:
+        return None, text
+    for word in ['תזכיר לי', 'תזכור לי', 'תזכורת', 'remind', 'בעוד', 'תוך']:
+        reminder_text = reminder_text.replace(word, '').strip()
+    return stamp + total_seconds, reminder_text or "תזכורת"
+
+
+# מילות טקסט שלא מתחילות באות של יחידה (ש/ד/h/m/d) - המנתח הישן היה קורא "30 שיחה" כ-30 שעות
+TEXT_WORDS = ["לקנות", "חלב", "פגישה", "להתקשר", "לאמא", "חידוש", "מנוי", "to", "call", "the", "vet", "לבדוק", "גיבוי"]
+OLD_UNITS = {
+    "h": ["שעות", "שעה", "ש'", "h"], "mi": ["דקות", "דקה", "ד'", "m"], "d": ["ימים", "d"],
+}
+
+
+def legacy_input(rng: random.Random) -> str:
+    """קלט בתחביר שהמנתח הקודם תמך בו: יחידה אחת מכל סוג, או שעה hh:mm"""
+    parts = [rng.choice(["", "תזכיר לי ", "תזכור לי ", "remind ", "תזכורת "])]
+    if rng.random() < 0.3:
+        parts.append(f"{rng.randint(0, 23)}:{rng.randint(0, 59):02d} ")
+    else:
+        parts.append(rng.choice(["", "בעוד ", "תוך "]))
+        for kind in rng.sample(list(OLD_UNITS), rng.randint(1, 3)):
+            unit = rng.choice(OLD_UNITS[kind])
+            space = "" if unit.isascii() else rng.choice(["", " "])
+            parts.append(f"{rng.randint(1, 99)}{space}{unit} ")
+    parts.append(" ".join(rng.choices(TEXT_WORDS, k=rng.randint(0, 4))))
+    return "".join(parts)
+
+
+def test_legacy_syntax_matches_old_parser():
+    rng = random.Random(3)
+    parser = bot.ReminderTimeParser()
+    mismatches = []
+    for _ in range(20_000):
+        text = legacy_input(rng)
+        old_at, _ = legacy_parse_reminder_time(text, NOW)
+        new = parser.parse(text, NOW)
+        if old_at is not None and (new is None or new.at != old_at):
+            mismatches.append((text, old_at, new))
+    assert not mismatches[:5]
+
+
+def test_fuzz_never_raises_and_stays_in_future():
+    rng = random.Random(4)
+    parser = bot.ReminderTimeParser()
+    alphabet = list("0123456789 :./-'") + list("שדימחרבעודתוךהםיוןhmdsw") + [
+        "שעות", "דקות", "מחר", "יום ", "ב-", "pm", "שבוע ", "שעה ", "דקה ", "שני ", "הולדת ",
+    ]
+    for _ in range(20_000):
+        text = "".join(rng.choices(alphabet, k=rng.randint(0, 30)))
+        result = parser.parse(text, NOW)
+        assert result is None or (result.at > NOW.timestamp() and result.text), (text, result)
+
+
+@pytest.mark.parametrize("text, expected_at, expected_text, kind", [
+    ("יום שני 10:15 ישיבה", datetime(2026, 3, 16, 10, 15), "ישיבה", "weekday"),
+    ("יום שני 10:15", datetime(2026, 3, 16, 10, 15), "תזכורת", "weekday"),
+    ("יום הולדת לאמא 25/12", datetime(2026, 12, 25, 9, 0), "יום הולדת לאמא", "date"),
+    ("שבוע הבא פגישה 18:00", datetime(2026, 3, 22, 18, 0), "פגישה", "day"),
+    ("בשבוע הבא לבדוק גיבוי", datetime(2026, 3, 22, 9, 0), "לבדוק גיבוי", "day"),
+    ("next week call the vet at 7pm", datetime(2026, 3, 22, 19, 0), "call the vet", "day"),
+    ("תזכיר לי ב 10 בלילה", datetime(2026, 3, 15, 22, 0), "תזכורת", "clock"),
+    ("תזכיר לי ב 10 בלילה לכבות מזגן", datetime(2026, 3, 15, 22, 0), "לכבות מזגן", "clock"),
+    ("שעה ספורט 19:30", datetime(2026, 3, 15, 19, 30), "שעה ספורט", "clock"),
+    ("דקה דומיה 11:00", datetime(2026, 3, 16, 11, 0), "דקה דומיה", "clock"),
+    ("בעוד יום לקנות חלב", datetime(2026, 3, 16, 13, 37, 12), "לקנות חלב", "relative"),
+    ("בעוד שבוע חידוש מנוי", datetime(2026, 3, 22, 13, 37, 12), "חידוש מנוי", "relative"),
+    ("מחר ב-9 להתקשר", datetime(2026, 3, 16, 9, 0), "להתקשר", "day"),
+])
+def test_known_inputs(text, expected_at, expected_text, kind):
+    result = bot.ReminderTimeParser().parse(text, NOW)
+    assert result is not None
+    assert (datetime.fromtimestamp(result.at), result.text, result.kind) == (expected_at, expected_text, kind)
+
+
+@pytest.mark.parametrize("text", ["יום", "שבוע", "שעה", "דקה", "יום הולדת"])
+def test_bare_unit_word_is_not_a_duration(text):
+    assert bot.ReminderTimeParser().parse(text, NOW) is None